@@ -0,0 +1,263 @@
+"""Offline export of rabbit_gamers into columnar chunks, and daily stats over them.
+
+The export pages through the collection in document-ID order and buffers
+at most `chunk_rows` profiles before writing them out as one .npz file of
+NumPy columns, so memory stays bounded however many players there are.
+manifest.json records the chunks and the last exported document ID; it is
+rewritten (atomically) after every chunk, so an interrupted export carries
+on from that cursor when run again with the same output directory.
+
+    python -m analytics_export export exports/2026-10-18
+    python -m analytics_export stats exports/2026-10-18 --previous exports/2026-10-17
+
+Stats are computed over whole columns (np.bincount, percentiles, masks);
+only the columns a stat needs are loaded. User IDs are not exported: each
+row carries a 64-bit hash of it, which is enough to match players between
+two exports (substitute-doll burn) without writing the IDs to disk.
+
+NumPy is not part of the web image: pip install -r requirements-analytics.txt
+"""
+import hashlib
+import json
+import os
+from datetime import datetime
+import numpy as np
+from user_state import ITEM_BITS, UserState, day_number
+
+MANIFEST = "manifest.json"
+FORMAT_VERSION = 1
+
+# column -> dtype; -1 means unknown for the day / look columns
+COLUMNS = {
+    "user_hash": np.uint64,
+    "carrot_count": np.int64,
+    "moon_level": np.int32,
+    "current_streak": np.int32,
+    "last_login_day": np.int32,
+    "created_day": np.int32,
+    "item_bits": np.int64,
+    "look": np.int16,  # index into manifest["looks"]
+}
+
+STREAK_BUCKETS = [0, 1, 2, 3, 7, 14, 30, 100]
+CARROT_BUCKETS = [0, 1, 5, 10, 20, 50, 100]
+
+
+def user_hash(user_id):
+    return int.from_bytes(hashlib.blake2b(user_id.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _created_day(created_at):
+    if isinstance(created_at, datetime):
+        return day_number(created_at.date())
+    if isinstance(created_at, str):
+        try:
+            return day_number(datetime.fromisoformat(created_at).date())
+        except ValueError:
+            pass
+    return -1
+
+
+class ColumnExporter:
+    """Streams one collection into chunk-NNNNNN.npz files under out_dir."""
+
+    def __init__(self, storage, out_dir, collection="rabbit_gamers", page_size=1000, chunk_rows=100000,
+                 today=None):
+        self.storage = storage
+        self.out_dir = out_dir
+        self.collection = collection
+        self.page_size = page_size
+        self.chunk_rows = chunk_rows
+        self.today = today
+        self.pages = 0
+        self._rows = {name: [] for name in COLUMNS}
+        self._buffered = 0
+        self._last_key = None
+
+    def _manifest_path(self):
+        return os.path.join(self.out_dir, MANIFEST)
+
+    def load_manifest(self):
+        try:
+            with open(self._manifest_path(), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _save_manifest(self, manifest):
+        path = self._manifest_path()
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def run(self, max_pages=None):
+        """Export (or resume) until the collection or max_pages runs out; returns the manifest."""
+        os.makedirs(self.out_dir, exist_ok=True)
+        manifest = self.load_manifest()
+        if manifest is None:
+            manifest = {
+                "format": FORMAT_VERSION,
+                "collection": self.collection,
+                "day": self.today,
+                "columns": {name: np.dtype(dtype).str for name, dtype in COLUMNS.items()},
+                "looks": [],
+                "chunks": [],
+                "rows": 0,
+                "cursor": None,
+                "complete": False,
+            }
+        if manifest["complete"]:
+            return manifest
+
+        after = manifest["cursor"]
+        while max_pages is None or self.pages < max_pages:
+            docs = self.storage.scan_page(self.collection, after=after, limit=self.page_size)
+            self.pages += 1
+            for doc in docs:
+                if doc.exists:
+                    self._add(manifest, UserState.from_dict(doc.data, doc.key))
+                self._last_key = doc.key
+                if self._buffered >= self.chunk_rows:
+                    self._flush(manifest)
+            if len(docs) < self.page_size:
+                manifest["complete"] = True
+                break
+            after = docs[-1].key
+        self._flush(manifest)
+        return manifest
+
+    def _add(self, manifest, state):
+        looks = manifest["looks"]
+        if state.current_look not in looks:
+            looks.append(state.current_look)
+        row = self._rows
+        row["user_hash"].append(user_hash(state.user_id))
+        row["carrot_count"].append(state.carrot_count or 0)
+        row["moon_level"].append(state.moon_level or 0)
+        row["current_streak"].append(state.current_streak or 0)
+        row["last_login_day"].append(-1 if state.last_login_day is None else state.last_login_day)
+        row["created_day"].append(_created_day(state.created_at))
+        row["item_bits"].append(state.item_bits or 0)
+        row["look"].append(looks.index(state.current_look))
+        self._buffered += 1
+
+    def _flush(self, manifest):
+        """Write the buffered rows as the next chunk, then move the cursor past them."""
+        if self._buffered:
+            name = f"chunk-{len(manifest['chunks']):06d}.npz"
+            path = os.path.join(self.out_dir, name)
+            with open(path + ".tmp", "wb") as f:
+                np.savez(f, **{column: np.array(values, dtype=COLUMNS[column])
+                               for column, values in self._rows.items()})
+            os.replace(path + ".tmp", path)
+            manifest["chunks"].append({"file": name, "rows": self._buffered})
+            manifest["rows"] += self._buffered
+            self._rows = {column: [] for column in COLUMNS}
+            self._buffered = 0
+        if self._last_key is not None:
+            manifest["cursor"] = self._last_key
+        self._save_manifest(manifest)
+
+
+def load_columns(out_dir, names):
+    """({column: array over all chunks}, manifest) for the given columns."""
+    with open(os.path.join(out_dir, MANIFEST), encoding="utf-8") as f:
+        manifest = json.load(f)
+    parts = {name: [] for name in names}
+    for chunk in manifest["chunks"]:
+        with np.load(os.path.join(out_dir, chunk["file"])) as data:
+            for name in names:
+                parts[name].append(data[name])
+    return {name: np.concatenate(arrays) if arrays else np.empty(0, COLUMNS[name])
+            for name, arrays in parts.items()}, manifest
+
+
+def _bucket_counts(values, edges):
+    """{"lo-hi": count} for edges [e0, e1, ...]; the last bucket is open-ended."""
+    slots = np.maximum(np.searchsorted(edges, values, side="right") - 1, 0)
+    counts = np.bincount(slots, minlength=len(edges))
+    labels = [f"{lo}" if hi == lo + 1 else f"{lo}-{hi - 1}" for lo, hi in zip(edges, edges[1:])]
+    labels.append(f"{edges[-1]}+")
+    return dict(zip(labels, counts.tolist()))
+
+
+def _summary(values):
+    if not len(values):
+        return {"total": 0, "mean": 0.0, "p50": 0, "p90": 0, "p99": 0, "max": 0}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {"total": int(values.sum()), "mean": round(float(values.mean()), 2),
+            "p50": float(p50), "p90": float(p90), "p99": float(p99), "max": int(values.max())}
+
+
+def daily_stats(out_dir, previous_dir=None, day=None):
+    """Retention and economy stats for one export (doll burn needs the previous day's export)."""
+    cols, manifest = load_columns(out_dir, ["user_hash", "carrot_count", "current_streak", "last_login_day",
+                                            "created_day", "item_bits", "look"])
+    day = day if day is not None else manifest["day"]
+    last_login, created = cols["last_login_day"], cols["created_day"]
+    streak, carrots, bits = cols["current_streak"], cols["carrot_count"], cols["item_bits"]
+
+    stats = {"day": day, "players": int(len(streak))}
+    if day is not None:
+        stats["active"] = {f"{n}d": int(np.count_nonzero((last_login >= 0) & (last_login > day - n)))
+                           for n in (1, 7, 30)}
+        # Dn retention: players created n days ago who logged in on `day`
+        retention = {}
+        for n in (1, 7, 30):
+            cohort = created == day - n
+            size = int(np.count_nonzero(cohort))
+            retained = int(np.count_nonzero(cohort & (last_login == day)))
+            retention[f"d{n}"] = {"cohort": size, "retained": retained,
+                                  "rate": round(retained / size, 4) if size else None}
+        stats["retention"] = retention
+
+    stats["streak"] = dict(_summary(streak), buckets=_bucket_counts(streak, STREAK_BUCKETS))
+    stats["carrots"] = dict(_summary(carrots), buckets=_bucket_counts(carrots, CARROT_BUCKETS))
+    stats["items"] = {item: int(np.count_nonzero(bits & bit)) for item, bit in ITEM_BITS.items()}
+    looks = np.bincount(cols["look"], minlength=len(manifest["looks"]))
+    stats["looks"] = dict(zip(manifest["looks"], looks.tolist()))
+
+    if previous_dir:
+        stats["doll_burn"] = doll_burn(cols, load_columns(previous_dir, ["user_hash", "item_bits"])[0])
+    return stats
+
+
+def doll_burn(cols, prev):
+    """Substitute dolls held in the previous export and gone in this one.
+
+    A doll only disappears when it saves a streak, so holders whose doll is
+    gone burned it (one bought back the same day is not seen).
+    """
+    doll = ITEM_BITS["substitute_doll"]
+    _, now_idx, prev_idx = np.intersect1d(cols["user_hash"], prev["user_hash"],
+                                          assume_unique=True, return_indices=True)
+    held = (prev["item_bits"][prev_idx] & doll) != 0
+    burned = held & ((cols["item_bits"][now_idx] & doll) == 0)
+    holders, burned = int(np.count_nonzero(held)), int(np.count_nonzero(burned))
+    return {"holders": holders, "burned": burned, "rate": round(burned / holders, 4) if holders else None}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="rabbit_gamers analytics export")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export = sub.add_parser("export", help="stream the collection into columnar chunks (resumes if interrupted)")
+    export.add_argument("out_dir")
+    export.add_argument("--page-size", type=int, default=1000)
+    export.add_argument("--chunk-rows", type=int, default=100000)
+    export.add_argument("--max-pages", type=int, help="stop after this many pages (run again to continue)")
+    stats = sub.add_parser("stats", help="daily stats for an export, as JSON")
+    stats.add_argument("out_dir")
+    stats.add_argument("--previous", help="the previous day's export, for the doll burn rate")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        import game_logic
+        exporter = ColumnExporter(game_logic.get_storage(), args.out_dir, page_size=args.page_size,
+                                  chunk_rows=args.chunk_rows, today=game_logic.today_number())
+        manifest = exporter.run(max_pages=args.max_pages)
+        state = "complete" if manifest["complete"] else f"paused at {manifest['cursor']}"
+        print(f"{manifest['rows']} rows in {len(manifest['chunks'])} chunks, {exporter.pages} pages read, {state}")
+    else:
+        print(json.dumps(daily_stats(args.out_dir, args.previous), ensure_ascii=False, indent=2))
@@ -0,0 +1,98 @@
+"""Write contention: transactions vs. version-guarded conditional writes.
+
+A few users each send bursts of simultaneous messages (greetings, purchases,
+look changes) from a thread pool, against the Firestore backend on the
+in-memory Firestore stand-in. Each write path is run on the same plan and
+reports the Firestore RPCs, aborted transactions and game_logic.write_stats
+counters, then checks that no carrots were lost or paid twice.
+
+Run from the repository root:
+    python -m benchmarks.bench_contention
+    python -m benchmarks.bench_contention --users 5 --burst 16 --firestore-latency 0.01
+"""
+import argparse
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+import game_logic
+from benchmarks.fakes import install_fakes
+from config import SHOP_ITEMS
+from storage import Write
+
+START_CARROTS = 1000
+
+
+def make_plan(users, bursts, burst, seed=1):
+    """[[(user_id, action, kwargs), ...] per burst]; every message in a burst is for the same user."""
+    rng = random.Random(seed)
+    plan = []
+    for _ in range(bursts):
+        user_id = f"Ucontend{rng.randrange(users):03d}"
+        messages = []
+        for _ in range(burst):
+            roll = rng.random()
+            if roll < 0.4:
+                messages.append((user_id, "morning_greeting", {}))
+            elif roll < 0.8:
+                messages.append((user_id, "purchase", {"item_key": rng.choice(list(SHOP_ITEMS))}))
+            else:
+                messages.append((user_id, "change_look", {"look_key": "normal", "item_req": None,
+                                                         "message_success": "ok", "message_fail": "fail"}))
+        plan.append(messages)
+    return plan
+
+
+def run_mode(conditional, plan, users, threads, firestore_latency):
+    db, _ = install_fakes(firestore_latency=firestore_latency)
+    game_logic.storage.write_many([
+        Write("set", "rabbit_gamers", f"Ucontend{i:03d}",
+              {"user_id": f"Ucontend{i:03d}", "carrot_count": START_CARROTS, "items": []})
+        for i in range(users)
+    ])
+    for name in game_logic.write_stats:
+        game_logic.write_stats[name] = 0
+    rpcs = db.rpcs
+    day = iter(range(20000, 20000 + len(plan)))
+    paid = {}
+
+    with patch("game_logic.CONDITIONAL_WRITES_ENABLED", conditional), ThreadPoolExecutor(threads) as pool:
+        started = time.perf_counter()
+        for messages in plan:
+            # a new day per burst, so greetings have something to write
+            with patch("game_logic.today_number", return_value=next(day)):
+                replies = list(pool.map(lambda m: game_logic.run_action(*m), messages))
+            for (user_id, action, kwargs), reply in zip(messages, replies):
+                if action == "purchase" and reply.startswith("まいどあり"):
+                    paid[user_id] = paid.get(user_id, 0) + SHOP_ITEMS[kwargs["item_key"]]["price"]
+                elif action == "morning_greeting" and reply.startswith("おはよう"):
+                    paid[user_id] = paid.get(user_id, 0) - 1
+        elapsed = time.perf_counter() - started
+
+    for user_id, spent in paid.items():
+        stored = game_logic.storage.get("rabbit_gamers", user_id).data["carrot_count"]
+        assert stored == START_CARROTS - spent, f"{user_id}: {stored} carrots, expected {START_CARROTS - spent}"
+    return elapsed, db.rpcs - rpcs, db.transactions_aborted, dict(game_logic.write_stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=3)
+    parser.add_argument("--bursts", type=int, default=100)
+    parser.add_argument("--burst", type=int, default=8, help="simultaneous messages per burst")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--firestore-latency", type=float, default=0.005, help="seconds per Firestore RPC")
+    args = parser.parse_args()
+
+    plan = make_plan(args.users, args.bursts, args.burst)
+    messages = sum(len(burst) for burst in plan)
+    print(f"{messages} messages in bursts of {args.burst}, {args.users} users, {args.threads} threads")
+    for name, conditional in (("transaction", False), ("conditional", True)):
+        elapsed, rpcs, aborted, stats = run_mode(conditional, plan, args.users, args.threads, args.firestore_latency)
+        print(f"{name:<12} {elapsed:6.2f}s  {rpcs / messages:5.2f} RPCs/message  {aborted:4d} aborted transactions")
+        print(f"{'':<12} {stats}")
+    print("carrot balances match the replies in both modes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Flex message build cost: per-request JSON/dict building vs. precompiled templates.
+
+Run from the repository root:
+    python -m benchmarks.bench_flex_messages
+"""
+import json
+import timeit
+import tracemalloc
+from linebot.models import FlexSendMessage
+from config import IMAGE_URLS
+import line_messages
+from user_state import UserState
+
+USER = {
+    "carrot_count": 12,
+    "current_streak": 7,
+    "items": ["substitute_doll", "sunglasses"],
+    "current_look": "sunglasses",
+}
+USER_STATE = UserState.from_dict(USER, "Ubench")
+
+
+def legacy_create_shop_message():
+    """The old implementation: read and parse the JSON file on every call."""
+    with open(line_messages.TEMPLATE_PATH, "r", encoding="utf-8") as f:
+        json.load(f)
+    return FlexSendMessage(alt_text="月面コンビニ", contents=line_messages.build_shop_carousel())
+
+
+def legacy_create_member_card(user_data):
+    """The old implementation: build the whole bubble dict literal on every call."""
+    my_items = user_data.get("items", [])
+    current_look = user_data.get("current_look", "normal")
+    display_image = IMAGE_URLS["normal"]
+    status_text = "ノーマル"
+    if current_look == "sunglasses":
+        display_image = IMAGE_URLS["sunglasses"]
+        status_text = "サングラス装着中 😎"
+    elif current_look == "pink":
+        display_image = IMAGE_URLS["pink"]
+        status_text = "ピンクに変身中 🎀"
+    doll_status = "あり 🧸" if "substitute_doll" in my_items else "なし"
+    text = lambda t, color="#666666", **kw: {"type": "text", "text": t, "size": "sm", "color": color, **kw}
+    status_card = {
+        "type": "bubble",
+        "hero": {"type": "image", "url": display_image, "size": "full", "aspectRatio": "1:1", "aspectMode": "cover"},
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {"type": "text", "text": "月うさぎ会員証 🌕", "weight": "bold", "size": "xl"},
+                {"type": "separator", "margin": "md"},
+                {
+                    "type": "box", "layout": "vertical", "margin": "md", "spacing": "sm",
+                    "contents": [
+                        text(f"🥕 所持人参: {user_data.get('carrot_count', 0)} 本"),
+                        text(f"🔥 連続記録: {user_data.get('current_streak', 0)} 日"),
+                        text(f"🧸 身代わり人形: {doll_status}"),
+                        text(f"状態: {status_text}", color="#aaaaaa", margin="sm"),
+                    ],
+                },
+            ],
+        },
+        "footer": {
+            "type": "box", "layout": "vertical",
+            "contents": [{
+                "type": "button", "style": "primary", "color": "#FF9933",
+                "action": {"type": "message", "label": "ショップを見る", "text": "ショップ"},
+            }],
+        },
+    }
+    return FlexSendMessage(alt_text="会員証", contents=status_card)
+
+
+def per_call(func, number):
+    """Build and serialize (as reply_message does) one message.
+
+    Returns µs per call, memory blocks retained per built message and the
+    peak traced memory of a single call.
+    """
+    call = lambda: func().as_json_dict()
+    seconds = timeit.timeit(call, number=number)
+
+    tracemalloc.start()
+    call()
+    _, peak = tracemalloc.get_traced_memory()
+    before = tracemalloc.take_snapshot()
+    kept = [func() for _ in range(100)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+    del kept
+    return seconds / number * 1e6, blocks / 100, peak / 1024
+
+
+def main(number=2000):
+    cases = [
+        ("shop (legacy)", legacy_create_shop_message),
+        ("shop (template)", line_messages.create_shop_message),
+        ("member card (legacy)", lambda: legacy_create_member_card(USER)),
+        ("member card (template)", lambda: line_messages.create_member_card(USER_STATE)),
+    ]
+    print(f"{'case':<24}{'us/call':>10}{'blocks/msg':>12}{'peak KiB':>10}")
+    for name, func in cases:
+        usec, allocs, peak = per_call(func, number)
+        print(f"{name:<24}{usec:>10.1f}{allocs:>12.1f}{peak:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Leaderboard cost with a million synthetic players.
+
+Compares "my rank" through the RankingIndex (Fenwick tree over the score
+histogram) with counting over every profile, which is what a query
+without the index would have to do. Also times an index refresh from the
+sharded histogram documents held in the in-memory Firestore stand-in.
+
+Run from the repository root:
+    python -m benchmarks.bench_leaderboard
+    python -m benchmarks.bench_leaderboard --users 100000
+"""
+import argparse
+import random
+import time
+import timeit
+from collections import Counter
+from benchmarks.fakes import FakeFirestore
+from leaderboard import LeaderboardStore, RankingIndex
+
+
+def synthetic_scores(users, seed=1):
+    """Streak-like scores: most players low, a long tail of regulars (about a fifth at 0)."""
+    rng = random.Random(seed)
+    return [int(rng.expovariate(1 / 20)) if rng.random() > 0.2 else 0 for _ in range(users)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--shards", type=int, default=20)
+    parser.add_argument("--max-score", type=int, default=10000)
+    args = parser.parse_args()
+
+    scores = synthetic_scores(args.users)
+    counts = Counter(score for score in scores if score)
+    print(f"{args.users} players, {sum(counts.values())} ranked, {len(counts)} distinct scores")
+
+    start = time.perf_counter()
+    index = RankingIndex(args.max_score, counts)
+    print(f"index build:            {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+    rng = random.Random(2)
+    queries = [rng.choice(scores) for _ in range(1000)]
+    number = 100000
+    it = iter(queries * (number // len(queries)))
+    per_rank = timeit.timeit(lambda: index.rank(next(it)), number=number) / number
+    moves = [(rng.choice(scores), rng.choice(scores)) for _ in range(number)]
+    it = iter(moves)
+    per_move = timeit.timeit(lambda: index.move(*next(it)), number=number) / number
+    print(f"rank() via index:       {per_rank * 1e6:8.2f} us/query")
+    print(f"move() on a new score:  {per_move * 1e6:8.2f} us/update")
+
+    scan_queries = queries[:10]
+    start = time.perf_counter()
+    for score in scan_queries:
+        1 + sum(1 for other in scores if other > score)
+    per_scan = (time.perf_counter() - start) / len(scan_queries)
+    print(f"rank by full scan:      {per_scan * 1e3:8.2f} ms/query "
+          f"(in memory; Firestore would also read {args.users} documents)")
+    print(f"speed-up:               {per_scan / per_rank:8.0f}x")
+
+    # Index refresh from the sharded histogram documents
+    db = FakeFirestore()
+    store = LeaderboardStore(lambda: db, shards=args.shards, max_score=args.max_score)
+    shards = [Counter() for _ in range(args.shards)]
+    # writes land on random shards, so every shard ends up with most scores
+    for score, count in counts.items():
+        for shard in range(args.shards):
+            share = count // args.shards + (shard < count % args.shards)
+            if share:
+                shards[shard][str(score)] = share
+    for shard, shard_counts in enumerate(shards):
+        db.collection("leaderboard").document(f"shard{shard}").set(
+            {"streak": dict(shard_counts), "carrots": dict(shard_counts)}
+        )
+    reads = db.rpcs
+    start = time.perf_counter()
+    store.indexes()
+    print(f"refresh from {args.shards} shards:  {(time.perf_counter() - start) * 1000:8.1f} ms "
+          f"({db.rpcs - reads} get_all call, largest shard {max(len(s) for s in shards)} scores)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""Moon phase lookup cost: legacy modulo arithmetic vs. the precomputed table.
+
+Also reports how long building the table takes and how far the legacy
+mean-synodic-month estimate drifts from the real phase instants.
+
+Run from the repository root:
+    python -m benchmarks.bench_moon_phase
+"""
+import random
+import time
+import timeit
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+import moon_phase
+
+JST = ZoneInfo("Asia/Tokyo")
+LEGACY_BASE = datetime(2023, 1, 22, tzinfo=JST)
+
+
+def legacy_moon_age(when):
+    """The old get_moon_info arithmetic: days since a 2023 new moon, mod the mean month."""
+    diff = when - LEGACY_BASE
+    return (diff.days + diff.seconds / 86400) % 29.53059
+
+
+def main():
+    number = 100000
+    years = 30
+    start = time.perf_counter()
+    table = moon_phase.MoonPhaseTable(2025, 2025 + years)
+    build_ms = (time.perf_counter() - start) * 1000
+    print(f"table build ({years} years, {len(table.times)} phases): {build_ms:.1f} ms, "
+          f"{table.times.itemsize * len(table.times) / 1024:.1f} KiB")
+
+    rng = random.Random(1)
+    samples = [datetime.fromtimestamp(rng.uniform(table.start + 86400, table.end - 86400), JST) for _ in range(1000)]
+    moments = iter(samples * (number // len(samples) + 1))
+    legacy = timeit.timeit(lambda: legacy_moon_age(next(moments)), number=number)
+    moments = iter(samples * (number // len(samples) + 1))
+    lookup = timeit.timeit(lambda: table.describe(next(moments)), number=number)
+    print(f"legacy modulo:     {legacy / number * 1e6:6.2f} us/call")
+    print(f"table describe():  {lookup / number * 1e6:6.2f} us/call")
+
+    # Legacy drift: mean-month age at each real new moon (ideally 0 / 29.5)
+    drift = []
+    for ts in table.times[::4]:
+        age = legacy_moon_age(datetime.fromtimestamp(ts, JST))
+        drift.append(min(age, 29.53059 - age) * 24)
+    print(f"legacy error at real new moons: mean {sum(drift) / len(drift):.1f} h, max {max(drift):.1f} h")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Game-flow throughput on each storage backend.
+
+Runs the game actions straight through game_logic (no HTTP, no Gemini) from
+a pool of threads: greetings and purchases as per-user transactions, look
+changes, member-card reads and whole webhook payloads through
+process_batch. The Firestore backend runs against the in-memory Firestore
+stand-in with --firestore-latency per RPC.
+
+Run from the repository root:
+    python -m benchmarks.bench_storage
+    python -m benchmarks.bench_storage --backends memory sqlite --actions 20000 --threads 16
+"""
+import argparse
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+import game_logic
+from benchmarks.fakes import install_fakes
+
+# action -> weight
+DEFAULT_MIX = {
+    "morning_greeting": 40,
+    "purchase": 15,
+    "change_look": 10,
+    "member_card": 20,
+    "batch": 15,
+}
+ITEMS = ["substitute_doll", "sunglasses", "pink_dye"]
+
+
+def make_plan(actions, users, seed=1):
+    rng = random.Random(seed)
+    names = list(DEFAULT_MIX)
+    kinds = rng.choices(names, weights=[DEFAULT_MIX[n] for n in names], k=actions)
+    return [(kind, f"Ubench{rng.randrange(users):06d}", rng.choice(ITEMS), rng) for kind in kinds]
+
+
+def run_one(kind, user_id, item, rng):
+    if kind == "morning_greeting":
+        game_logic.process_morning_greeting(user_id)
+    elif kind == "purchase":
+        game_logic.process_purchase(user_id, item)
+    elif kind == "change_look":
+        game_logic.process_change_look(user_id, "pink", "pink_dye", "ok", "fail")
+    elif kind == "member_card":
+        game_logic.get_or_create_user(user_id, use_cache=False)
+    else:
+        others = [f"Ubench{rng.randrange(100000, 100050):06d}" for _ in range(4)]
+        game_logic.process_batch([(u, "morning_greeting", {}) for u in others])
+
+
+def run_backend(backend, plan, threads, firestore_latency):
+    with tempfile.TemporaryDirectory() as workdir:
+        install_fakes(firestore_latency=firestore_latency, backend=backend, sqlite_path=f"{workdir}/bench.db")
+        game_logic.leaderboard._indexes = None
+        # every action reads its profile instead of hitting the profile cache
+        with patch.object(game_logic.profile_cache, "get", return_value=None):
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                for future in [pool.submit(run_one, *step) for step in plan]:
+                    future.result()
+            elapsed = time.perf_counter() - started
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=["memory", "sqlite", "firestore"],
+                        choices=["memory", "sqlite", "firestore"])
+    parser.add_argument("--actions", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--firestore-latency", type=float, default=0.005, help="seconds per Firestore RPC")
+    args = parser.parse_args()
+
+    print(f"{args.actions} actions, {args.users} users, {args.threads} threads")
+    print(f"{'backend':<12}{'seconds':>10}{'actions/s':>12}{'us/action':>12}")
+    for backend in args.backends:
+        elapsed = run_backend(backend, make_plan(args.actions, args.users), args.threads, args.firestore_latency)
+        print(f"{backend:<12}{elapsed:>10.2f}{args.actions / elapsed:>12.0f}{elapsed / args.actions * 1e6:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,412 @@
+"""Local stand-ins for Firestore, Gemini and the LINE platform.
+
+Used by the load tests and benchmarks so the full game flow runs on one
+machine. Each fake has a tunable per-call latency.
+"""
+import asyncio
+import base64
+import copy
+import hashlib
+import hmac
+import itertools
+import json
+import threading
+import time
+import uuid
+from google.api_core.exceptions import Aborted, AlreadyExists, FailedPrecondition, NotFound
+from google.cloud.firestore import DELETE_FIELD, Increment, Query
+
+
+def _merge(current, data, nested=True):
+    """set(merge=True) (nested maps merged key by key) or update() (nested=False).
+
+    Increment and DELETE_FIELD are applied.
+    """
+    merged = dict(current)
+    for name, value in data.items():
+        if value is DELETE_FIELD:
+            merged.pop(name, None)
+        elif isinstance(value, Increment):
+            merged[name] = merged.get(name, 0) + value.value
+        elif nested and isinstance(value, dict):
+            merged[name] = _merge(merged.get(name) or {}, value)
+        else:
+            merged[name] = value
+    return merged
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data, update_time):
+        self.id = doc_id
+        self._data = data
+        self.exists = data is not None
+        self.update_time = update_time
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+class FakeWriteResult:
+    def __init__(self, update_time):
+        self.update_time = update_time
+
+
+class FakeWriteOption:
+    def __init__(self, last_update_time):
+        self.last_update_time = last_update_time
+
+
+class FakeDocumentReference:
+    def __init__(self, db, collection, doc_id):
+        self._db = db
+        self.collection_name = collection
+        self.id = doc_id
+        self.key = (collection, doc_id)
+
+    def get(self, transaction=None):
+        self._db._rpc()
+        snapshot = self._db._snapshot(self.key)
+        if transaction is not None:
+            transaction._reads[self.key] = snapshot.update_time
+        return snapshot
+
+    def set(self, data, merge=False):
+        self._db._rpc()
+        self._db._apply([("merge" if merge else "set", self.key, data, None)])
+
+    def update(self, data, option=None):
+        self._db._rpc()
+        self._db._apply([("update", self.key, data, option)])
+
+    def create(self, data):
+        self._db._rpc()
+        self._db._apply([("create", self.key, data, None)])
+
+    def collection(self, name):
+        return FakeCollection(self._db, f"{self.collection_name}/{self.id}/{name}")
+
+
+class FakeQuery:
+    """order_by / limit / start_after / select over one collection (no index needed here).
+
+    Ordering by "__name__" (the document ID) supports a start_after cursor.
+    """
+
+    def __init__(self, db, collection, order=None, limit=None, after=None):
+        self._db = db
+        self._collection = collection
+        self._order = order
+        self._limit = limit
+        self._after = after
+
+    def order_by(self, field, direction=Query.ASCENDING):
+        return FakeQuery(self._db, self._collection, (field, direction), self._limit, self._after)
+
+    def limit(self, count):
+        return FakeQuery(self._db, self._collection, self._order, count, self._after)
+
+    def start_after(self, values):
+        after = values["__name__"]
+        return FakeQuery(self._db, self._collection, self._order, self._limit, getattr(after, "id", after))
+
+    def select(self, fields):
+        return self
+
+    def stream(self):
+        self._db._rpc()
+        with self._db._lock:
+            docs = [(key[1], data) for key, (data, _) in self._db._docs.items() if key[0] == self._collection]
+        if self._order and self._order[0] == "__name__":
+            docs.sort(key=lambda doc: doc[0])
+            if self._after is not None:
+                docs = [doc for doc in docs if doc[0] > self._after]
+        elif self._order:
+            field, direction = self._order
+            docs = [doc for doc in docs if field in doc[1]]
+            docs.sort(key=lambda doc: doc[1][field], reverse=direction == Query.DESCENDING)
+        if self._limit is not None:
+            docs = docs[:self._limit]
+        return iter([FakeSnapshot(doc_id, data, None) for doc_id, data in docs])
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, name):
+        super().__init__(db, name)
+        self.name = name
+
+    def document(self, doc_id):
+        return FakeDocumentReference(self._db, self.name, doc_id)
+
+
+class FakeWriteBatch:
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, ref, data, merge=False):
+        self._writes.append(("merge" if merge else "set", ref.key, data, None))
+
+    def update(self, ref, data, option=None):
+        self._writes.append(("update", ref.key, data, option))
+
+    def create(self, ref, data):
+        self._writes.append(("create", ref.key, data, None))
+
+    def commit(self):
+        self._db._rpc()
+        return self._db._apply(self._writes)
+
+
+class FakeTransaction(FakeWriteBatch):
+    """Optimistic transaction compatible with @firestore.transactional.
+
+    Reads remember the document version; commit aborts (and the decorator
+    retries) if any read document changed in the meantime.
+    """
+
+    def __init__(self, db, max_attempts=5):
+        super().__init__(db)
+        self._max_attempts = max_attempts
+        self._read_only = False
+        self._id = None
+        self._reads = {}
+
+    def _clean_up(self):
+        self._writes = []
+        self._reads = {}
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._db._rpc()
+        self._id = uuid.uuid4().bytes
+
+    def _rollback(self):
+        self._clean_up()
+
+    def _commit(self):
+        self._db._rpc()
+        self._db._apply(self._writes, expected=self._reads)
+        self._db.transactions_committed += 1
+        self._clean_up()
+        return []
+
+
+class FakeFirestore:
+    """In-memory Firestore client with per-RPC latency.
+
+    Set `outage` to an exception to have every RPC fail with it (after the
+    latency), for fault-injection tests.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.outage = None
+        self.rpcs = 0
+        self.transactions_committed = 0
+        self.transactions_aborted = 0
+        self._docs = {}  # (collection, id) -> (data, update_time)
+        self._clock = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _rpc(self):
+        self.rpcs += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.outage is not None:
+            raise self.outage
+
+    def _snapshot(self, key):
+        with self._lock:
+            data, update_time = self._docs.get(key, (None, None))
+            return FakeSnapshot(key[1], data, update_time)
+
+    def _apply(self, writes, expected=None):
+        with self._lock:
+            for key, update_time in (expected or {}).items():
+                if self._docs.get(key, (None, None))[1] != update_time:
+                    self.transactions_aborted += 1
+                    raise Aborted("Transaction lock timeout / contention")
+            for op, key, data, option in writes:
+                current, update_time = self._docs.get(key, (None, None))
+                if op == "create" and current is not None:
+                    raise AlreadyExists(f"Document already exists: {key}")
+                if op == "update":
+                    if current is None:
+                        raise NotFound(f"No document to update: {key}")
+                    if option is not None and option.last_update_time != update_time:
+                        raise FailedPrecondition("update_time precondition failed")
+            results = []
+            for op, key, data, option in writes:
+                if op == "update":
+                    data = _merge(self._docs[key][0], data, nested=False)
+                elif op == "merge":
+                    data = _merge(self._docs.get(key, (None, None))[0] or {}, data)
+                self._docs[key] = (copy.deepcopy(data), next(self._clock))
+                results.append(FakeWriteResult(self._docs[key][1]))
+            return results
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def transaction(self, max_attempts=5, read_only=False):
+        return FakeTransaction(self, max_attempts=max_attempts)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def write_option(self, last_update_time=None):
+        return FakeWriteOption(last_update_time)
+
+    def get_all(self, refs, transaction=None):
+        self._rpc()
+        return [self._snapshot(ref.key) for ref in refs]
+
+
+class FakeUsage:
+    def __init__(self, prompt_tokens, output_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+
+
+class FakeResponse:
+    def __init__(self, text, usage=None):
+        self.text = text
+        self.usage_metadata = usage
+
+
+class FakeGeminiModel:
+    """Gemini stand-in: answers after `latency` seconds in persona style.
+
+    Set `outage` to an exception to have every call fail with it.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.outage = None
+        self.calls = 0
+
+    def _reply(self, contents):
+        self.calls += 1
+        if self.outage is not None:
+            raise self.outage
+        if isinstance(contents, list):
+            # chat history: answer the newest message
+            contents = contents[-1]["parts"][0]
+        return FakeResponse(f"{str(contents)[:20]}だぴょん🐰")
+
+    def generate_content(self, contents, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._reply(contents)
+
+    async def generate_content_async(self, contents, stream=False, **kwargs):
+        if not stream:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return self._reply(contents)
+        # First chunk after half the latency, the rest spread over the other half
+        if self.latency:
+            await asyncio.sleep(self.latency / 2)
+        return self._stream(self._reply(contents).text)
+
+    async def _stream(self, text, chunk_chars=8):
+        pieces = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)]
+        for n, piece in enumerate(pieces, 1):
+            if n > 1 and self.latency:
+                await asyncio.sleep(self.latency / 2 / len(pieces))
+            yield FakeResponse(piece, FakeUsage(len(text), n))
+
+
+def install_fakes(firestore_latency=0.0, gemini_latency=0.0, backend="firestore", sqlite_path=None):
+    """Point game_logic at fresh in-memory stand-ins; returns (db, model).
+
+    backend "firestore" runs the Firestore backend against FakeFirestore
+    (db); "memory" and "sqlite" use those backends directly (db is None).
+    """
+    import game_logic
+    from storage import create_backend
+
+    db = FakeFirestore(latency=firestore_latency) if backend == "firestore" else None
+    model = FakeGeminiModel(latency=gemini_latency)
+    game_logic.db = db
+    game_logic.storage = create_backend(backend, firestore_client=lambda: db,
+                                        sqlite_path=sqlite_path or game_logic.SQLITE_PATH)
+    game_logic.model = model
+    game_logic.profile_cache.clear()
+    game_logic.reply_cache.backend.clear()
+    return db, model
+
+
+# --- LINE platform stand-in: signed webhook payloads ---
+
+def sign_body(body, channel_secret):
+    digest = hmac.new(channel_secret.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+def text_event(user_id, text, reply_token=None, redelivery=False):
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "replyToken": reply_token or uuid.uuid4().hex,
+        "webhookEventId": uuid.uuid4().hex.upper(),
+        "deliveryContext": {"isRedelivery": redelivery},
+        "message": {"type": "text", "id": uuid.uuid4().hex[:16], "text": text},
+    }
+
+
+def make_webhook(events, channel_secret):
+    """Return (body, headers) for a signed LINE webhook delivery."""
+    body = json.dumps({"destination": "Ubench", "events": events}, ensure_ascii=False)
+    return body, {"X-Line-Signature": sign_body(body, channel_secret), "Content-Type": "application/json"}
+
+
+class FakeLineClient:
+    """AsyncLineClient stand-in that records replies and wakes up waiters."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.replies = 0
+        self.multicasts = 0
+        self.broadcasts = 0
+        self._waiters = {}
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def expect_reply(self, reply_token):
+        """Future resolved with the messages once `reply_token` is replied to."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[reply_token] = future
+        return future
+
+    async def reply_message(self, reply_token, messages, received_at=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.replies += 1
+        future = self._waiters.pop(reply_token, None)
+        if future is not None and not future.done():
+            future.set_result(messages)
+
+    async def push_message(self, to, messages, notification_disabled=False):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def broadcast(self, messages, retry_key=None, notification_disabled=False):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.broadcasts += 1
+
+    async def multicast(self, user_ids, messages, notification_disabled=False):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.multicasts += 1
+        return (len(user_ids) + 499) // 500
+
+    def stats(self):
+        return {"replies": self.replies, "multicasts": self.multicasts, "broadcasts": self.broadcasts}
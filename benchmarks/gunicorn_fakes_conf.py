@@ -0,0 +1,13 @@
+"""gunicorn config for load tests: production settings + in-memory backends per worker."""
+import os
+from gunicorn_conf import *  # noqa: F401,F403
+
+
+def post_worker_init(worker):
+    from benchmarks.fakes import install_fakes
+    install_fakes(
+        firestore_latency=float(os.environ.get("FAKE_FIRESTORE_LATENCY", "0.005")),
+        gemini_latency=float(os.environ.get("FAKE_GEMINI_LATENCY", "0.2")),
+        # "sqlite" shares one database file (SQLITE_PATH) between the workers
+        backend=os.environ.get("FAKE_STORAGE_BACKEND", "firestore"),
+    )
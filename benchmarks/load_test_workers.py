@@ -0,0 +1,139 @@
+"""Throughput vs. gunicorn worker count, against local stand-ins.
+
+Starts a stub LINE API, then for each worker count boots the app under
+gunicorn (with in-memory Firestore / Gemini fakes in every worker), fires
+signed webhooks and measures how fast replies come back to the stub.
+
+Run from the repository root:
+    python -m benchmarks.load_test_workers --workers 1 2 4 --requests 2000
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import socket
+import subprocess
+import sys
+import time
+import httpx
+from aiohttp import web
+from benchmarks.fakes import make_webhook, text_event
+
+CHANNEL_SECRET = "load-test-secret"
+COMMAND_MIX = ["おはよう", "ショップ", "会員証", "サングラスを買う", "サングラス装着", "おやすみ", "今日は何してるの？"]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LineStub:
+    """Minimal LINE Messaging API: counts reply calls."""
+
+    def __init__(self):
+        self.replies = 0
+        self.app = web.Application()
+        self.app.router.add_post("/v2/bot/message/reply", self.reply)
+
+    async def reply(self, request):
+        await request.read()
+        self.replies += 1
+        return web.json_response({})
+
+    async def start(self, port):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def start_server(workers, port, line_port, args):
+    env = dict(
+        os.environ,
+        CHANNEL_ACCESS_TOKEN="load-test-token",
+        CHANNEL_SECRET=CHANNEL_SECRET,
+        GEMINI_API_KEY="load-test-key",
+        LINE_API_ENDPOINT=f"http://127.0.0.1:{line_port}",
+        WEB_CONCURRENCY=str(workers),
+        PORT=str(port),
+        FAKE_FIRESTORE_LATENCY=str(args.firestore_latency),
+        FAKE_GEMINI_LATENCY=str(args.gemini_latency),
+    )
+    return subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "main:app", "-c", "benchmarks/gunicorn_fakes_conf.py",
+         "--log-level", "warning"],
+        env=env,
+    )
+
+
+async def wait_ready(client, url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+async def run_round(workers, args, stub, line_port):
+    port = free_port()
+    proc = start_server(workers, port, line_port, args)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        async with httpx.AsyncClient(timeout=30) as client:
+            await wait_ready(client, base + "/")
+            stub.replies = 0
+            users = [f"Uload{i:05d}" for i in range(args.users)]
+            payloads = [
+                make_webhook([text_event(user, text)], CHANNEL_SECRET)
+                for user, text in zip(itertools.cycle(users), itertools.islice(itertools.cycle(COMMAND_MIX), args.requests))
+            ]
+            sem = asyncio.Semaphore(args.concurrency)
+
+            async def send(body, headers):
+                async with sem:
+                    await client.post(base + "/callback", content=body.encode("utf-8"), headers=headers)
+
+            started = time.monotonic()
+            await asyncio.gather(*(send(body, headers) for body, headers in payloads))
+            while stub.replies < args.requests and time.monotonic() - started < args.timeout:
+                await asyncio.sleep(0.01)
+            elapsed = time.monotonic() - started
+            return stub.replies, elapsed
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--firestore-latency", type=float, default=0.005)
+    parser.add_argument("--gemini-latency", type=float, default=0.2)
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    stub = LineStub()
+    line_port = free_port()
+    await stub.start(line_port)
+    try:
+        print(f"{'workers':>8}{'replies':>10}{'seconds':>10}{'replies/s':>12}")
+        for workers in args.workers:
+            replies, elapsed = await run_round(workers, args, stub, line_port)
+            print(f"{workers:>8}{replies:>10}{elapsed:>10.2f}{replies / elapsed:>12.1f}")
+    finally:
+        await stub.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
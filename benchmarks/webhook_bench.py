@@ -0,0 +1,184 @@
+"""End-to-end latency / throughput benchmark with a local LINE webhook simulator.
+
+Drives the FastAPI app in-process with correctly signed webhook payloads
+(using CHANNEL_SECRET) and in-memory Firestore / Gemini / LINE stand-ins
+with tunable latency. Each virtual user sends a command and waits for its
+reply before sending the next, so latency covers signature check, queueing,
+game logic and the reply call.
+
+Run from the repository root:
+    python -m benchmarks.webhook_bench --requests 2000 --concurrency 50
+    python -m benchmarks.webhook_bench --json after.json --baseline before.json
+    python -m benchmarks.webhook_bench --backend sqlite
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import tempfile
+import time
+import httpx
+from benchmarks.fakes import FakeLineClient, install_fakes, make_webhook, text_event
+
+# command type -> (weight, candidate texts)
+DEFAULT_MIX = {
+    "おはよう": (30, ["おはよう", "おはよう！", "みんなおはよう"]),
+    "ショップ": (10, ["ショップ"]),
+    "会員証": (15, ["会員証"]),
+    "購入": (10, ["身代わり人形を買う", "サングラスを買う", "ピンク染め粉を買う"]),
+    "着替え": (5, ["サングラス装着", "ピンクに変身", "元に戻す"]),
+    "おやすみ": (5, ["おやすみ"]),
+    "フリー会話": (25, ["こんにちは", "今日は何してるの？", "月ってどんなところ？", "お腹すいた"]),
+}
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(samples, elapsed):
+    """samples: {command: [latency seconds]} -> {command: stats dict}."""
+    report = {}
+    everything = []
+    for command, latencies in samples.items():
+        everything.extend(latencies)
+        report[command] = _stats(latencies, elapsed)
+    report["ALL"] = _stats(everything, elapsed)
+    return report
+
+
+def _stats(latencies, elapsed):
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "p50_ms": percentile(ordered, 50) * 1000,
+        "p95_ms": percentile(ordered, 95) * 1000,
+        "p99_ms": percentile(ordered, 99) * 1000,
+        "rps": len(ordered) / elapsed if elapsed else 0.0,
+    }
+
+
+def print_report(report):
+    print(f"{'command':<12}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}")
+    for command, row in report.items():
+        print(f"{command:<12}{row['count']:>8}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}"
+              f"{row['p99_ms']:>10.1f}{row['rps']:>10.1f}")
+
+
+def regressions(report, baseline, tolerance):
+    """Commands whose p95 grew or throughput dropped by more than `tolerance`."""
+    found = []
+    for command, row in report.items():
+        base = baseline.get(command)
+        if not base or not base["count"]:
+            continue
+        if base["p95_ms"] and row["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            found.append(f"{command}: p95 {base['p95_ms']:.1f} -> {row['p95_ms']:.1f} ms")
+        if row["rps"] < base["rps"] * (1 - tolerance):
+            found.append(f"{command}: req/s {base['rps']:.1f} -> {row['rps']:.1f}")
+    return found
+
+
+async def run_benchmark(requests=1000, concurrency=20, users=200, mix=None,
+                        firestore_latency=0.005, gemini_latency=0.3, line_latency=0.02, seed=1,
+                        backend="firestore"):
+    """Replay a weighted command mix; returns (report, elapsed seconds)."""
+    import main
+    from config import CHANNEL_SECRET
+
+    mix = mix or DEFAULT_MIX
+    rng = random.Random(seed)
+    commands = list(mix)
+    weights = [mix[c][0] for c in commands]
+    plan = [(c, rng.choice(mix[c][1])) for c in rng.choices(commands, weights=weights, k=requests)]
+    user_ids = [f"Ubench{i:06d}" for i in range(users)]
+
+    workdir = tempfile.TemporaryDirectory()
+    install_fakes(firestore_latency=firestore_latency, gemini_latency=gemini_latency,
+                  backend=backend, sqlite_path=f"{workdir.name}/bench.db")
+    for limiter in main.rate_limiters.values():
+        limiter.clear()
+    fake_line = FakeLineClient(latency=line_latency)
+    original_line_client = main.line_client
+    main.line_client = fake_line
+
+    samples = {c: [] for c in commands}
+    queue = asyncio.Queue()
+    for item in plan:
+        queue.put_nowait(item)
+
+    async def virtual_user(client):
+        while not queue.empty():
+            command, text = queue.get_nowait()
+            event = text_event(rng.choice(user_ids), text)
+            body, headers = make_webhook([event], CHANNEL_SECRET)
+            replied = fake_line.expect_reply(event["replyToken"])
+            started = time.perf_counter()
+            res = await client.post("/callback", content=body.encode("utf-8"), headers=headers)
+            if res.status_code != 200:
+                replied.cancel()
+                continue
+            await asyncio.wait_for(replied, timeout=60)
+            samples[command].append(time.perf_counter() - started)
+
+    try:
+        async with main.lifespan(main.app):
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                started = time.perf_counter()
+                await asyncio.gather(*(virtual_user(client) for _ in range(concurrency)))
+                elapsed = time.perf_counter() - started
+    finally:
+        main.line_client = original_line_client
+        workdir.cleanup()
+    return summarize(samples, elapsed), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--backend", choices=["firestore", "memory", "sqlite"], default="firestore",
+                        help="storage backend (firestore: the in-memory Firestore stand-in)")
+    parser.add_argument("--firestore-latency", type=float, default=0.005, help="seconds per Firestore RPC")
+    parser.add_argument("--gemini-latency", type=float, default=0.3, help="seconds per Gemini call")
+    parser.add_argument("--line-latency", type=float, default=0.02, help="seconds per LINE reply")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--baseline", help="compare with a report saved by --json")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression vs. baseline")
+    args = parser.parse_args()
+
+    report, elapsed = asyncio.run(run_benchmark(
+        requests=args.requests,
+        concurrency=args.concurrency,
+        users=args.users,
+        firestore_latency=args.firestore_latency,
+        gemini_latency=args.gemini_latency,
+        line_latency=args.line_latency,
+        seed=args.seed,
+        backend=args.backend,
+    ))
+    print(f"{args.requests} requests, concurrency {args.concurrency}, {args.backend} backend, {elapsed:.2f}s")
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            found = regressions(report, json.load(f), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from storage import Write
+
+# Sent ahead of the recent turns so the model knows what was said earlier
+SUMMARY_PREFIX = "（これまでの会話のまとめ: {summary}）"
+
+
+def extractive_summary(summary, exchanges, max_chars):
+    """Fold old exchanges into the summary without a model call.
+
+    Keeps what the user said (that is the context they would otherwise
+    repeat); when over budget the oldest part is dropped.
+    """
+    parts = [summary] if summary else []
+    parts.extend(user_text for user_text, _ in exchanges)
+    combined = " / ".join(parts)
+    if len(combined) > max_chars:
+        combined = "…" + combined[-(max_chars - 1):]
+    return combined
+
+
+class ChatSession:
+    """One user's conversation: a summary plus a ring buffer of recent exchanges."""
+
+    __slots__ = ("user_id", "summary", "exchanges", "dirty", "last_used")
+
+    def __init__(self, user_id, summary="", exchanges=(), max_exchanges=8, last_used=0.0):
+        self.user_id = user_id
+        self.summary = summary
+        self.exchanges = deque(exchanges, maxlen=max_exchanges)  # (user_text, reply)
+        self.dirty = False
+        self.last_used = last_used
+
+    @property
+    def has_history(self):
+        return bool(self.summary or self.exchanges)
+
+    def contents(self, text):
+        """Gemini contents: summary, recent exchanges, then the new message."""
+        contents = []
+        if self.summary:
+            contents.append({"role": "user", "parts": [SUMMARY_PREFIX.format(summary=self.summary)]})
+        for user_text, reply in self.exchanges:
+            contents.append({"role": "user", "parts": [user_text]})
+            contents.append({"role": "model", "parts": [reply]})
+        contents.append({"role": "user", "parts": [text]})
+        return contents
+
+    def to_dict(self):
+        """Stored form: exchanges flattened to one list of strings (user, reply, user, ...)."""
+        return {
+            "summary": self.summary,
+            "turns": [text for exchange in self.exchanges for text in exchange],
+        }
+
+    @classmethod
+    def from_dict(cls, user_id, data, max_exchanges=8):
+        turns = data.get("turns") or []
+        exchanges = list(zip(turns[0::2], turns[1::2]))
+        return cls(user_id, data.get("summary", ""), exchanges[-max_exchanges:], max_exchanges)
+
+
+class ChatMemory:
+    """Per-user chat history with bounded memory.
+
+    Hot sessions live in an LRU of at most `max_sessions` users. Each keeps
+    up to `max_exchanges` exchanges (texts capped at `max_turn_chars`); when
+    the buffer is full the oldest `compact_exchanges` are folded into a
+    summary of at most `summary_max_chars`, so prompt size stays flat.
+    Sessions that fall out of the LRU or sit idle for `idle_ttl` seconds go
+    cold: they are handed back to the caller to persist to `store`.
+
+    load() and persist() do I/O when a store is set; call them off the event loop.
+    """
+
+    def __init__(self, max_sessions=10000, max_exchanges=8, compact_exchanges=4, max_turn_chars=300,
+                 summary_max_chars=400, idle_ttl=1800.0, store=None, summarizer=extractive_summary,
+                 clock=time.monotonic):
+        self.max_sessions = max_sessions
+        self.max_exchanges = max_exchanges
+        self.compact_exchanges = max(1, min(compact_exchanges, max_exchanges))
+        self.max_turn_chars = max_turn_chars
+        self.summary_max_chars = summary_max_chars
+        self.idle_ttl = idle_ttl
+        self.store = store
+        self.summarizer = summarizer
+        self.clock = clock
+        self.loads = 0
+        self.compactions = 0
+        self.evictions = 0
+        self.saved = 0
+        self._sessions = OrderedDict()  # user_id -> ChatSession, least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def hot(self, user_id):
+        """The in-memory session, or None (no I/O)."""
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is not None:
+                self._sessions.move_to_end(user_id)
+                session.last_used = self.clock()
+            return session
+
+    def load(self, user_id):
+        """Hot session, else the stored one, else a new empty session."""
+        session = self.hot(user_id)
+        if session is not None:
+            return session
+        data = self.store.load(user_id) if self.store is not None else None
+        self.loads += 1
+        session = ChatSession(user_id, max_exchanges=self.max_exchanges, last_used=self.clock())
+        if data:
+            session = ChatSession.from_dict(user_id, data, self.max_exchanges)
+            session.last_used = self.clock()
+        with self._lock:
+            # Another request for the same user may have loaded it meanwhile
+            return self._sessions.setdefault(user_id, session)
+
+    def record(self, session, text, reply):
+        """Append an exchange. Returns the sessions that went cold (to persist)."""
+        with self._lock:
+            if len(session.exchanges) >= self.max_exchanges:
+                old = [session.exchanges.popleft() for _ in range(self.compact_exchanges)]
+                session.summary = self.summarizer(session.summary, old, self.summary_max_chars)
+                self.compactions += 1
+            session.exchanges.append((text[:self.max_turn_chars], reply[:self.max_turn_chars]))
+            session.dirty = True
+            session.last_used = now = self.clock()
+            self._sessions[session.user_id] = session
+            self._sessions.move_to_end(session.user_id)
+            return self._evict(now)
+
+    def _evict(self, now):
+        cold = []
+        while self._sessions:
+            user_id, oldest = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and now - oldest.last_used < self.idle_ttl:
+                break
+            del self._sessions[user_id]
+            self.evictions += 1
+            if oldest.dirty:
+                cold.append(oldest)
+        return cold
+
+    def persist(self, sessions):
+        """Write sessions to the store (blocking)."""
+        sessions = [s for s in sessions if s.dirty]
+        if self.store is None or not sessions:
+            return
+        self.store.save_many([(s.user_id, s.to_dict()) for s in sessions])
+        for session in sessions:
+            session.dirty = False
+        self.saved += len(sessions)
+
+    def flush(self):
+        """Persist every unsaved hot session (shutdown)."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        self.persist(sessions)
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+    def stats(self):
+        return {
+            "sessions": len(self._sessions),
+            "loads": self.loads,
+            "compactions": self.compactions,
+            "evictions": self.evictions,
+            "saved": self.saved,
+        }
+
+
+class ChatStore:
+    """Cold sessions as one small document under the user's rabbit_gamers document."""
+
+    def __init__(self, storage_factory, collection="rabbit_gamers", subcollection="chat_memory",
+                 document="session"):
+        self.storage_factory = storage_factory
+        self.collection = collection
+        self.subcollection = subcollection
+        self.document = document
+
+    def _collection(self, user_id):
+        return f"{self.collection}/{user_id}/{self.subcollection}"
+
+    def load(self, user_id):
+        return self.storage_factory().get(self._collection(user_id), self.document).data
+
+    def save_many(self, items):
+        storage = self.storage_factory()
+        now = datetime.now(timezone.utc)
+        # Firestore commits hold at most 500 writes
+        for start in range(0, len(items), 500):
+            storage.write_many([
+                Write("set", self._collection(user_id), self.document, dict(data, updated_at=now))
+                for user_id, data in items[start:start + 500]
+            ])
@@ -0,0 +1,177 @@
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """The breaker is open: the call was not attempted."""
+
+
+class CircuitBreaker:
+    """Failure-rate circuit breaker for one dependency.
+
+    Closed: calls go through and their outcomes are kept for `window`
+    seconds. Once at least `min_calls` are in the window and the share of
+    failures (errors, and calls slower than `slow_call` seconds) reaches
+    `failure_rate`, the breaker opens and calls are refused straight away.
+    After `open_seconds` it lets `probes` trial calls through (half-open):
+    if they all succeed it closes again, one failure opens it again.
+    """
+
+    def __init__(self, name, failure_rate=0.5, min_calls=10, window=30.0, slow_call=None,
+                 open_seconds=30.0, probes=1, clock=time.monotonic):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.slow_call = slow_call
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self.clock = clock
+        self.opened = 0
+        self.rejected = 0
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._outcomes = deque()  # (time, failed), oldest first
+        self._failures = 0
+        self._probes_started = 0
+        self._probes_passed = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(self.clock())
+
+    def _current_state(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes_started = self._probes_passed = 0
+        return self._state
+
+    def allow(self):
+        """May a call go out now? (Counts a refusal; in half-open, starts a probe.)"""
+        with self._lock:
+            state = self._current_state(self.clock())
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and self._probes_started < self.probes:
+                self._probes_started += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, failed, duration=0.0):
+        """Outcome of a call that allow() let through."""
+        if self.slow_call is not None and duration > self.slow_call:
+            failed = True
+        now = self.clock()
+        with self._lock:
+            state = self._current_state(now)
+            if state == HALF_OPEN:
+                if failed:
+                    self._open(now)
+                else:
+                    self._probes_passed += 1
+                    if self._probes_passed >= self.probes:
+                        self._state = CLOSED
+                        self._outcomes.clear()
+                        self._failures = 0
+                return
+            if state == OPEN:
+                return
+            self._outcomes.append((now, failed))
+            self._failures += failed
+            while self._outcomes and now - self._outcomes[0][0] > self.window:
+                self._failures -= self._outcomes.popleft()[1]
+            calls = len(self._outcomes)
+            if calls >= self.min_calls and self._failures / calls >= self.failure_rate:
+                self._open(now)
+
+    def _open(self, now):
+        self._state = OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+        self._failures = 0
+        self.opened += 1
+
+    def call(self, func, *args, **kwargs):
+        """func(*args, **kwargs) through the breaker; CircuitOpenError if it is open."""
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} circuit is open")
+        started = self.clock()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record(True)
+            raise
+        self.record(False, self.clock() - started)
+        return result
+
+    async def call_async(self, func, *args, **kwargs):
+        """await func(*args, **kwargs) through the breaker.
+
+        A cancelled call isn't counted: a wait_for() deadline reaches here as
+        TimeoutError (a failure), a cancelled caller as CancelledError.
+        """
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} circuit is open")
+        started = self.clock()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception:
+            self.record(True)
+            raise
+        self.record(False, self.clock() - started)
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._state = CLOSED
+            self._outcomes.clear()
+            self._failures = 0
+
+    def stats(self):
+        with self._lock:
+            state = self._current_state(self.clock())
+            calls = len(self._outcomes)
+            return {
+                "state": state,
+                "window_calls": calls,
+                "window_failure_rate": round(self._failures / calls, 4) if calls else 0.0,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
+
+
+class GuardedBackend:
+    """A storage backend whose calls go through a CircuitBreaker.
+
+    Conflicts are answers, not failures (commit() returns None, create()
+    False), so only errors and slow calls count against the backend.
+    """
+
+    METHODS = ("get", "get_many", "create", "transact", "write_many", "commit", "top", "scan", "scan_page")
+
+    def __init__(self, backend, breaker):
+        self.backend = backend
+        self.breaker = breaker
+        self.name = backend.name
+
+    def warm_up(self):
+        self.backend.warm_up()
+
+    def __getattr__(self, name):
+        if name not in self.METHODS:
+            raise AttributeError(name)
+        method = getattr(self.backend, name)
+
+        @wraps(method)
+        def guarded(*args, **kwargs):
+            return self.breaker.call(method, *args, **kwargs)
+        return guarded
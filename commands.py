@@ -0,0 +1,99 @@
+from collections import deque
+
+
+class KeywordMatcher:
+    """Aho-Corasick automaton over the trigger keywords.
+
+    One pass over the text finds every keyword occurrence (overlaps
+    included), so matching cost depends on the message length, not on how
+    many keywords are registered. Keywords are given in priority order and
+    best() returns the index of the highest-priority keyword present.
+    """
+
+    def __init__(self, keywords):
+        self._goto = [{}]
+        self._fail = [0]
+        self._best = [None]  # best (lowest) keyword index recognised at each state
+
+        for index, keyword in enumerate(keywords):
+            state = 0
+            for char in keyword:
+                nxt = self._goto[state].get(char)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][char] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._best.append(None)
+                state = nxt
+            if self._best[state] is None or index < self._best[state]:
+                self._best[state] = index
+
+        # Breadth-first failure links; fold each state's fallback output into it
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                inherited = self._best[self._fail[nxt]]
+                if inherited is not None and (self._best[nxt] is None or inherited < self._best[nxt]):
+                    self._best[nxt] = inherited
+
+    def best(self, text):
+        goto, fail, outputs = self._goto, self._fail, self._best
+        state = 0
+        best = None
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            found = outputs[state]
+            if found is not None and (best is None or found < best):
+                if found == 0:
+                    return 0
+                best = found
+        return best
+
+
+class CommandRouter:
+    """Maps incoming text to a command handler.
+
+    Exact commands are a single dict lookup. If none matches, substring
+    triggers ("おはよう" anywhere in the text) are checked with one
+    Aho-Corasick pass; when several triggers appear, the one registered
+    first wins. Anything else goes to the fallback.
+    """
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback
+        self._exact = {}
+        self._keywords = []
+        self._keyword_handlers = []
+        self._matcher = KeywordMatcher([])
+
+    def add_exact(self, text, handler):
+        if text in self._exact:
+            raise ValueError(f"Command already registered: {text}")
+        self._exact[text] = handler
+
+    def add_keyword(self, keyword, handler):
+        if keyword in self._keywords:
+            raise ValueError(f"Keyword already registered: {keyword}")
+        self._keywords.append(keyword)
+        self._keyword_handlers.append(handler)
+        # Registration happens at startup, so rebuilding the automaton here is fine
+        self._matcher = KeywordMatcher(self._keywords)
+
+    def resolve(self, text):
+        handler = self._exact.get(text)
+        if handler is not None:
+            return handler
+        index = self._matcher.best(text)
+        if index is not None:
+            return self._keyword_handlers[index]
+        return self.fallback
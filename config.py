@@ -1,8 +1,26 @@
 import os
-from dotenv import load_dotenv
 
-# Load environment variables
-load_dotenv()
+
+def _find_dotenv():
+    """The nearest .env above the working directory or this file (like dotenv.find_dotenv)."""
+    for directory in (os.getcwd(), os.path.dirname(os.path.abspath(__file__))):
+        while True:
+            path = os.path.join(directory, ".env")
+            if os.path.isfile(path):
+                return path
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                break
+            directory = parent
+    return None
+
+
+# Load environment variables from .env (local development only; Cloud Run
+# has no .env, so python-dotenv isn't even imported there)
+_DOTENV_PATH = _find_dotenv()
+if _DOTENV_PATH:
+    from dotenv import load_dotenv
+    load_dotenv(_DOTENV_PATH)
 
 # LINE Bot Settings
 CHANNEL_ACCESS_TOKEN = os.environ.get("CHANNEL_ACCESS_TOKEN")
@@ -39,3 +57,185 @@ IMAGE_URLS = {
     "shop_sunglasses": "https://cdn-icons-png.flaticon.com/512/1169/1169992.png",
     "shop_dye": "https://cdn-icons-png.flaticon.com/512/2919/2919740.png"
 }
+
+# Shop Items
+# The single source for the shop: command routing, purchase logic and the
+# shop carousel are all generated from this table (in display order).
+SHOP_ITEMS = {
+    "substitute_doll": {
+        "title": "身代わり人形",
+        "purchase_name": "身代わり人形🧸",
+        "price": 5,
+        "image": IMAGE_URLS["shop_doll"],
+        "description": "早起き失敗しても安心！\n1回だけ記録を守ってくれるよ🧸",
+        "buy_command": "身代わり人形を買う",
+        "buy_hint": "",
+        "owned_message": "もう一つ持ってますよ！\n保険は1つあれば十分です🧸",
+        "look": None,
+    },
+    "sunglasses": {
+        "title": "イケてるサングラス",
+        "purchase_name": "サングラス🕶️",
+        "price": 10,
+        "image": IMAGE_URLS["shop_sunglasses"],
+        "description": None,
+        "buy_command": "サングラスを買う",
+        "buy_hint": "\n「サングラス装着」と送ると着替えるよ！",
+        "owned_message": None,
+        "look": {
+            "key": "sunglasses",
+            "command": "サングラス装着",
+            "image": IMAGE_URLS["sunglasses"],
+            "status": "サングラス装着中 😎",
+            "success": "シャキーン！😎\nサングラスをかけました！",
+            "fail": "まだサングラスを持ってないよ！",
+        },
+    },
+    "pink_dye": {
+        "title": "魔法のピンク染め粉",
+        "purchase_name": "魔法のピンク染め粉🎨",
+        "price": 20,
+        "image": IMAGE_URLS["shop_dye"],
+        "description": None,
+        "buy_command": "ピンク染め粉を買う",
+        "buy_hint": "\n「ピンクに変身」と送ると着替えるよ！",
+        "owned_message": None,
+        "look": {
+            "key": "pink",
+            "command": "ピンクに変身",
+            "image": IMAGE_URLS["pink"],
+            "status": "ピンクに変身中 🎀",
+            "success": "✨キラキラ〜✨\nピンク色に変身しました！🐰🎀",
+            "fail": "まだ染め粉を持ってないよ！",
+        },
+    },
+}
+
+# Webhook Event Processing
+EVENT_QUEUE_MAXSIZE = int(os.environ.get("EVENT_QUEUE_MAXSIZE", "1000"))
+EVENT_WORKERS = int(os.environ.get("EVENT_WORKERS", "8"))
+EVENT_DRAIN_TIMEOUT = float(os.environ.get("EVENT_DRAIN_TIMEOUT", "10"))
+
+# Gemini Request Limits
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", "16"))
+GEMINI_TIMEOUT = float(os.environ.get("GEMINI_TIMEOUT", "15"))
+GEMINI_MAX_RETRIES = int(os.environ.get("GEMINI_MAX_RETRIES", "2"))
+GEMINI_RETRY_BASE_DELAY = float(os.environ.get("GEMINI_RETRY_BASE_DELAY", "0.5"))
+
+# Gemini reply length: output token cap, and the budget at which a streamed
+# reply is cut off (whichever of characters / sentences is reached first)
+GEMINI_STREAMING = os.environ.get("GEMINI_STREAMING", "true").lower() == "true"
+GEMINI_MAX_OUTPUT_TOKENS = int(os.environ.get("GEMINI_MAX_OUTPUT_TOKENS", "256"))
+GEMINI_REPLY_MAX_CHARS = int(os.environ.get("GEMINI_REPLY_MAX_CHARS", "300"))
+GEMINI_REPLY_MAX_SENTENCES = int(os.environ.get("GEMINI_REPLY_MAX_SENTENCES", "5"))
+
+# Chat memory: per-user conversation history sent with each Gemini request
+# (off: every chat is stateless). Older exchanges are folded into a summary;
+# sessions leaving memory are stored under rabbit_gamers/{user_id}/chat_memory.
+CHAT_MEMORY_ENABLED = os.environ.get("CHAT_MEMORY_ENABLED", "false").lower() == "true"
+CHAT_MEMORY_MAX_SESSIONS = int(os.environ.get("CHAT_MEMORY_MAX_SESSIONS", "10000"))
+CHAT_MEMORY_MAX_EXCHANGES = int(os.environ.get("CHAT_MEMORY_MAX_EXCHANGES", "8"))
+CHAT_MEMORY_COMPACT_EXCHANGES = int(os.environ.get("CHAT_MEMORY_COMPACT_EXCHANGES", "4"))
+CHAT_MEMORY_MAX_TURN_CHARS = int(os.environ.get("CHAT_MEMORY_MAX_TURN_CHARS", "300"))
+CHAT_MEMORY_SUMMARY_MAX_CHARS = int(os.environ.get("CHAT_MEMORY_SUMMARY_MAX_CHARS", "400"))
+CHAT_MEMORY_IDLE_TTL = float(os.environ.get("CHAT_MEMORY_IDLE_TTL", "1800"))
+
+# Gemini Reply Cache
+REPLY_CACHE_ENABLED = os.environ.get("REPLY_CACHE_ENABLED", "true").lower() == "true"
+REPLY_CACHE_TTL = float(os.environ.get("REPLY_CACHE_TTL", "3600"))
+REPLY_CACHE_MAX_ENTRIES = int(os.environ.get("REPLY_CACHE_MAX_ENTRIES", "1024"))
+REPLY_CACHE_VARIANTS = int(os.environ.get("REPLY_CACHE_VARIANTS", "3"))
+REPLY_CACHE_MAX_INPUT_CHARS = int(os.environ.get("REPLY_CACHE_MAX_INPUT_CHARS", "20"))
+
+# User Profile Cache
+USER_CACHE_MAX_ENTRIES = int(os.environ.get("USER_CACHE_MAX_ENTRIES", "10000"))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "300"))
+
+# Webhook redelivery dedup (by webhookEventId). EVENT_DEDUP_SHARED also records
+# every event in Firestore so redeliveries to another instance are caught.
+# EVENT_DEDUP_TTL (seconds) applies to both the local and the shared seen-set.
+EVENT_DEDUP_ENABLED = os.environ.get("EVENT_DEDUP_ENABLED", "true").lower() == "true"
+EVENT_DEDUP_TTL = float(os.environ.get("EVENT_DEDUP_TTL", "3600"))
+EVENT_DEDUP_MAX_ENTRIES = int(os.environ.get("EVENT_DEDUP_MAX_ENTRIES", "100000"))
+EVENT_DEDUP_SHARED = os.environ.get("EVENT_DEDUP_SHARED", "false").lower() == "true"
+EVENT_DEDUP_COLLECTION = os.environ.get("EVENT_DEDUP_COLLECTION", "webhook_events")
+
+# Per-user rate limits (token buckets: tokens per second, burst size).
+# "chat" covers the Gemini fallback, "game" the Firestore-writing commands.
+# Rates must be > 0; set RATE_LIMIT_ENABLED=false to turn limiting off.
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_CHAT_RATE = float(os.environ.get("RATE_LIMIT_CHAT_RATE", "0.2"))
+RATE_LIMIT_CHAT_BURST = float(os.environ.get("RATE_LIMIT_CHAT_BURST", "5"))
+RATE_LIMIT_GAME_RATE = float(os.environ.get("RATE_LIMIT_GAME_RATE", "1"))
+RATE_LIMIT_GAME_BURST = float(os.environ.get("RATE_LIMIT_GAME_BURST", "10"))
+RATE_LIMIT_MAX_USERS = int(os.environ.get("RATE_LIMIT_MAX_USERS", "100000"))
+
+# Fair scheduling of queued events across users; a chat (Gemini) event
+# counts as FAIR_QUEUE_CHAT_COST ordinary events
+FAIR_QUEUE_ENABLED = os.environ.get("FAIR_QUEUE_ENABLED", "true").lower() == "true"
+FAIR_QUEUE_CHAT_COST = float(os.environ.get("FAIR_QUEUE_CHAT_COST", "4"))
+
+# Leaderboard ("ランキング"): score histograms sharded over LEADERBOARD_SHARDS
+# documents, summed into an in-memory ranking index every LEADERBOARD_TTL seconds.
+# Scores above LEADERBOARD_MAX_SCORE share the top rank.
+LEADERBOARD_ENABLED = os.environ.get("LEADERBOARD_ENABLED", "true").lower() == "true"
+LEADERBOARD_COLLECTION = os.environ.get("LEADERBOARD_COLLECTION", "leaderboard")
+LEADERBOARD_SHARDS = int(os.environ.get("LEADERBOARD_SHARDS", "20"))
+LEADERBOARD_MAX_SCORE = int(os.environ.get("LEADERBOARD_MAX_SCORE", "10000"))
+LEADERBOARD_TTL = float(os.environ.get("LEADERBOARD_TTL", "60"))
+LEADERBOARD_TOP_N = int(os.environ.get("LEADERBOARD_TOP_N", "5"))
+
+# Batch mode: process each webhook payload as one unit with grouped Firestore I/O
+WEBHOOK_BATCH_MODE = os.environ.get("WEBHOOK_BATCH_MODE", "false").lower() == "true"
+
+# LINE Messaging API base URL (overridable for local stand-ins / load tests)
+LINE_API_ENDPOINT = os.environ.get("LINE_API_ENDPOINT", "https://api.line.me")
+
+# LINE HTTP Client
+LINE_HTTP_POOL_SIZE = int(os.environ.get("LINE_HTTP_POOL_SIZE", "100"))
+LINE_HTTP_TIMEOUT = float(os.environ.get("LINE_HTTP_TIMEOUT", "10"))
+LINE_MAX_RETRIES = int(os.environ.get("LINE_MAX_RETRIES", "3"))
+# Reply tokens are only valid for a short while after the webhook event
+LINE_REPLY_TOKEN_TTL = float(os.environ.get("LINE_REPLY_TOKEN_TTL", "50"))
+
+# Moon phase table (years precomputed ahead) and new/full moon broadcasts
+MOON_TABLE_YEARS = int(os.environ.get("MOON_TABLE_YEARS", "30"))
+MOON_BROADCAST_ENABLED = os.environ.get("MOON_BROADCAST_ENABLED", "false").lower() == "true"
+
+# Build the Firestore / Gemini / LINE clients in the background right after
+# startup (default: on when running on Cloud Run, which sets K_SERVICE)
+STARTUP_WARMUP = os.environ.get("STARTUP_WARMUP", "true" if os.environ.get("K_SERVICE") else "false").lower() == "true"
+
+# Slow-request sampling profiler (off by default; results under /metrics/profiles)
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "false").lower() == "true"
+PROFILER_INTERVAL = float(os.environ.get("PROFILER_INTERVAL", "0.005"))
+PROFILER_SLOW_THRESHOLD = float(os.environ.get("PROFILER_SLOW_THRESHOLD", "1.0"))
+PROFILER_MAX_PROFILES = int(os.environ.get("PROFILER_MAX_PROFILES", "20"))
+
+# Storage backend for profiles, leaderboard shards, chat memory and shared
+# event dedup: "firestore" (production), "sqlite" (one file, single host) or
+# "memory" (tests / local runs; nothing survives a restart)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "firestore").lower()
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "moon_rabbit.db")
+
+# Greetings and purchases commit one version-guarded write starting from the
+# cached profile instead of running a transaction; after
+# CONDITIONAL_WRITE_ATTEMPTS conflicts the action falls back to a transaction
+CONDITIONAL_WRITES_ENABLED = os.environ.get("CONDITIONAL_WRITES_ENABLED", "true").lower() == "true"
+CONDITIONAL_WRITE_ATTEMPTS = int(os.environ.get("CONDITIONAL_WRITE_ATTEMPTS", "3"))
+
+# Circuit breakers around Gemini and storage. A breaker opens when at least
+# BREAKER_MIN_CALLS calls in the last BREAKER_WINDOW seconds failed at
+# BREAKER_FAILURE_RATE or more (storage calls slower than STORAGE_SLOW_CALL
+# count as failures), then lets one probe through every BREAKER_OPEN_SECONDS.
+# While open the bot runs degraded: canned chat replies, static content, and
+# greetings / look changes queued (up to DEGRADED_QUEUE_MAX) and replayed
+# every DEGRADED_REPLAY_INTERVAL seconds once storage answers again.
+CIRCUIT_BREAKER_ENABLED = os.environ.get("CIRCUIT_BREAKER_ENABLED", "true").lower() == "true"
+BREAKER_FAILURE_RATE = float(os.environ.get("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_MIN_CALLS = int(os.environ.get("BREAKER_MIN_CALLS", "10"))
+BREAKER_WINDOW = float(os.environ.get("BREAKER_WINDOW", "30"))
+BREAKER_OPEN_SECONDS = float(os.environ.get("BREAKER_OPEN_SECONDS", "30"))
+STORAGE_SLOW_CALL = float(os.environ.get("STORAGE_SLOW_CALL", "5"))
+DEGRADED_QUEUE_MAX = int(os.environ.get("DEGRADED_QUEUE_MAX", "10000"))
+DEGRADED_REPLAY_INTERVAL = float(os.environ.get("DEGRADED_REPLAY_INTERVAL", "10"))
@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class EventDeduplicator:
+    """Drops LINE webhook events that were already accepted.
+
+    LINE redelivers an event (same webhookEventId, deliveryContext.isRedelivery
+    = true) when it didn't get a timely 200. Event IDs are remembered in a
+    bounded LRU with a TTL on this instance; an optional shared store (see
+    SharedEventStore) catches redeliveries that land on another instance.
+    """
+
+    def __init__(self, max_entries=100000, ttl=3600.0, store=None, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = store
+        self.clock = clock
+        self.checked = 0
+        self.duplicates = 0
+        self.shared_duplicates = 0
+        self.shared_errors = 0
+        self.redeliveries = 0
+        self._seen = OrderedDict()  # event_id -> expires_at
+        self._lock = threading.Lock()
+
+    def is_duplicate(self, event_id, redelivery=False):
+        """Check and remember event_id on this instance (no I/O)."""
+        if not event_id:
+            return False
+        now = self.clock()
+        with self._lock:
+            self.checked += 1
+            if redelivery:
+                self.redeliveries += 1
+            expires_at = self._seen.get(event_id)
+            if expires_at is not None and expires_at > now:
+                self.duplicates += 1
+                return True
+            self._seen[event_id] = now + self.ttl
+            self._seen.move_to_end(event_id)
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+            # Entries are added in time order, so expired ones sit at the front
+            while self._seen:
+                oldest_id, oldest_expiry = next(iter(self._seen.items()))
+                if oldest_expiry > now:
+                    break
+                del self._seen[oldest_id]
+        return False
+
+    def forget(self, event_id):
+        """Un-see an event that was not accepted after all (so its redelivery runs)."""
+        with self._lock:
+            self._seen.pop(event_id, None)
+
+    def claim_shared(self, event_id):
+        """True if this instance may process the event (blocking; off the event loop).
+
+        Without a shared store every event is claimed.
+        """
+        if self.store is None or not event_id:
+            return True
+        try:
+            claimed = self.store.claim(event_id)
+        except Exception:
+            # Shared store unavailable: the local check already ran, so process it
+            logger.warning("Shared event dedup unavailable; processing %s", event_id, exc_info=True)
+            with self._lock:
+                self.shared_errors += 1
+            return True
+        if claimed:
+            return True
+        with self._lock:
+            self.shared_duplicates += 1
+        return False
+
+    def clear(self):
+        with self._lock:
+            self._seen.clear()
+
+    def stats(self):
+        return {
+            "entries": len(self._seen),
+            "checked": self.checked,
+            "redeliveries": self.redeliveries,
+            "duplicates_dropped": self.duplicates + self.shared_duplicates,
+            "local_duplicates": self.duplicates,
+            "shared_duplicates": self.shared_duplicates,
+            "shared_errors": self.shared_errors,
+            "shared_store": self.store is not None,
+        }
+
+
+class SharedEventStore:
+    """Shared seen-set: one small document per event ID in the storage backend.
+
+    create() fails if the document already exists, so exactly one instance
+    claims each event. Documents carry an expires_at timestamp; on Firestore,
+    configure a TTL policy on that field to have them cleaned up.
+    """
+
+    def __init__(self, storage_factory, collection="webhook_events", ttl=86400.0):
+        self.storage_factory = storage_factory
+        self.collection = collection
+        self.ttl = ttl
+
+    def claim(self, event_id):
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+        return self.storage_factory().create(self.collection, event_id, {"expires_at": expires_at})
@@ -0,0 +1,169 @@
+import asyncio
+import heapq
+import inspect
+import itertools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when the event queue cannot accept more work."""
+
+
+class FairQueue(asyncio.Queue):
+    """asyncio.Queue that serves flows (users) in weighted fair order.
+
+    Self-clocked fair queuing: an item's finish tag is
+    max(virtual time, its flow's last finish tag) + cost(item), and the
+    smallest tag is served first. A flow with many queued items only gets
+    its share, so one busy user can't hold up everyone queued behind it;
+    a costlier item uses up more of its flow's share. Within a flow,
+    items stay in order.
+    """
+
+    def __init__(self, maxsize=0, flow=None, cost=None):
+        self.flow = flow or (lambda item: None)
+        self.cost = cost or (lambda item: 1.0)
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self._queue = []  # heap of (finish_tag, seq, flow, item)
+        self._finish = {}  # flow -> finish tag of its newest queued item
+        self._vtime = 0.0
+        self._seq = itertools.count()
+
+    def _put(self, item):
+        flow = self.flow(item)
+        finish = max(self._vtime, self._finish.get(flow, 0.0)) + self.cost(item)
+        self._finish[flow] = finish
+        heapq.heappush(self._queue, (finish, next(self._seq), flow, item))
+
+    def _get(self):
+        finish, _, flow, item = heapq.heappop(self._queue)
+        self._vtime = finish
+        if self._finish.get(flow) == finish:
+            # nothing else queued for this flow
+            del self._finish[flow]
+        return item
+
+
+class EventProcessor:
+    """Bounded queue + worker pool that runs webhook events off the request path.
+
+    With `flow` (event -> user key) the queue is a FairQueue; `cost`
+    (event -> float) weights events within it.
+    """
+
+    def __init__(self, process_func, maxsize=1000, workers=8, drain_timeout=10.0, flow=None, cost=None):
+        self.process_func = process_func
+        self.maxsize = maxsize
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self.flow = flow
+        self.cost = cost
+
+        self._queue = None
+        self._tasks = []
+        self._in_flight = 0
+
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+
+    @property
+    def running(self):
+        return bool(self._tasks)
+
+    async def start(self):
+        """Create the queue and spawn the worker tasks (call from the running loop)."""
+        if self.running:
+            return
+        if self.flow is None:
+            self._queue = asyncio.Queue(maxsize=self.maxsize)
+        else:
+            # queued items are (queued_at, event)
+            self._queue = FairQueue(
+                maxsize=self.maxsize,
+                flow=lambda item: self.flow(item[1]),
+                cost=(lambda item: self.cost(item[1])) if self.cost else None,
+            )
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"event-worker-{i}")
+            for i in range(self.workers)
+        ]
+
+    async def stop(self):
+        """Drain queued events (up to drain_timeout) and shut the workers down."""
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=self.drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Event queue drain timed out: %d events dropped", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, event):
+        """Enqueue one event without blocking. Raises QueueFullError on backpressure."""
+        if not self.running:
+            raise QueueFullError("event processor is not running")
+        try:
+            self._queue.put_nowait((time.monotonic(), event))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise QueueFullError(f"event queue is full ({self.maxsize})")
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    def submit_many(self, events):
+        """Enqueue a whole webhook payload, or none of it if it doesn't fit."""
+        if self.running and self._queue.qsize() + len(events) > self.maxsize:
+            self.rejected += len(events)
+            raise QueueFullError(f"event queue is full ({self.maxsize})")
+        for event in events:
+            self.submit(event)
+
+    async def _worker(self):
+        while True:
+            queued_at, event = await self._queue.get()
+            self.total_wait += time.monotonic() - queued_at
+            self._in_flight += 1
+            try:
+                await self._run(event)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Event processing error")
+            finally:
+                self._in_flight -= 1
+                self._queue.task_done()
+
+    async def _run(self, event):
+        if inspect.iscoroutinefunction(self.process_func):
+            await self.process_func(event)
+        else:
+            # Blocking handlers (Firestore / Gemini / LINE SDK) run in a thread
+            await asyncio.to_thread(self.process_func, event)
+
+    def stats(self):
+        """Snapshot of queue / backpressure metrics."""
+        done = self.processed + self.failed
+        return {
+            "queue_size": self._queue.qsize() if self._queue else 0,
+            "queue_maxsize": self.maxsize,
+            "max_depth": self.max_depth,
+            "workers": self.workers,
+            "in_flight": self._in_flight,
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait / done * 1000, 3) if done else 0.0,
+        }
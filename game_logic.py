@@ -1,10 +1,76 @@
-import firebase_admin
-from firebase_admin import credentials, firestore
+import asyncio
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import unicodedata
+from collections import deque
 from datetime import datetime
 from zoneinfo import ZoneInfo
-import google.generativeai as genai
-from config import GEMINI_API_KEY, RABBIT_SYSTEM_INSTRUCTION
-from firebase_admin import firestore
+from config import (
+    GEMINI_API_KEY,
+    RABBIT_SYSTEM_INSTRUCTION,
+    GEMINI_MAX_CONCURRENCY,
+    GEMINI_TIMEOUT,
+    GEMINI_MAX_RETRIES,
+    GEMINI_RETRY_BASE_DELAY,
+    GEMINI_STREAMING,
+    GEMINI_MAX_OUTPUT_TOKENS,
+    GEMINI_REPLY_MAX_CHARS,
+    GEMINI_REPLY_MAX_SENTENCES,
+    CHAT_MEMORY_ENABLED,
+    CHAT_MEMORY_MAX_SESSIONS,
+    CHAT_MEMORY_MAX_EXCHANGES,
+    CHAT_MEMORY_COMPACT_EXCHANGES,
+    CHAT_MEMORY_MAX_TURN_CHARS,
+    CHAT_MEMORY_SUMMARY_MAX_CHARS,
+    CHAT_MEMORY_IDLE_TTL,
+    REPLY_CACHE_ENABLED,
+    REPLY_CACHE_TTL,
+    REPLY_CACHE_MAX_ENTRIES,
+    REPLY_CACHE_VARIANTS,
+    REPLY_CACHE_MAX_INPUT_CHARS,
+    USER_CACHE_MAX_ENTRIES,
+    USER_CACHE_TTL,
+    SHOP_ITEMS,
+    MOON_TABLE_YEARS,
+    LEADERBOARD_ENABLED,
+    LEADERBOARD_COLLECTION,
+    LEADERBOARD_SHARDS,
+    LEADERBOARD_MAX_SCORE,
+    LEADERBOARD_TTL,
+    LEADERBOARD_TOP_N,
+    STORAGE_BACKEND,
+    SQLITE_PATH,
+    CONDITIONAL_WRITES_ENABLED,
+    CONDITIONAL_WRITE_ATTEMPTS,
+    CIRCUIT_BREAKER_ENABLED,
+    BREAKER_FAILURE_RATE,
+    BREAKER_MIN_CALLS,
+    BREAKER_WINDOW,
+    BREAKER_OPEN_SECONDS,
+    STORAGE_SLOW_CALL,
+    DEGRADED_QUEUE_MAX,
+)
+from reply_cache import ReplyCache, InMemoryReplyCache
+from user_cache import UserProfileCache, FirestoreReadCounter
+from user_state import UserState, ITEM_BITS, day_number
+from storage import Write, create_backend
+from circuit_breaker import OPEN, CircuitBreaker, CircuitOpenError, GuardedBackend
+from chat_memory import ChatMemory, ChatStore
+from leaderboard import BOARDS, LeaderboardStore, score_changes
+from metrics import stage_metrics
+import moon_phase
+
+# firebase_admin / google.generativeai take most of the cold start, so they
+# are imported on first use (or by warm_up() right after startup) instead of here.
+
+logger = logging.getLogger(__name__)
+
+if set(SHOP_ITEMS) - set(ITEM_BITS):
+    raise ValueError(f"Shop items without a bit in user_state.ITEM_BITS: {sorted(set(SHOP_ITEMS) - set(ITEM_BITS))}")
 
 # --- Core Logic & Database ---
 # Gemini Model (Lazy loaded)
@@ -15,14 +81,21 @@ def get_now_jst():
 
 
 
+# Clients are created once per process and shared by all threads of a
+# worker; the lock keeps concurrent first requests from building two.
+_client_lock = threading.Lock()
+
 def get_model():
     global model
     if model is None:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel(
-            "gemini-2.5-flash",
-            system_instruction=RABBIT_SYSTEM_INSTRUCTION,
-        )
+        with _client_lock:
+            if model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=GEMINI_API_KEY)
+                model = genai.GenerativeModel(
+                    "gemini-2.5-flash",
+                    system_instruction=RABBIT_SYSTEM_INSTRUCTION,
+                )
     return model
 
 # Initialize Firestore safely
@@ -31,117 +104,169 @@ db = None
 def init_db():
     global db
     if db is None:
-        if not firebase_admin._apps:
-            cred = credentials.ApplicationDefault()
-            firebase_admin.initialize_app(cred)
-        db = firestore.client()
+        with _client_lock:
+            if db is None:
+                import firebase_admin
+                from firebase_admin import credentials, firestore
+                if not firebase_admin._apps:
+                    cred = credentials.ApplicationDefault()
+                    firebase_admin.initialize_app(cred)
+                db = firestore.client()
     return db
 
-# We will call init_db() inside functions, or at the bottom if not testing.
-# For backward compatibility with the functions I wrote, I'll update get_or_create_user to call init_db()
+def reset_clients():
+    """Drop clients inherited from a parent process.
+
+    gRPC channels must not be shared across fork(), so a forked worker
+    (gunicorn --preload) rebuilds its own Firestore and Gemini clients on
+    first use.
+    """
+    global model, db, _client_lock
+    _client_lock = threading.Lock()
+    model = None
+    db = None
+    firebase_admin = sys.modules.get("firebase_admin")
+    if firebase_admin is not None and firebase_admin._apps:
+        try:
+            firebase_admin.delete_app(firebase_admin.get_app())
+        except ValueError:
+            pass
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_clients)
+
+# Storage backend (STORAGE_BACKEND); Firestore clients come from init_db().
+# Backends hold no per-process connections of their own across fork().
+storage = None
+USERS = "rabbit_gamers"
+
+# Circuit breakers (CIRCUIT_BREAKER_ENABLED); see the degraded mode below
+gemini_breaker = CircuitBreaker(
+    "gemini",
+    failure_rate=BREAKER_FAILURE_RATE,
+    min_calls=BREAKER_MIN_CALLS,
+    window=BREAKER_WINDOW,
+    open_seconds=BREAKER_OPEN_SECONDS,
+)
+storage_breaker = CircuitBreaker(
+    "storage",
+    failure_rate=BREAKER_FAILURE_RATE,
+    min_calls=BREAKER_MIN_CALLS,
+    window=BREAKER_WINDOW,
+    slow_call=STORAGE_SLOW_CALL,
+    open_seconds=BREAKER_OPEN_SECONDS,
+)
+_guarded_storage = None
+
+def get_storage():
+    """The storage backend, behind storage_breaker when circuit breakers are on."""
+    global storage, _guarded_storage
+    if storage is None:
+        with _client_lock:
+            if storage is None:
+                storage = create_backend(STORAGE_BACKEND, firestore_client=lambda: init_db(), sqlite_path=SQLITE_PATH)
+    if not CIRCUIT_BREAKER_ENABLED:
+        return storage
+    guarded = _guarded_storage
+    if guarded is None or guarded.backend is not storage or guarded.breaker is not storage_breaker:
+        guarded = _guarded_storage = GuardedBackend(storage, storage_breaker)
+    return guarded
+
+def warm_up():
+    """Import the SDKs and build the clients before the first request needs them."""
+    for name, factory in (("Storage", lambda: get_storage().warm_up()), ("Gemini", get_model)):
+        try:
+            factory()
+        except Exception:
+            logger.exception("%s warm-up failed", name)
+    moon_phase.get_table(MOON_TABLE_YEARS)
+
+# Write-through cache of rabbit_gamers profiles + Firestore read accounting
+profile_cache = UserProfileCache(max_entries=USER_CACHE_MAX_ENTRIES, ttl=USER_CACHE_TTL)
+read_counter = FirestoreReadCounter()
+
+leaderboard = LeaderboardStore(
+    get_storage,
+    collection=LEADERBOARD_COLLECTION,
+    shards=LEADERBOARD_SHARDS,
+    max_score=LEADERBOARD_MAX_SCORE,
+    ttl=LEADERBOARD_TTL,
+    top_n=LEADERBOARD_TOP_N,
+)
+
+def read_user(user_id):
+    """Profile Document, counted in the read metrics."""
+    read_counter.record_read()
+    with stage_metrics.timer("storage.get"):
+        return get_storage().get(USERS, user_id)
 
 
 def get_moon_info():
     """Calculate the current moon phase emoji."""
-    base_date = datetime(2023, 1, 22, tzinfo=ZoneInfo("Asia/Tokyo"))
-
-# 2. 現在時刻を取得する場合
-    current_date = datetime.now(ZoneInfo("Asia/Tokyo"))
-
-    diff = current_date - base_date
-    days = diff.days + (diff.seconds / 86400)
-    moon_age = days % 29.53059
-
-    if moon_age < 1 or moon_age > 28.5:
-        return "🌑 (新月)"
-    elif moon_age < 6:
-        return "🌒 (三日月)"
-    elif moon_age < 9:
-        return "🌓 (上弦の月)"
-    elif moon_age < 14:
-        return "🌔 (十三夜)"
-    elif moon_age < 16:
-        return "🌕 (満月)"
-    elif moon_age < 20:
-        return "🌖 (寝待月)"
-    elif moon_age < 24:
-        return "🌗 (下弦の月)"
-    else:
-        return "🌘 (有明月)"
+    return moon_phase.get_table(MOON_TABLE_YEARS).describe(get_now_jst())
 
-def get_or_create_user(user_id):
-    """Retrieve user data from Firestore or create a new profile if not exists."""
-    db = init_db() # Ensure DB is valid
-    doc_ref = db.collection("rabbit_gamers").document(user_id)
-    doc = doc_ref.get()
+def new_user_data(user_id):
+    return UserState.new(user_id, now=get_now_jst())
 
-    if doc.exists:
-        return doc.to_dict(), doc_ref
-    else:
-        initial_data = {
-            "user_id": user_id,
-            "carrot_count": 0,
-            "moon_level": 1,
-            "current_streak": 0,
-            "last_login": None,
-            "items": [],
-            "current_look": "normal",
-            "created_at": get_now_jst(),
-        }
-        doc_ref.set(initial_data)
-        return initial_data, doc_ref
+def get_or_create_user(user_id, use_cache=True):
+    """Retrieve user data from storage or create a new profile if not exists.
 
-def process_morning_greeting(user_id):
-    """Refactored logic for 'Good Morning' streak processing."""
-    db = init_db()
-    doc_ref = db.collection("rabbit_gamers").document(user_id)
-    transaction = db.transaction()
+    Returns a UserState. Served from the profile cache when possible;
+    pass use_cache=False when a fresh read is required.
+    """
+    if use_cache:
+        cached = profile_cache.get(user_id)
+        if cached is not None:
+            return cached
 
-    today_date = get_now_jst().date()
-    today_str = today_date.strftime("%Y-%m-%d")
+    doc = read_user(user_id)
 
-    return _morning_greeting_transaction(transaction, doc_ref, today_str, today_date)
+    if doc.exists:
+        # Older documents are migrated in memory here and rewritten on their next update
+        user_data = _doc_state(doc)
+    else:
+        user_data = new_user_data(user_id)
+        with stage_metrics.timer("storage.write"):
+            versions = get_storage().commit([Write("create", USERS, user_id, user_data.to_dict())])
+        if versions is None:
+            # Another request created it in the meantime
+            return get_or_create_user(user_id, use_cache=False)
+        user_data.mark_saved(versions[(USERS, user_id)])
+    profile_cache.put(user_id, user_data)
+    return user_data
+
+# --- Game rules ---
+# The apply_* functions are pure: they take the current profile (None for a
+# user without a document), change it and return (message, user_data).
+# What to write is derived from the profile itself (see _user_write), so the
+# transactional and batch paths below share them.
+
+def apply_morning_greeting(user_id, user_data, today):
+    """'Good Morning' for the JST day number `today`."""
+    if user_data is None:
+        # 初回ログイン時の処理
+        user_data = new_user_data(user_id)
+        user_data.carrot_count = 1
+        user_data.current_streak = 1
+        user_data.last_login_day = today
+        return "今日から早起きチャレンジスタート！\n最初のご褒美の人参です！🥕", user_data
 
-@firestore.transactional
-def _morning_greeting_transaction(transaction, doc_ref, today_str, today_date):
-    snapshot = doc_ref.get(transaction=transaction)
+    if user_data.last_login_day == today:
+        return "今日はもう人参あげましたよ！また明日ね🥕", user_data
 
-    if not snapshot.exists:
-        # 初回ログイン時の処理
-        initial_data = {
-            "user_id": doc_ref.id,
-            "carrot_count": 1,
-            "moon_level": 1,
-            "current_streak": 1,
-            "last_login": today_str,
-            "items": [],
-            "current_look": "normal",
-            "current_at" : get_now_jst(),
-        }
-        transaction.set(doc_ref, initial_data)
-        return "今日から早起きチャレンジスタート！\n最初のご褒美の人参です！🥕"
-
-    user_data = snapshot.to_dict()
-    last_login_str = user_data.get("last_login")
-
-    if last_login_str == today_str:
-        return "今日はもう人参あげましたよ！また明日ね🥕"
-
-    current_streak = user_data.get("current_streak", 0)
-    my_items = user_data.get("items", [])
+    current_streak = user_data.current_streak
     new_streak = 1
     streak_message = ""
 
-    if last_login_str:
-        last_login_date = datetime.strptime(last_login_str, "%Y-%m-%d").date()
-        delta = (today_date - last_login_date).days
+    if user_data.last_login_day is not None:
+        delta = today - user_data.last_login_day
 
         if delta == 1:
             new_streak = current_streak + 1
             streak_message = f"\n🔥 {new_streak}日連続早起き中！すごい！"
         elif delta > 1:
-            if "substitute_doll" in my_items:
-                my_items.remove("substitute_doll")
+            if user_data.has_item("substitute_doll"):
+                user_data.remove_item("substitute_doll")
                 new_streak = current_streak + 1
                 streak_message = f"\n🧸 身代わり人形が身代わりになりました！\n連続記録({new_streak}日)は守られた！"
             else:
@@ -150,77 +275,635 @@ def _morning_greeting_transaction(transaction, doc_ref, today_str, today_date):
     else:
         streak_message = "\n今日から早起きチャレンジスタート！"
 
-    new_carrot_count = user_data.get("carrot_count", 0) + 1
-    transaction.update(doc_ref, {
-        "carrot_count": new_carrot_count,
-        "last_login": today_str,
-        "current_streak": new_streak,
-        "items": my_items
-    })
-
-    return f"おはようございます！☀️\n早起きのご褒美の人参です！🥕{streak_message}"
+    user_data.carrot_count += 1
+    user_data.last_login_day = today
+    user_data.current_streak = new_streak
 
+    return f"おはようございます！☀️\n早起きのご褒美の人参です！🥕{streak_message}", user_data
 
-@firestore.transactional
-def _purchase_transaction_inner(transaction, doc_ref, item_key, price, item_name):
-    # ①トランザクション（安全な箱）の中で最新のデータを取得
-    snapshot = doc_ref.get(transaction=transaction)
+def apply_purchase(user_id, user_data, item_key):
+    """Buy an item from SHOP_ITEMS."""
+    item = SHOP_ITEMS[item_key]
+    if user_data is None:
+        # 初めてのユーザーはここでプロフィールを作る（事前の存在確認は不要）
+        user_data = new_user_data(user_id)
 
-    if not snapshot.exists:
-        return "ユーザーデータが見つかりません。"
+    if user_data.has_item(item_key):
+        # Single-item policy applies to every item
+        if item["owned_message"]:
+             return item["owned_message"], user_data
+        return f"もう持ってますよ！\nアイテムを使うにはコマンドを送ってね。", user_data
 
-    user_data = snapshot.to_dict()
-    my_items = user_data.get("items", [])
-    carrot_count = user_data.get("carrot_count", 0)
-
-    if item_key in my_items:
-        # Check if single-item policy applies (it does for all current items)
-        if item_key == "substitute_doll":
-             return "もう一つ持ってますよ！\n保険は1つあれば十分です🧸"
-        return f"もう持ってますよ！\nアイテムを使うにはコマンドを送ってね。"
-
-    if carrot_count < price:
-        return "人参が足りませんっ！🐰💦"
+    price = item["price"]
+    if user_data.carrot_count < price:
+        return "人参が足りませんっ！🐰💦", user_data
 
     # ②購入できたらデータを上書き
-    new_carrot_count = carrot_count - price
-    my_items.append(item_key)
-    transaction.update(doc_ref, {
-        "carrot_count": new_carrot_count,
-        "items": my_items
-    })
+    user_data.carrot_count -= price
+    user_data.add_item(item_key)
+
+    return f"まいどあり！{item['purchase_name']}をお買い上げ！\n(残り人参: {user_data.carrot_count}本)", user_data
+
+def apply_change_look(user_id, user_data, look_key, item_req, message_success, message_fail):
+    """Change appearance (requires item_req, if given)."""
+    if user_data is None:
+        user_data = new_user_data(user_id)
+
+    if item_req and not user_data.has_item(item_req):
+        return message_fail, user_data
+
+    user_data.current_look = look_key
+    return message_success, user_data
+
+def _user_write(user_data, version=None, new_op="set"):
+    """Write for one profile, or None if nothing changed.
+
+    New profiles are written in full; existing ones only get the fields
+    that changed (plus the schema migration, if still pending), guarded by
+    `version` when given.
+    """
+    if user_data.is_new:
+        return Write(new_op, USERS, user_data.user_id, user_data.to_dict())
+    updates = user_data.changes()
+    if updates:
+        return Write("update", USERS, user_data.user_id, updates, version=version)
+    return None
+
+def _score_writes(states):
+    """Leaderboard histogram update for profiles being written."""
+    if not LEADERBOARD_ENABLED:
+        return []
+    write = leaderboard.write([score_changes(user_data) for user_data in states])
+    return [write] if write else []
+
+def _committed(states, versions=None):
+    """After a commit: profiles now match storage; refresh the caches.
+
+    versions: the commit's {(collection, key): version}, if known.
+    """
+    changes = [score_changes(user_data) for user_data in states] if LEADERBOARD_ENABLED else []
+    for user_data in states:
+        user_data.mark_saved((versions or {}).get((USERS, user_data.user_id)))
+        profile_cache.put(user_data.user_id, user_data)
+    if changes:
+        leaderboard.applied(changes)
+
+def _doc_state(doc):
+    if not doc.exists:
+        return None
+    user_data = UserState.from_dict(doc.data, doc.key)
+    user_data.version = doc.version
+    return user_data
+
+def today_number():
+    """Today's JST date as a day number (the login calendar is Japan time)."""
+    return day_number(get_now_jst().date())
+
+# Single-profile write paths: conditional writes (default) and transactions
+write_stats = {"conditional_writes": 0, "conflicts": 0, "confirm_reads": 0, "transaction_fallbacks": 0,
+               "transactions": 0, "transaction_attempts": 0}
+
+def _run_transaction(user_id, apply, *args):
+    """Read-modify-write one profile in a transaction: apply(user_id, user_data, *args)."""
+    def attempt(doc):
+        read_counter.record_read()
+        write_stats["transaction_attempts"] += 1
+        message, user_data = apply(user_id, _doc_state(doc), *args)
+        writes = [write for write in (_user_write(user_data),) if write] + _score_writes([user_data])
+        return (message, user_data), writes
+
+    with stage_metrics.timer("storage.transaction"):
+        message, user_data = get_storage().transact(USERS, user_id, attempt)
+    write_stats["transactions"] += 1
+    # Write-through only after the transaction has committed
+    _committed([user_data])
+    return message
+
+def _run_conditional(user_id, apply, *args):
+    """Read-modify-write one profile without a transaction.
+
+    Starts from the cached profile when it knows its stored version (else
+    one read) and commits just the changed fields, guarded by that version:
+    a single round trip with no transaction to begin, lock or retry. A
+    conflict means someone else wrote first; re-read and apply again.
+    Outcomes worked out from the cache that write nothing ("not enough
+    carrots") are confirmed with a fresh read.
+    """
+    user_data = profile_cache.get(user_id)
+    from_cache = user_data is not None and user_data.version is not None
+    for _ in range(CONDITIONAL_WRITE_ATTEMPTS):
+        if not from_cache:
+            user_data = _doc_state(read_user(user_id))
+        version = user_data.version if user_data is not None else None
+        message, user_data = apply(user_id, user_data, *args)
+        write = _user_write(user_data, version=version, new_op="create")
+        if write is None:
+            if from_cache:
+                write_stats["confirm_reads"] += 1
+                from_cache = False
+                continue
+            return message
+        with stage_metrics.timer("storage.write"):
+            versions = get_storage().commit([write] + _score_writes([user_data]))
+        if versions is not None:
+            write_stats["conditional_writes"] += 1
+            _committed([user_data], versions)
+            return message
+        write_stats["conflicts"] += 1
+        from_cache = False
+    # Heavily contended: let the transaction queue up behind the other writers
+    write_stats["transaction_fallbacks"] += 1
+    return _run_transaction(user_id, apply, *args)
+
+def _run_write(user_id, apply, *args):
+    if CONDITIONAL_WRITES_ENABLED:
+        return _run_conditional(user_id, apply, *args)
+    return _run_transaction(user_id, apply, *args)
 
-    return f"まいどあり！{item_name}をお買い上げ！\n(残り人参: {new_carrot_count}本)"
+def process_morning_greeting(user_id):
+    """Refactored logic for 'Good Morning' streak processing."""
+    return _run_write(user_id, apply_morning_greeting, today_number())
 
-def process_purchase(user_id: str, item_key: str, price: int, item_name: str) -> str:
+def process_purchase(user_id: str, item_key: str) -> str:
     """購入処理のエントリポイント"""
-    db = init_db()
-
-    # 買う前にユーザーデータが存在するか確認・作成しておく
-    get_or_create_user(user_id)
-    doc_ref = db.collection("rabbit_gamers").document(user_id)
-    transaction = db.transaction()
-
-    # 内側の関数を呼び出す
-    return _purchase_transaction_inner(transaction, doc_ref, item_key, price, item_name)
+    # 存在しないユーザーはここで作成（事前の存在確認は不要）
+    return _run_write(user_id, apply_purchase, item_key)
 
 def process_change_look(user_id: str, look_key: str, item_req: str, message_success: str, message_fail: str) -> str:
-    """Generic logic for changing appearance."""
-    user_data, doc_ref = get_or_create_user(user_id)
-    my_items = user_data.get("items", [])
-
-    if item_req and item_req not in my_items:
-        return message_fail
-
-    doc_ref.update({"current_look": look_key})
+    """Generic logic for changing appearance.
+
+    current_look is written on its own with no precondition: look items are
+    never taken away, so an item seen once is enough, and the last look
+    change wins. Without an item requirement nothing is read at all.
+    """
+    if item_req:
+        user_data = get_or_create_user(user_id)
+        if not user_data.has_item(item_req):
+            # The cached profile may predate a purchase made elsewhere; confirm with a fresh read
+            user_data = get_or_create_user(user_id, use_cache=False)
+            if not user_data.has_item(item_req):
+                return message_fail
+
+    with stage_metrics.timer("storage.write"):
+        written = get_storage().write_many([Write("update", USERS, user_id, {"current_look": look_key})])
+    if not written:
+        # No profile yet: create it, then change the look
+        get_or_create_user(user_id, use_cache=False)
+        return process_change_look(user_id, look_key, None, message_success, message_fail)
+    profile_cache.update(user_id, {"current_look": look_key})
     return message_success
 
+# --- Degraded mode (storage circuit open) ---
+# Greetings and look changes are answered right away and queued; purchases
+# need the real carrot count, so they are refused. Queued actions are
+# replayed in order by replay_deferred() once storage answers again.
+DEGRADED_GREETING_MESSAGE = "おはようございます！☀️\n月との通信が混み合ってるから、人参はあとで届けておくぴょん🥕"
+DEGRADED_SHOP_MESSAGE = "いまお店の帳簿が月に届かないぴょん…🐰💦\n少し時間をおいてからもう一度お願いね🛒"
+DEGRADED_MESSAGE = "月との通信が混み合ってるぴょん...🌕💦\n少し時間をおいてからもう一度お願いね！"
+
+deferred_writes = deque()  # (user_id, action, kwargs), oldest first
+degraded_stats = {"degraded_replies": 0, "deferred": 0, "dropped": 0, "replayed": 0, "replay_failures": 0}
+
+def defer_action(user_id, action, kwargs):
+    if len(deferred_writes) >= DEGRADED_QUEUE_MAX:
+        deferred_writes.popleft()
+        degraded_stats["dropped"] += 1
+    deferred_writes.append((user_id, action, kwargs))
+    degraded_stats["deferred"] += 1
+
+def run_action_degraded(user_id, action, kwargs):
+    """Reply to a game action without storage (no I/O)."""
+    degraded_stats["degraded_replies"] += 1
+    if action == "morning_greeting":
+        # Remember the day it was sent: the reward is for that day
+        defer_action(user_id, "morning_greeting", {"day": today_number()})
+        return DEGRADED_GREETING_MESSAGE
+    if action == "change_look":
+        item_req = kwargs["item_req"]
+        cached = profile_cache.get(user_id) if item_req else None
+        if item_req and (cached is None or not cached.has_item(item_req)):
+            return DEGRADED_MESSAGE
+        defer_action(user_id, "change_look", kwargs)
+        return kwargs["message_success"]
+    return DEGRADED_SHOP_MESSAGE
+
+def apply_deferred_greeting(user_id, user_data, day):
+    """A greeting queued during an outage, applied for the day it was sent.
+
+    Skipped if the profile already has a login on or after that day.
+    """
+    if user_data is not None and user_data.last_login_day is not None and user_data.last_login_day >= day:
+        return "", user_data
+    return apply_morning_greeting(user_id, user_data, day)
+
+def _replay(user_id, action, kwargs):
+    if action == "morning_greeting":
+        _run_write(user_id, apply_deferred_greeting, kwargs["day"])
+    else:
+        process_change_look(user_id, **kwargs)
+
+REPLAY_ATTEMPTS = 3
+_replay_failures = 0  # failed replays of the action at the head of the queue
+
+def replay_deferred():
+    """Run queued actions in order until the queue is empty or storage fails again.
+
+    Runs on one background task only. An action that keeps failing is
+    dropped after REPLAY_ATTEMPTS rounds so it can't hold up the queue.
+    """
+    global _replay_failures
+    while deferred_writes:
+        if CIRCUIT_BREAKER_ENABLED and storage_breaker.state == OPEN:
+            return
+        user_id, action, kwargs = deferred_writes[0]
+        try:
+            _replay(user_id, action, kwargs)
+        except CircuitOpenError:
+            return
+        except Exception:
+            logger.exception("Replay of a deferred %s failed", action)
+            degraded_stats["replay_failures"] += 1
+            _replay_failures += 1
+            if _replay_failures < REPLAY_ATTEMPTS:
+                return
+            degraded_stats["dropped"] += 1
+        else:
+            degraded_stats["replayed"] += 1
+        deferred_writes.popleft()
+        _replay_failures = 0
+
+def get_leaderboard(user_id):
+    """{board: (top entries, my rank, ranked players, my score)} for the ランキング view."""
+    user_data = get_or_create_user(user_id)
+    boards = {}
+    for board, field in BOARDS.items():
+        score = getattr(user_data, field)
+        rank, total = leaderboard.rank(board, score)
+        boards[board] = (leaderboard.top(board), rank, total, score)
+    return boards
+
+ACTIONS = {
+    "morning_greeting": process_morning_greeting,
+    "purchase": process_purchase,
+    "change_look": process_change_look,
+}
+
+def run_action(user_id, action, kwargs):
+    """Run one game action through its transactional path."""
+    return ACTIONS[action](user_id, **kwargs)
+
+def run_game_action(user_id, action, kwargs):
+    """run_action, or its degraded reply while the storage circuit is open."""
+    try:
+        return run_action(user_id, action, kwargs)
+    except CircuitOpenError:
+        return run_action_degraded(user_id, action, kwargs)
+
+# --- Batch processing (one webhook payload at a time) ---
+# Users whose profiles are part of an in-flight batch on this instance
+_batch_users = set()
+_batch_lock = threading.Lock()
+batch_stats = {"batches": 0, "batched_actions": 0, "batch_commits": 0, "transaction_fallbacks": 0}
+
+def process_batch(actions):
+    """Run game actions from one webhook payload with grouped storage I/O.
+
+    actions: list of (user_id, action, kwargs). All profiles are fetched in a
+    single get_many, the rules are applied in memory in payload order and the
+    resulting writes are committed in one write_many guarded by version
+    preconditions. Users already being batched by another worker, or a batch
+    that fails its preconditions, fall back to per-action transactions.
+    Returns the reply messages in the order of `actions`.
+    """
+    if not actions:
+        return []
+    batch_stats["batches"] += 1
+    with _batch_lock:
+        conflicting = {user_id for user_id, _, _ in actions if user_id in _batch_users}
+        owned = {user_id for user_id, _, _ in actions} - conflicting
+        _batch_users.update(owned)
+
+    messages = [None] * len(actions)
+    try:
+        batched = [(i, a) for i, a in enumerate(actions) if a[0] in owned]
+        if batched and not _run_batched(batched, messages):
+            # Someone else wrote one of the profiles after we read it
+            conflicting |= owned
+    except CircuitOpenError:
+        # nothing was written
+        for i, (user_id, action, kwargs) in batched:
+            messages[i] = run_action_degraded(user_id, action, kwargs)
+    finally:
+        with _batch_lock:
+            _batch_users.difference_update(owned)
+
+    for i, (user_id, action, kwargs) in enumerate(actions):
+        if user_id in conflicting:
+            batch_stats["transaction_fallbacks"] += 1
+            messages[i] = run_game_action(user_id, action, kwargs)
+    return messages
+
+def _run_batched(batched, messages):
+    """Apply and commit `batched` actions in one atomic write. False on conflict."""
+    store = get_storage()
+    user_ids = list(dict.fromkeys(user_id for _, (user_id, _, _) in batched))
+    read_counter.record_read(len(user_ids))
+    with stage_metrics.timer("storage.get_many"):
+        docs = store.get_many(USERS, user_ids)
+
+    today = today_number()
+    state = {user_id: _doc_state(docs[user_id]) for user_id in user_ids}
+
+    results = {}
+    for i, (user_id, action, kwargs) in batched:
+        if action == "morning_greeting":
+            message, state[user_id] = apply_morning_greeting(user_id, state[user_id], today)
+        elif action == "purchase":
+            message, state[user_id] = apply_purchase(user_id, state[user_id], **kwargs)
+        else:
+            message, state[user_id] = apply_change_look(user_id, state[user_id], **kwargs)
+        results[i] = message
+
+    written = [state[user_id] for user_id in user_ids if state[user_id] is not None]
+    # create fails if the document appeared in the meantime; updates are
+    # guarded by the version that was read
+    writes = [write for write in (_user_write(user_data, version=docs[user_data.user_id].version, new_op="create")
+                                  for user_data in written) if write]
+    # profiles left unchanged are still at the version that was read
+    versions = {(USERS, user_id): docs[user_id].version for user_id in user_ids}
+    if writes:
+        with stage_metrics.timer("storage.write_many"):
+            committed = store.commit(writes + _score_writes(written))
+        if committed is None:
+            return False
+        versions.update(committed)
+        batch_stats["batch_commits"] += 1
+
+    batch_stats["batched_actions"] += len(batched)
+    _committed(written, versions)
+    for i, message in results.items():
+        messages[i] = message
+    return True
+
+GEMINI_FALLBACK_MESSAGE = "月との通信が混み合ってるぴょん...🌕💦"
+
+# Answered without a model call while the Gemini circuit is open
+DEGRADED_CHAT_REPLIES = [
+    "いま月の電波がちょっと弱いみたいだぴょん📡🐰\nまたあとでお話ししようね！",
+    "うさうさ…月で餅つき中で手が離せないぴょん🍡\n少し待っててね！",
+    "お話ししたいけど、いまは月との通信が混み合ってるだうさ🌕💦",
+    "ぴょん！いまは短いお返事しかできないけど、話しかけてくれてうれしいぴょん🐰✨",
+]
+
+def degraded_chat_reply():
+    return random.choice(DEGRADED_CHAT_REPLIES)
+
+# Stock phrases (greetings etc.) are answered from here instead of a Gemini round trip
+reply_cache = ReplyCache(
+    InMemoryReplyCache(max_entries=REPLY_CACHE_MAX_ENTRIES, ttl=REPLY_CACHE_TTL),
+    RABBIT_SYSTEM_INSTRUCTION,
+    variants=REPLY_CACHE_VARIANTS,
+    max_input_chars=REPLY_CACHE_MAX_INPUT_CHARS,
+)
+
+def get_cached_reply(text):
+    if not REPLY_CACHE_ENABLED:
+        return None
+    return reply_cache.lookup(text)
+
+def store_cached_reply(text, reply):
+    if REPLY_CACHE_ENABLED:
+        reply_cache.store(text, reply)
+
+# --- Reply length budget ---
+SENTENCE_ENDS = "。！？!?\n"
+
+def _sentence_end(text, i):
+    """Index just past the sentence ending at text[i] (runs of "！？" and trailing emoji included)."""
+    j = i + 1
+    while j < len(text) and (text[j] in SENTENCE_ENDS or unicodedata.category(text[j]) in ("So", "Sk", "Mn", "Cf", "Zs")):
+        j += 1
+    return j
+
+def trim_reply(text, final=True, max_chars=None, max_sentences=None):
+    """Cut a reply to the length budget. Returns (text, budget_reached).
+
+    With final=False (a partial stream) a sentence only counts once
+    something follows it, so trailing emoji in the next chunk are kept.
+    """
+    max_chars = max_chars or GEMINI_REPLY_MAX_CHARS
+    max_sentences = max_sentences or GEMINI_REPLY_MAX_SENTENCES
+    sentences = 0
+    last_end = 0  # end of the last complete sentence within max_chars
+    i = 0
+    while i < min(len(text), max_chars):
+        if text[i] not in SENTENCE_ENDS:
+            i += 1
+            continue
+        end = _sentence_end(text, i)
+        if end == len(text) and not final:
+            break
+        if end > max_chars:
+            break
+        sentences += 1
+        last_end = end
+        if sentences >= max_sentences:
+            return text[:end].rstrip(), True
+        i = end
+    if len(text) > max_chars:
+        if last_end >= max_chars // 2:
+            return text[:last_end].rstrip(), True
+        return text[:max_chars - 1].rstrip() + "…", True
+    return text, False
+
+# Token usage and cut-off counters (see /metrics "gemini")
+gemini_stats = {"requests": 0, "streamed": 0, "cut_off": 0, "prompt_tokens": 0, "output_tokens": 0}
+
+def _generation_config():
+    return {"max_output_tokens": GEMINI_MAX_OUTPUT_TOKENS}
+
+def _record_usage(response):
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        gemini_stats["prompt_tokens"] += getattr(usage, "prompt_token_count", 0) or 0
+        gemini_stats["output_tokens"] += getattr(usage, "candidates_token_count", 0) or 0
+
 def get_gemini_reply(text):
     """Get a response from the Gemini API."""
-    try:
+    cached = get_cached_reply(text)
+    if cached is not None:
+        return cached
+    def call():
         model_instance = get_model()
-        response = model_instance.generate_content(text)
-        return response.text
-    except Exception as e:
-        print(f"Gemini Error: {e}")
-        return "月との通信が混み合ってるぴょん...🌕💦"
+        gemini_stats["requests"] += 1
+        with stage_metrics.timer("gemini.call"):
+            return model_instance.generate_content(text, generation_config=_generation_config())
+    try:
+        response = gemini_breaker.call(call) if CIRCUIT_BREAKER_ENABLED else call()
+        _record_usage(response)
+        reply, cut = trim_reply(response.text)
+        if cut:
+            gemini_stats["cut_off"] += 1
+        store_cached_reply(text, reply)
+        return reply
+    except CircuitOpenError:
+        stage_metrics.incr("gemini.short_circuit")
+        return degraded_chat_reply()
+    except Exception:
+        logger.exception("Gemini error")
+        return GEMINI_FALLBACK_MESSAGE
+
+# (loop, semaphore) - asyncio primitives must not be shared across event loops
+_gemini_semaphore = None
+
+def get_gemini_semaphore():
+    """Semaphore limiting in-flight Gemini requests on the running loop."""
+    global _gemini_semaphore
+    loop = asyncio.get_running_loop()
+    if _gemini_semaphore is None or _gemini_semaphore[0] is not loop:
+        _gemini_semaphore = (loop, asyncio.Semaphore(GEMINI_MAX_CONCURRENCY))
+    return _gemini_semaphore[1]
+
+async def _generate_once(model_instance, contents):
+    """One model call; streamed replies stop as soon as the length budget is reached."""
+    gemini_stats["requests"] += 1
+    if not GEMINI_STREAMING:
+        response = await model_instance.generate_content_async(contents, generation_config=_generation_config())
+        _record_usage(response)
+        reply, cut = trim_reply(response.text)
+    else:
+        gemini_stats["streamed"] += 1
+        started = time.perf_counter()
+        response = await model_instance.generate_content_async(
+            contents, stream=True, generation_config=_generation_config()
+        )
+        received = ""
+        chunk = None
+        cut = False
+        async for chunk in response:
+            if not received:
+                stage_metrics.observe("gemini.first_chunk", time.perf_counter() - started)
+            received += chunk.text
+            reply, cut = trim_reply(received, final=False)
+            if cut:
+                # Stop reading: the rest would not be sent anyway
+                break
+        if not cut:
+            reply, cut = trim_reply(received)
+        # Usage arrives with the chunks (complete on the last one)
+        _record_usage(chunk)
+    if cut:
+        gemini_stats["cut_off"] += 1
+    return reply
+
+async def _generate_with_retry(contents):
+    from google.api_core.exceptions import TooManyRequests
+    model_instance = get_model()
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        try:
+            async with get_gemini_semaphore():
+                with stage_metrics.timer("gemini.call"):
+                    return await _generate_once(model_instance, contents)
+        except TooManyRequests:
+            if attempt == GEMINI_MAX_RETRIES:
+                raise
+            stage_metrics.incr("gemini.retry")
+            # Full-jitter backoff, slept outside the semaphore so other chats can proceed
+            await asyncio.sleep(random.uniform(0, GEMINI_RETRY_BASE_DELAY * 2 ** attempt))
+
+# --- Chat memory (CHAT_MEMORY_ENABLED) ---
+chat_memory = ChatMemory(
+    max_sessions=CHAT_MEMORY_MAX_SESSIONS,
+    max_exchanges=CHAT_MEMORY_MAX_EXCHANGES,
+    compact_exchanges=CHAT_MEMORY_COMPACT_EXCHANGES,
+    max_turn_chars=CHAT_MEMORY_MAX_TURN_CHARS,
+    summary_max_chars=CHAT_MEMORY_SUMMARY_MAX_CHARS,
+    idle_ttl=CHAT_MEMORY_IDLE_TTL,
+    store=ChatStore(get_storage),
+)
+# Background writes of sessions that went cold (kept referenced until done)
+_chat_writes = set()
+
+async def get_chat_session(user_id):
+    session = chat_memory.hot(user_id)
+    if session is None:
+        try:
+            with stage_metrics.timer("chat_memory.load"):
+                session = await asyncio.to_thread(chat_memory.load, user_id)
+        except CircuitOpenError:
+            # storage outage: chat without history, no traceback per message
+            logger.warning("Chat memory load skipped: storage circuit is open")
+        except Exception:
+            logger.exception("Chat memory load failed")
+    return session
+
+def _persist_chat_sessions(sessions):
+    try:
+        chat_memory.persist(sessions)
+    except CircuitOpenError:
+        logger.warning("Chat memory write skipped: storage circuit is open")
+    except Exception:
+        logger.exception("Chat memory write failed")
+
+def remember_exchange(session, text, reply):
+    """Add an exchange to the session; cold sessions are written in the background."""
+    if session is None:
+        return
+    cold = chat_memory.record(session, text, reply)
+    if cold:
+        task = asyncio.get_running_loop().create_task(asyncio.to_thread(_persist_chat_sessions, cold))
+        _chat_writes.add(task)
+        task.add_done_callback(_chat_writes.discard)
+
+async def flush_chat_memory():
+    """Write all unsaved sessions (shutdown)."""
+    if _chat_writes:
+        await asyncio.gather(*_chat_writes, return_exceptions=True)
+    try:
+        await asyncio.to_thread(chat_memory.flush)
+    except CircuitOpenError:
+        logger.warning("Chat memory write skipped: storage circuit is open")
+    except Exception:
+        logger.exception("Chat memory write failed")
+
+async def _call_gemini(contents):
+    def call():
+        return asyncio.wait_for(_generate_with_retry(contents), timeout=GEMINI_TIMEOUT)
+    if CIRCUIT_BREAKER_ENABLED:
+        return await gemini_breaker.call_async(call)
+    return await call()
+
+async def get_gemini_reply_async(text, user_id=None):
+    """Async Gemini reply with a concurrency limit, deadline and rate-limit retries.
+
+    With CHAT_MEMORY_ENABLED and a user_id the model also sees that user's
+    conversation so far.
+    """
+    session = await get_chat_session(user_id) if CHAT_MEMORY_ENABLED and user_id else None
+    contents = text
+    if session is not None and session.has_history:
+        # The reply depends on the history, so the reply cache is bypassed
+        contents = session.contents(text)
+    else:
+        cached = get_cached_reply(text)
+        if cached is not None:
+            remember_exchange(session, text, cached)
+            return cached
+    try:
+        with stage_metrics.timer("gemini.time_to_reply"):
+            reply = await _call_gemini(contents)
+        if contents is text:
+            store_cached_reply(text, reply)
+        remember_exchange(session, text, reply)
+        return reply
+    except CircuitOpenError:
+        # Gemini has been failing: answer right away instead of waiting for another timeout
+        stage_metrics.incr("gemini.short_circuit")
+        return degraded_chat_reply()
+    except asyncio.TimeoutError:
+        stage_metrics.incr("gemini.timeout")
+        logger.warning("Gemini timeout: no reply within %ss", GEMINI_TIMEOUT)
+    except Exception:
+        stage_metrics.incr("gemini.failure")
+        logger.exception("Gemini error")
+    return GEMINI_FALLBACK_MESSAGE
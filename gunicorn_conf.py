@@ -0,0 +1,36 @@
+import multiprocessing
+import os
+
+
+def available_cpus():
+    """CPUs this container may actually use (cgroup quota, then affinity)."""
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return max(1, int(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+
+def default_workers():
+    # Uvicorn workers are async and mostly wait on I/O, so one per core is
+    # enough to use every core without oversubscribing.
+    return available_cpus()
+
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.environ.get("WEB_CONCURRENCY") or default_workers())
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+# Import the app once in the master and fork it (smaller per-worker memory).
+# The Firestore / Gemini clients are created lazily in each worker after
+# the fork (see game_logic.reset_clients).
+preload_app = os.environ.get("GUNICORN_PRELOAD", "false").lower() == "true"
+
@@ -0,0 +1,252 @@
+"""Streak / carrot rankings without scanning rabbit_gamers.
+
+Every scoring write also increments a score histogram, split over a few
+shard documents so no single document takes every write:
+
+    leaderboard/shard{n}: {"streak": {"<score>": count, ...}, "carrots": {...}}
+
+Only players with a score above 0 are counted; everyone at 0 shares the
+last rank. Each instance sums the shards into a RankingIndex (a Fenwick
+tree over scores) for O(log n) "my rank" lookups, and gets the top
+players from a top-N query (an indexed order_by on Firestore).
+
+Histograms for players that existed before the leaderboard are built once
+with:
+    python -m leaderboard --rebuild
+"""
+import random
+import threading
+import time
+from array import array
+from collections import Counter
+from storage import Increment, Write
+
+# Board name -> rabbit_gamers field
+BOARDS = {
+    "streak": "current_streak",
+    "carrots": "carrot_count",
+}
+
+
+def score_slot(score, max_score):
+    return max(0, min(int(score or 0), max_score))
+
+
+def score_changes(user_data):
+    """{board: (stored score, new score)} for a profile about to be written."""
+    changes = {}
+    for board, field in BOARDS.items():
+        old, new = user_data.saved_value(field, 0), getattr(user_data, field)
+        if old != new:
+            changes[board] = (old, new)
+    return changes
+
+
+class FenwickTree:
+    """Prefix sums over counts[0..size-1]: O(log n) update and query."""
+
+    def __init__(self, size):
+        self.size = size
+        self._tree = array("q", [0]) * (size + 1)
+
+    @classmethod
+    def from_counts(cls, counts):
+        """Build in O(n)."""
+        tree = cls(len(counts))
+        t = tree._tree
+        for i, count in enumerate(counts, 1):
+            t[i] += count
+            parent = i + (i & -i)
+            if parent <= tree.size:
+                t[parent] += t[i]
+        return tree
+
+    def add(self, index, delta):
+        i = index + 1
+        while i <= self.size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, index):
+        """counts[0] + ... + counts[index]."""
+        total = 0
+        i = index + 1
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+
+class RankingIndex:
+    """Histogram of ranked players' scores (1..max_score).
+
+    rank(score) is 1 + the number of players with a higher score.
+    """
+
+    def __init__(self, max_score=10000, counts=None):
+        self.max_score = max_score
+        dense = [0] * (max_score + 1)
+        for score, count in (counts or {}).items():
+            slot = score_slot(score, max_score)
+            if slot:
+                dense[slot] += count
+        self.total = sum(dense)
+        self._tree = FenwickTree.from_counts(dense)
+
+    def move(self, old, new):
+        """A player's score changed from old to new (0: not ranked)."""
+        old, new = score_slot(old, self.max_score), score_slot(new, self.max_score)
+        if old == new:
+            return
+        if old:
+            self._tree.add(old, -1)
+            self.total -= 1
+        if new:
+            self._tree.add(new, 1)
+            self.total += 1
+
+    def rank(self, score):
+        return 1 + self.total - self._tree.prefix_sum(score_slot(score, self.max_score))
+
+
+class LeaderboardStore:
+    """Sharded histogram documents plus the per-instance ranking indexes.
+
+    Indexes and top lists are refreshed every `ttl` seconds (one get_many of
+    the shards / one top query per board); this instance's own writes are
+    applied to its indexes right away.
+    """
+
+    def __init__(self, storage_factory, collection="leaderboard", shards=20, max_score=10000, ttl=60.0,
+                 top_n=5, users_collection="rabbit_gamers", clock=time.monotonic):
+        self.storage_factory = storage_factory
+        self.collection = collection
+        self.shards = shards
+        self.max_score = max_score
+        self.ttl = ttl
+        self.top_n = top_n
+        self.users_collection = users_collection
+        self.clock = clock
+        self.refreshes = 0
+        self.top_queries = 0
+        self._indexes = None
+        self._indexes_expire = 0.0
+        self._top = {}  # board -> (expires_at, [(user_id, score), ...])
+        self._lock = threading.Lock()
+
+    def histogram_deltas(self, changes_list):
+        """{board: {"<score>": delta}} for a list of score_changes() results."""
+        deltas = {}
+        for changes in changes_list:
+            for board, (old, new) in changes.items():
+                old, new = score_slot(old, self.max_score), score_slot(new, self.max_score)
+                if old == new:
+                    continue
+                counts = deltas.setdefault(board, Counter())
+                if old:
+                    counts[str(old)] -= 1
+                if new:
+                    counts[str(new)] += 1
+        result = {}
+        for board, counts in deltas.items():
+            nonzero = {score: d for score, d in counts.items() if d}
+            if nonzero:
+                result[board] = nonzero
+        return result
+
+    def write(self, changes_list):
+        """The histogram increments as one Write to a random shard (None if nothing changes).
+
+        Commit it together with the profile writes.
+        """
+        deltas = self.histogram_deltas(changes_list)
+        if not deltas:
+            return None
+        updates = {board: {score: Increment(d) for score, d in counts.items()} for board, counts in deltas.items()}
+        return Write("merge", self.collection, f"shard{random.randrange(self.shards)}", updates)
+
+    def applied(self, changes_list):
+        """Apply committed score changes to this instance's indexes."""
+        with self._lock:
+            if self._indexes is None:
+                return
+            for changes in changes_list:
+                for board, (old, new) in changes.items():
+                    self._indexes[board].move(old, new)
+
+    def indexes(self):
+        now = self.clock()
+        with self._lock:
+            if self._indexes is not None and now < self._indexes_expire:
+                return self._indexes
+            shards = self.storage_factory().get_many(self.collection, [f"shard{n}" for n in range(self.shards)])
+            counts = {board: Counter() for board in BOARDS}
+            for doc in shards.values():
+                for board, shard_counts in (doc.data or {}).items():
+                    if board in counts:
+                        counts[board].update({int(score): count for score, count in shard_counts.items()})
+            self._indexes = {board: RankingIndex(self.max_score, board_counts)
+                             for board, board_counts in counts.items()}
+            self._indexes_expire = now + self.ttl
+            self.refreshes += 1
+            return self._indexes
+
+    def rank(self, board, score):
+        """(rank, ranked players) for a score on a board."""
+        index = self.indexes()[board]
+        return index.rank(score), index.total
+
+    def top(self, board):
+        """[(user_id, score), ...] best first, players with a score above 0 only."""
+        now = self.clock()
+        cached = self._top.get(board)
+        if cached is not None and now < cached[0]:
+            return cached[1]
+        field = BOARDS[board]
+        entries = []
+        for doc in self.storage_factory().top(self.users_collection, field, self.top_n):
+            score = doc.data.get(field, 0)
+            if score:
+                entries.append((doc.key, score))
+        self.top_queries += 1
+        self._top[board] = (now + self.ttl, entries)
+        return entries
+
+    def rebuild(self):
+        """Recount every profile into the shards (one full scan; run while writes are paused)."""
+        storage = self.storage_factory()
+        counts = {board: Counter() for board in BOARDS}
+        for doc in storage.scan(self.users_collection):
+            for board, field in BOARDS.items():
+                slot = score_slot(doc.data.get(field), self.max_score)
+                if slot:
+                    counts[board][str(slot)] += 1
+        storage.write_many([
+            Write("set", self.collection, f"shard{shard}",
+                  {board: dict(board_counts) for board, board_counts in counts.items()} if shard == 0 else {})
+            for shard in range(self.shards)
+        ])
+        with self._lock:
+            self._indexes = None
+        return {board: sum(board_counts.values()) for board, board_counts in counts.items()}
+
+    def stats(self):
+        indexes = self._indexes or {}
+        return {
+            "ranked": {board: index.total for board, index in indexes.items()},
+            "refreshes": self.refreshes,
+            "top_queries": self.top_queries,
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+    import game_logic
+
+    parser = argparse.ArgumentParser(description="Leaderboard maintenance")
+    parser.add_argument("--rebuild", action="store_true", help="recount all profiles into the histogram shards")
+    args = parser.parse_args()
+    if args.rebuild:
+        print(game_logic.leaderboard.rebuild())
+    else:
+        parser.print_help()
@@ -0,0 +1,181 @@
+import asyncio
+import random
+import time
+import uuid
+
+MULTICAST_MAX_RECIPIENTS = 500  # LINE API limit per multicast request
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class LineApiError(Exception):
+    """Non-retryable (or retries exhausted) error from the Messaging API."""
+
+    def __init__(self, status, body):
+        super().__init__(f"LINE API error {status}: {body}")
+        self.status = status
+        self.body = body
+
+
+def _message_json(message):
+    return message.as_json_dict() if hasattr(message, "as_json_dict") else message
+
+
+class AsyncLineClient:
+    """Non-blocking LINE Messaging API client on a pooled keep-alive session.
+
+    - one aiohttp session per worker process (connections are reused)
+    - 429 / 5xx are retried with jittered backoff, honouring Retry-After
+    - reply retries stop once the reply token would have expired
+    - push / multicast retries carry an X-Line-Retry-Key so LINE drops duplicates
+    """
+
+    def __init__(self, channel_access_token, endpoint="https://api.line.me", pool_size=100,
+                 timeout=10.0, keepalive_timeout=30.0, max_retries=3, retry_base_delay=0.5,
+                 reply_token_ttl=50.0, multicast_concurrency=4):
+        self.channel_access_token = channel_access_token
+        self.endpoint = endpoint.rstrip("/")
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.reply_token_ttl = reply_token_ttl
+        self.multicast_concurrency = multicast_concurrency
+        self._session = None
+
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.expired_replies = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+
+    async def start(self):
+        if self._session is not None:
+            return
+        import aiohttp  # imported here to keep it off the cold-start path
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._on_connection_created)
+        trace.on_connection_reuseconn.append(self._on_connection_reused)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={"Authorization": f"Bearer {self.channel_access_token}"},
+            trace_configs=[trace],
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _on_connection_created(self, session, ctx, params):
+        self.connections_created += 1
+
+    async def _on_connection_reused(self, session, ctx, params):
+        self.connections_reused += 1
+
+    async def reply_message(self, reply_token, messages, received_at=None):
+        """Reply to a webhook event. received_at: event time (epoch seconds)."""
+        deadline = (received_at or time.time()) + self.reply_token_ttl
+        payload = {"replyToken": reply_token, "messages": [_message_json(m) for m in messages]}
+        return await self._post("/v2/bot/message/reply", payload, deadline=deadline)
+
+    async def push_message(self, to, messages, notification_disabled=False):
+        payload = {
+            "to": to,
+            "messages": [_message_json(m) for m in messages],
+            "notificationDisabled": notification_disabled,
+        }
+        return await self._post("/v2/bot/message/push", payload, retry_key=str(uuid.uuid4()))
+
+    async def broadcast(self, messages, retry_key=None, notification_disabled=False):
+        """Send to every friend of the bot.
+
+        Pass a fixed retry_key (a UUID) to make the send idempotent: when
+        several workers broadcast the same event, LINE accepts the first
+        and answers 409 to the others, which is treated as success.
+        """
+        payload = {"messages": [_message_json(m) for m in messages], "notificationDisabled": notification_disabled}
+        try:
+            return await self._post("/v2/bot/message/broadcast", payload, retry_key=retry_key or str(uuid.uuid4()))
+        except LineApiError as e:
+            if e.status == 409 and retry_key:
+                return None
+            raise
+
+    async def multicast(self, user_ids, messages, notification_disabled=False):
+        """Send the same messages to many users, 500 recipients per request.
+
+        Returns the number of requests made; raises LineApiError if any chunk
+        ultimately fails (the other chunks are still sent).
+        """
+        messages = [_message_json(m) for m in messages]
+        chunks = [user_ids[i:i + MULTICAST_MAX_RECIPIENTS] for i in range(0, len(user_ids), MULTICAST_MAX_RECIPIENTS)]
+        semaphore = asyncio.Semaphore(self.multicast_concurrency)
+
+        async def send(chunk):
+            payload = {"to": chunk, "messages": messages, "notificationDisabled": notification_disabled}
+            async with semaphore:
+                return await self._post("/v2/bot/message/multicast", payload, retry_key=str(uuid.uuid4()))
+
+        results = await asyncio.gather(*(send(chunk) for chunk in chunks), return_exceptions=True)
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            raise errors[0]
+        return len(chunks)
+
+    async def _post(self, path, payload, retry_key=None, deadline=None):
+        await self.start()
+        import aiohttp
+        headers = {"X-Line-Retry-Key": retry_key} if retry_key else None
+        attempt = 0
+        while True:
+            self.requests += 1
+            try:
+                async with self._session.post(self.endpoint + path, json=payload, headers=headers) as res:
+                    body = await res.text()
+                    if res.status < 300:
+                        return body
+                    if res.status == 409 and retry_key and attempt:
+                        # Same retry key already accepted: an earlier attempt went through
+                        return body
+                    if res.status not in RETRYABLE_STATUS:
+                        self.failures += 1
+                        raise LineApiError(res.status, body)
+                    retry_after = res.headers.get("Retry-After")
+                    error = LineApiError(res.status, body)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                retry_after = None
+                error = e
+
+            delay = self._backoff(attempt, retry_after)
+            if attempt >= self.max_retries:
+                self.failures += 1
+                raise error
+            if deadline is not None and time.time() + delay >= deadline:
+                # The reply token will be dead before we could try again
+                self.expired_replies += 1
+                self.failures += 1
+                raise error
+            attempt += 1
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    def _backoff(self, attempt, retry_after):
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return random.uniform(0, self.retry_base_delay * 2 ** attempt)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+            "expired_replies": self.expired_replies,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+        }
@@ -8,110 +8,228 @@ from linebot.models import (
     TextComponent,
     ButtonComponent
 )
-from config import IMAGE_URLS
+from linebot.models.send_messages import SendMessage
+from config import IMAGE_URLS, SHOP_ITEMS
+from metrics import stage_metrics
+from string import Formatter
 import json
+import os
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "flex_templates.json")
+
+
+class RenderedFlexMessage(FlexSendMessage):
+    """FlexSendMessage that keeps already-built Flex JSON as-is.
+
+    The stock FlexSendMessage turns the dict into a tree of SDK objects and
+    walks it again in as_json_dict(); for templates we already hold the
+    final JSON, so both steps are skipped.
+    """
+
+    def __init__(self, alt_text, contents):
+        SendMessage.__init__(self)
+        self.type = "flex"
+        self.alt_text = alt_text
+        self.contents = contents
+
+    def as_json_dict(self):
+        return {"type": "flex", "altText": self.alt_text, "contents": self.contents}
+
+
+class FlexTemplate:
+    """Flex JSON compiled once into a renderer.
+
+    String values may contain {field} placeholders. Subtrees without
+    placeholders are shared between renders (treat rendered output as
+    read-only); only the path down to a placeholder is rebuilt per call.
+    """
+
+    def __init__(self, tree):
+        self.fields = set()
+        self.dynamic, self._render = self._compile(tree)
+
+    def _compile(self, node):
+        if isinstance(node, str):
+            names = [name for _, name, _, _ in Formatter().parse(node) if name is not None]
+            if not names:
+                return False, node
+            for name in names:
+                if not name.isidentifier():
+                    raise ValueError(f"Invalid template placeholder: {{{name}}}")
+            self.fields.update(names)
+            return True, node.format_map
+
+        if isinstance(node, dict):
+            entries = [(key,) + self._compile(value) for key, value in node.items()]
+            if not any(is_dynamic for _, is_dynamic, _ in entries):
+                return False, node
+
+            def render_dict(values):
+                return {key: item(values) if is_dynamic else item for key, is_dynamic, item in entries}
+            return True, render_dict
+
+        if isinstance(node, list):
+            compiled = [self._compile(item) for item in node]
+            if not any(is_dynamic for is_dynamic, _ in compiled):
+                return False, node
+
+            def render_list(values):
+                return [item(values) if is_dynamic else item for is_dynamic, item in compiled]
+            return True, render_list
+
+        return False, node
+
+    def render(self, **values):
+        missing = self.fields - values.keys()
+        if missing:
+            raise KeyError(f"Missing template fields: {sorted(missing)}")
+        return self._render(values) if self.dynamic else self._render
+
+
+def load_templates(path=TEMPLATE_PATH):
+    """Load flex_templates.json and validate every container once."""
+    with open(path, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+
+    templates = {}
+    for name, tree in raw.items():
+        if tree.get("type") not in ("bubble", "carousel"):
+            raise ValueError(f"Flex template '{name}' must be a bubble or carousel")
+        template = FlexTemplate(tree)
+        # Every container must parse as SDK objects (placeholders filled with dummies)
+        FlexSendMessage(alt_text=name, contents=template.render(**{field: "0" for field in template.fields}))
+        templates[name] = template
+    return templates
+
+
+# JSONファイルのデザインデータは起動時に一度だけ読み込む
+TEMPLATES = load_templates()
+MEMBER_CARD_TEMPLATE = TEMPLATES["member_card"]
+if MEMBER_CARD_TEMPLATE.fields != {"display_image", "carrot_count", "current_streak", "doll_status", "status_text"}:
+    raise ValueError(f"Unexpected member_card fields: {sorted(MEMBER_CARD_TEMPLATE.fields)}")
 
-def create_shop_message():
-    """Create the shop carousel Flex Message."""
-        # JSONファイルからデザインデータを読み込む
-    with open('flex_templates.json', 'r', encoding='utf-8') as f:
-        shop_carousel = json.load(f)
 
+def build_shop_carousel(items=SHOP_ITEMS):
+    """One bubble per entry in SHOP_ITEMS, in catalog order.
 
-    return FlexSendMessage(alt_text="月面コンビニ", contents=shop_carousel)
+    Items without a description show their price on one (unwrapped) line.
+    """
+    bubbles = []
+    for item in items.values():
+        if item["description"]:
+            template, fields = TEMPLATES["shop_item"], {"description": item["description"]}
+        else:
+            template, fields = TEMPLATES["shop_item_price"], {}
+        bubbles.append(template.render(
+            image=item["image"],
+            title=item["title"],
+            price=item["price"],
+            buy_command=item["buy_command"],
+            **fields,
+        ))
+    return {"type": "carousel", "contents": bubbles}
+
+SHOP_MESSAGE = RenderedFlexMessage(alt_text="月面コンビニ", contents=build_shop_carousel())
+
+# look key -> (member card image, status text)
+LOOK_DISPLAY = {"normal": (IMAGE_URLS["normal"], "ノーマル")}
+for _item in SHOP_ITEMS.values():
+    if _item["look"]:
+        LOOK_DISPLAY[_item["look"]["key"]] = (_item["look"]["image"], _item["look"]["status"])
+
+
+def create_shop_message():
+    """Create the shop carousel Flex Message."""
+    return SHOP_MESSAGE
 
 
 def create_member_card(user_data):
-    """Create the member card Flex Message based on user data."""
-    my_items = user_data.get("items", [])
-    current_look = user_data.get("current_look", "normal")
-    current_streak = user_data.get("current_streak", 0)
-    carrot_count = user_data.get("carrot_count", 0)
+    """Create the member card Flex Message from a UserState."""
+    with stage_metrics.timer("flex.member_card"):
+        return _build_member_card(user_data)
 
-    # Determine display image and status text
-    display_image = IMAGE_URLS["normal"]
-    status_text = "ノーマル"
 
-    if current_look == "sunglasses":
-        display_image = IMAGE_URLS["sunglasses"]
-        status_text = "サングラス装着中 😎"
-    elif current_look == "pink":
-        display_image = IMAGE_URLS["pink"]
-        status_text = "ピンクに変身中 🎀"
+def _build_member_card(user_data):
+    # Determine display image and status text
+    display_image, status_text = LOOK_DISPLAY.get(user_data.current_look, LOOK_DISPLAY["normal"])
 
     # Check for substitute doll
-    doll_status = "あり 🧸" if "substitute_doll" in my_items else "なし"
-
-    status_card = {
-        "type": "bubble",
-        "hero": {
-            "type": "image",
-            "url": display_image,
-            "size": "full",
-            "aspectRatio": "1:1",
-            "aspectMode": "cover",
-        },
-        "body": {
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {
-                    "type": "text",
-                    "text": "月うさぎ会員証 🌕",
-                    "weight": "bold",
-                    "size": "xl",
-                },
-                {"type": "separator", "margin": "md"},
-                {
-                    "type": "box",
-                    "layout": "vertical",
-                    "margin": "md",
-                    "spacing": "sm",
-                    "contents": [
-                        {
-                            "type": "text",
-                            "text": f"🥕 所持人参: {carrot_count} 本",
-                            "size": "sm",
-                            "color": "#666666",
-                        },
-                        {
-                            "type": "text",
-                            "text": f"🔥 連続記録: {current_streak} 日",
-                            "size": "sm",
-                            "color": "#666666",
-                        },
-                        {
-                            "type": "text",
-                            "text": f"🧸 身代わり人形: {doll_status}",
-                            "size": "sm",
-                            "color": "#666666",
-                        },
-                        {
-                            "type": "text",
-                            "text": f"状態: {status_text}",
-                            "size": "sm",
-                            "color": "#aaaaaa",
-                            "margin": "sm",
-                        },
-                    ],
-                },
-            ],
-        },
-        "footer": {
-            "type": "box",
-            "layout": "vertical",
+    doll_status = "あり 🧸" if user_data.has_item("substitute_doll") else "なし"
+
+    status_card = MEMBER_CARD_TEMPLATE.render(
+        display_image=display_image,
+        carrot_count=user_data.carrot_count,
+        current_streak=user_data.current_streak,
+        doll_status=doll_status,
+        status_text=status_text,
+    )
+    return RenderedFlexMessage(alt_text="会員証", contents=status_card)
+
+
+LEADERBOARD_TEMPLATE = TEMPLATES["leaderboard"]
+if LEADERBOARD_TEMPLATE.fields != {"title", "my_rank", "total", "my_score"}:
+    raise ValueError(f"Unexpected leaderboard fields: {sorted(LEADERBOARD_TEMPLATE.fields)}")
+# The empty box in the template body receives the ranking rows
+LEADERBOARD_ROWS_AT = next(
+    i for i, node in enumerate(LEADERBOARD_TEMPLATE.render(**dict.fromkeys(LEADERBOARD_TEMPLATE.fields, ""))["body"]["contents"])
+    if node["type"] == "box" and not node["contents"]
+)
+
+# board -> (title, score unit)
+LEADERBOARD_BOARDS = {
+    "streak": ("🔥 早起き連続ランキング", "日"),
+    "carrots": ("🥕 人参長者ランキング", "本"),
+}
+RANK_MEDALS = {1: "🥇", 2: "🥈", 3: "🥉"}
+
+
+def _leaderboard_row(rank, name, score, unit, is_me):
+    return {
+        "type": "box",
+        "layout": "horizontal",
+        "contents": [
+            {"type": "text", "text": RANK_MEDALS.get(rank, f"{rank}位"), "size": "sm", "flex": 1},
+            {"type": "text", "text": name, "size": "sm", "flex": 3,
+             "weight": "bold" if is_me else "regular"},
+            {"type": "text", "text": f"{score}{unit}", "size": "sm", "flex": 2, "align": "end"},
+        ],
+    }
+
+
+def _leaderboard_bubble(board, user_id, entries, my_rank, total, my_score):
+    title, unit = LEADERBOARD_BOARDS[board]
+    rows = []
+    rank = 0
+    previous = None
+    for position, (entry_id, score) in enumerate(entries, 1):
+        # tied scores share a rank
+        if score != previous:
+            rank, previous = position, score
+        is_me = entry_id == user_id
+        rows.append(_leaderboard_row(rank, "あなた" if is_me else f"うさぎ#{entry_id[-4:]}", score, unit, is_me))
+    if not rows:
+        rows.append({"type": "text", "text": "まだ誰もいないよ🐰", "size": "sm", "color": "#aaaaaa"})
+
+    bubble = LEADERBOARD_TEMPLATE.render(
+        title=title,
+        my_rank=my_rank if my_score else "-",
+        total=total,
+        my_score=f"{my_score}{unit}",
+    )
+    # Rendered templates share their static parts: copy the path down to the rows box
+    body = dict(bubble["body"])
+    body["contents"] = list(body["contents"])
+    body["contents"][LEADERBOARD_ROWS_AT] = dict(body["contents"][LEADERBOARD_ROWS_AT], contents=rows)
+    return dict(bubble, body=body)
+
+
+def create_leaderboard_message(user_id, boards):
+    """Ranking carousel; boards is game_logic.get_leaderboard() output."""
+    with stage_metrics.timer("flex.leaderboard"):
+        return RenderedFlexMessage(alt_text="ランキング", contents={
+            "type": "carousel",
             "contents": [
-                {
-                    "type": "button",
-                    "style": "primary",
-                    "color": "#FF9933",
-                    "action": {
-                        "type": "message",
-                        "label": "ショップを見る",
-                        "text": "ショップ",
-                    },
-                }
+                _leaderboard_bubble(board, user_id, *boards[board])
+                for board in LEADERBOARD_BOARDS if board in boards
             ],
-        },
-    }
-    return FlexSendMessage(alt_text="会員証", contents=status_card)
+        })
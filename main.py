@@ -1,115 +1,478 @@
-import sys
-from fastapi import FastAPI, Request, BackgroundTasks
-from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
-from linebot.models import MessageEvent, TextMessage, TextSendMessage
+import asyncio
+import importlib
+import logging
+import uuid
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, Response
+from starlette.concurrency import run_in_threadpool
 
 # Import local modules
-from config import CHANNEL_ACCESS_TOKEN, CHANNEL_SECRET
+from config import (
+    CHANNEL_ACCESS_TOKEN,
+    CHANNEL_SECRET,
+    EVENT_QUEUE_MAXSIZE,
+    EVENT_WORKERS,
+    EVENT_DRAIN_TIMEOUT,
+    WEBHOOK_BATCH_MODE,
+    EVENT_DEDUP_ENABLED,
+    EVENT_DEDUP_TTL,
+    EVENT_DEDUP_MAX_ENTRIES,
+    EVENT_DEDUP_SHARED,
+    EVENT_DEDUP_COLLECTION,
+    SHOP_ITEMS,
+    LINE_API_ENDPOINT,
+    LINE_HTTP_POOL_SIZE,
+    LINE_HTTP_TIMEOUT,
+    LINE_MAX_RETRIES,
+    LINE_REPLY_TOKEN_TTL,
+    PROFILER_ENABLED,
+    PROFILER_INTERVAL,
+    PROFILER_SLOW_THRESHOLD,
+    PROFILER_MAX_PROFILES,
+    MOON_TABLE_YEARS,
+    MOON_BROADCAST_ENABLED,
+    CHAT_MEMORY_ENABLED,
+    LEADERBOARD_ENABLED,
+    RATE_LIMIT_ENABLED,
+    RATE_LIMIT_CHAT_RATE,
+    RATE_LIMIT_CHAT_BURST,
+    RATE_LIMIT_GAME_RATE,
+    RATE_LIMIT_GAME_BURST,
+    RATE_LIMIT_MAX_USERS,
+    FAIR_QUEUE_ENABLED,
+    FAIR_QUEUE_CHAT_COST,
+    STARTUP_WARMUP,
+    CIRCUIT_BREAKER_ENABLED,
+    DEGRADED_REPLAY_INTERVAL,
+)
+from commands import CommandRouter
+from line_client import AsyncLineClient
+from event_queue import EventProcessor, QueueFullError
+from event_dedup import EventDeduplicator, SharedEventStore
+from rate_limit import TokenBucketLimiter
+from circuit_breaker import CircuitOpenError
+from metrics import stage_metrics, SlowRequestProfiler
+import moon_phase
 import game_logic
-import line_messages
+
+logger = logging.getLogger(__name__)
+
+
+# linebot (which loads all of linebot.models) and line_messages, which builds
+# on it, are imported on first use or by warm_up(), not at startup
+_parser = None
+
+def get_parser():
+    global _parser
+    if _parser is None:
+        from linebot import WebhookParser
+        _parser = WebhookParser(CHANNEL_SECRET)
+    return _parser
+
+def text_message(text):
+    from linebot.models import TextSendMessage
+    return TextSendMessage(text=text)
+
+def is_text_message(event):
+    from linebot.models import MessageEvent, TextMessage
+    return isinstance(event, MessageEvent) and isinstance(event.message, TextMessage)
+
+
+def event_id(event):
+    return getattr(event, "webhook_event_id", None)
+
+def is_redelivery(event):
+    context = getattr(event, "delivery_context", None)
+    return bool(context and context.is_redelivery)
+
+async def claim_events(events):
+    """Drop events another instance already took (shared dedup store only)."""
+    if deduplicator.store is None:
+        return events
+    claimed = await asyncio.gather(*(run_in_threadpool(deduplicator.claim_shared, event_id(e)) for e in events))
+    return [event for event, ok in zip(events, claimed) if ok]
+
+async def process_event(event):
+    """Route one parsed webhook event to its handler (runs on the event workers)."""
+    if await claim_events([event]):
+        await handle_event(event)
+
+
+async def process_event_batch(events):
+    """Batch mode: handle a whole webhook payload as one job.
+
+    Game commands from every user in the payload go through
+    game_logic.process_batch (one batched get + one batched write); all
+    other events take the normal per-event path.
+    """
+    game_events, throttled_events, other_events = [], [], []
+    for event in await claim_events(events):
+        command = router.resolve(event.message.text.strip()) if is_text_message(event) else None
+        if not isinstance(command, GameCommand):
+            other_events.append(event)
+        elif is_throttled(event.source.user_id, command):
+            throttled_events.append(event)
+        else:
+            game_events.append((event, command))
+
+    replies = [send_reply(event, [text_message(THROTTLED_MESSAGE)]) for event in throttled_events]
+    if game_events:
+        actions = [(event.source.user_id, command.action, command.kwargs) for event, command in game_events]
+        with game_logic.read_counter.track_request(), stage_metrics.timer("command.batch"):
+            messages = await run_in_threadpool(game_logic.process_batch, actions)
+        replies.extend(
+            send_reply(event, command.reply(msg_text))
+            for (event, command), msg_text in zip(game_events, messages)
+        )
+    results = await asyncio.gather(*replies, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Reply error: %s", result, exc_info=result)
+
+    await asyncio.gather(*(handle_event(event) for event in other_events))
+
+async def handle_event(event):
+    if is_text_message(event):
+        with game_logic.read_counter.track_request():
+            await handle_message(event)
+
+
+deduplicator = EventDeduplicator(
+    max_entries=EVENT_DEDUP_MAX_ENTRIES,
+    ttl=EVENT_DEDUP_TTL,
+    store=(SharedEventStore(game_logic.get_storage, EVENT_DEDUP_COLLECTION, ttl=EVENT_DEDUP_TTL)
+           if EVENT_DEDUP_SHARED else None),
+)
+
+def event_flow(event):
+    """Fair-queue flow: the sending user."""
+    source = getattr(event, "source", None)
+    return getattr(source, "user_id", None)
+
+def event_cost(event):
+    """Fair-queue weight: chats hold a worker for a whole Gemini call."""
+    if is_text_message(event) and router.resolve(event.message.text.strip()) is chat_with_rabbit:
+        return FAIR_QUEUE_CHAT_COST
+    return 1.0
+
+event_processor = EventProcessor(
+    process_event_batch if WEBHOOK_BATCH_MODE else process_event,
+    maxsize=EVENT_QUEUE_MAXSIZE,
+    workers=EVENT_WORKERS,
+    drain_timeout=EVENT_DRAIN_TIMEOUT,
+    # batch mode queues whole payloads, which have no single user
+    flow=event_flow if FAIR_QUEUE_ENABLED and not WEBHOOK_BATCH_MODE else None,
+    cost=event_cost,
+)
+
+# Per-user token buckets in front of Gemini and the Firestore-writing commands
+rate_limiters = {
+    "chat": TokenBucketLimiter(RATE_LIMIT_CHAT_RATE, RATE_LIMIT_CHAT_BURST, max_users=RATE_LIMIT_MAX_USERS),
+    "game": TokenBucketLimiter(RATE_LIMIT_GAME_RATE, RATE_LIMIT_GAME_BURST, max_users=RATE_LIMIT_MAX_USERS),
+}
+
+profiler = SlowRequestProfiler(
+    interval=PROFILER_INTERVAL,
+    slow_threshold=PROFILER_SLOW_THRESHOLD,
+    max_profiles=PROFILER_MAX_PROFILES,
+)
+
+MOON_BROADCAST_MESSAGES = {
+    moon_phase.NEW_MOON: "今夜は新月だぴょん🌑\n月が隠れて星がよく見えるよ✨",
+    moon_phase.FULL_MOON: "今夜は満月だぴょん！🌕\n月のうさぎも大はしゃぎ🐰✨",
+}
+
+async def broadcast_moon_phase(phase, when):
+    """Scheduler hook: announce new / full moons to every friend.
+
+    The retry key is derived from the phase instant, so every worker sends
+    the same key and LINE delivers the announcement only once.
+    """
+    retry_key = str(uuid.uuid5(uuid.NAMESPACE_URL, f"moon-rabbit/{moon_phase.PHASE_NAMES[phase]}/{when.isoformat()}"))
+    await line_client.broadcast([text_message(MOON_BROADCAST_MESSAGES[phase])], retry_key=retry_key)
+
+moon_scheduler = moon_phase.MoonPhaseScheduler(
+    lambda: moon_phase.get_table(MOON_TABLE_YEARS), broadcast_moon_phase, phases=MOON_BROADCAST_MESSAGES
+)
+
+
+async def warm_up():
+    """Load the SDKs and open the clients while the server is already listening."""
+    # SDK imports run in a thread so health checks and webhooks are served meanwhile
+    await asyncio.to_thread(game_logic.warm_up)
+    await asyncio.to_thread(importlib.import_module, "aiohttp")
+    await asyncio.to_thread(importlib.import_module, "line_messages")
+    await asyncio.to_thread(get_parser)
+    # The HTTP pool is created inside each worker's own event loop
+    await line_client.start()
+
+
+async def replay_deferred_writes():
+    """Replay greetings / look changes queued while storage was unavailable."""
+    while True:
+        await asyncio.sleep(DEGRADED_REPLAY_INTERVAL)
+        if game_logic.deferred_writes:
+            await run_in_threadpool(game_logic.replay_deferred)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Clients are otherwise created on first use
+    warm_up_task = asyncio.create_task(warm_up()) if STARTUP_WARMUP else None
+    replay_task = asyncio.create_task(replay_deferred_writes()) if CIRCUIT_BREAKER_ENABLED else None
+    await event_processor.start()
+    if PROFILER_ENABLED:
+        profiler.enable()
+    if MOON_BROADCAST_ENABLED:
+        moon_scheduler.start()
+    yield
+    if warm_up_task is not None:
+        warm_up_task.cancel()
+    await moon_scheduler.stop()
+    # Finish already-acknowledged events before the instance goes away
+    await event_processor.stop()
+    if replay_task is not None:
+        replay_task.cancel()
+        # last chance for queued writes (anything still queued is lost)
+        if game_logic.deferred_writes:
+            await run_in_threadpool(game_logic.replay_deferred)
+    if CHAT_MEMORY_ENABLED:
+        await game_logic.flush_chat_memory()
+    await line_client.close()
+    profiler.disable()
+
 
 # Initialize App & LINE API
-app = FastAPI()
-line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(CHANNEL_SECRET)
+app = FastAPI(lifespan=lifespan)
+line_client = AsyncLineClient(
+    CHANNEL_ACCESS_TOKEN,
+    endpoint=LINE_API_ENDPOINT,
+    pool_size=LINE_HTTP_POOL_SIZE,
+    timeout=LINE_HTTP_TIMEOUT,
+    max_retries=LINE_MAX_RETRIES,
+    reply_token_ttl=LINE_REPLY_TOKEN_TTL,
+)
 
 @app.get("/")
 def health_check():
     """Health check endpoint for Cloud Run."""
     return {"status": "OK", "message": "Rabbit Bot is active!"}
 
+@app.get("/metrics")
+def metrics():
+    """Runtime metrics for the event pipeline."""
+    return {
+        "event_queue": event_processor.stats(),
+        "dedup": deduplicator.stats(),
+        "reply_cache": game_logic.reply_cache.stats(),
+        "gemini": dict(game_logic.gemini_stats),
+        "chat_memory": game_logic.chat_memory.stats(),
+        "rate_limit": {name: limiter.stats() for name, limiter in rate_limiters.items()},
+        "leaderboard": game_logic.leaderboard.stats(),
+        "profile_cache": game_logic.profile_cache.stats(),
+        "firestore_reads": game_logic.read_counter.stats(),
+        "batch": dict(game_logic.batch_stats),
+        "writes": dict(game_logic.write_stats),
+        "circuit_breakers": {
+            "gemini": game_logic.gemini_breaker.stats(),
+            "storage": game_logic.storage_breaker.stats(),
+        },
+        "degraded": dict(game_logic.degraded_stats, queued=len(game_logic.deferred_writes)),
+        "line_client": line_client.stats(),
+        "latency": stage_metrics.stats(),
+    }
+
+@app.get("/metrics/profiles")
+def metrics_profiles():
+    """Stack profiles of slow requests (PROFILER_ENABLED=true)."""
+    return profiler.stats()
+
 @app.post("/callback")
-async def callback(request: Request, background_tasks: BackgroundTasks):
-    """Handle the webhook request from LINE."""
+async def callback(request: Request):
+    """Handle the webhook request from LINE.
+
+    Only the signature check happens here; events are queued and processed
+    by the background workers so LINE gets its 200 right away.
+    """
     signature = request.headers["X-Line-Signature"]
     body = await request.body()
     body_decode = body.decode("utf-8")
 
+    from linebot.exceptions import InvalidSignatureError
     try:
-        handler.handle(body_decode, signature)
+        with stage_metrics.timer("webhook.signature"):
+            events = get_parser().parse(body_decode, signature)
     except InvalidSignatureError:
         return "Invalid signature"
+
+    if EVENT_DEDUP_ENABLED:
+        # Redeliveries of events this instance already accepted stop here,
+        # before any Firestore or Gemini work
+        events = [e for e in events if not deduplicator.is_duplicate(event_id(e), is_redelivery(e))]
+        if not events:
+            return "OK"
+
+    try:
+        # In batch mode the whole payload is one queue job
+        event_processor.submit_many([events] if WEBHOOK_BATCH_MODE else events)
+    except QueueFullError as e:
+        # Backpressure: let LINE redeliver instead of silently dropping events
+        logger.warning("Webhook rejected: %s", e)
+        for event in events:
+            deduplicator.forget(event_id(event))
+        return Response(content="Busy", status_code=503)
     return "OK"
 
-@handler.add(MessageEvent, message=TextMessage)
-def handle_message(event):
-    """Main message handler. Routes logic based on user input."""
-    user_id = event.source.user_id
-    text = event.message.text.strip()
+# --- Command handlers: async (user_id, text) -> list of messages to reply ---
+
+class GameCommand:
+    """A command backed by a Firestore-writing game_logic action.
+
+    Kept as data (action + kwargs) so batch mode can group these per payload.
+    """
+
+    def __init__(self, action, suffix="", **kwargs):
+        self.name = action
+        self.action = action
+        self.suffix = suffix
+        self.kwargs = kwargs
 
-    reply_content = []
+    def reply(self, msg_text):
+        return [text_message(msg_text + self.suffix)]
+
+    async def __call__(self, user_id, text):
+        msg_text = await run_in_threadpool(game_logic.run_game_action, user_id, self.action, self.kwargs)
+        return self.reply(msg_text)
+
+async def show_shop(user_id, text):
+    import line_messages
+    return [line_messages.create_shop_message()]
+
+async def show_member_card(user_id, text):
+    try:
+        user_data = await run_in_threadpool(game_logic.get_or_create_user, user_id)
+    except CircuitOpenError:
+        # Degraded: a card from the (possibly stale) cached profile, if there is one
+        user_data = game_logic.profile_cache.get(user_id)
+        if user_data is None:
+            return degraded_reply()
+    import line_messages
+    return [line_messages.create_member_card(user_data)]
+
+async def show_leaderboard(user_id, text):
+    try:
+        boards = await run_in_threadpool(game_logic.get_leaderboard, user_id)
+    except CircuitOpenError:
+        return degraded_reply()
+    import line_messages
+    return [line_messages.create_leaderboard_message(user_id, boards)]
+
+def degraded_reply():
+    game_logic.degraded_stats["degraded_replies"] += 1
+    return [text_message(game_logic.DEGRADED_MESSAGE)]
+
+async def good_night(user_id, text):
+    moon_emoji = game_logic.get_moon_info()
+    return [
+        text_message(
+            f"おやすみなさいだうさ〜🐰💤\n\n今日の月は【 {moon_emoji} 】だぴょん！\nゆっくり休んでね✨"
+        )
+    ]
+
+THROTTLED_MESSAGE = "ちょっと待ってほしいぴょん…🐰💦\n少し時間をおいてから話しかけてね！"
+
+async def throttled_reply(user_id, text):
+    # Canned: no Firestore or Gemini call for users over their rate limit
+    return [text_message(THROTTLED_MESSAGE)]
+
+async def chat_with_rabbit(user_id, text):
+    # If no commands matched, chat with the AI persona
+    reply_text = await game_logic.get_gemini_reply_async(text, user_id=user_id)
+    return [text_message(reply_text)]
+
+def rate_limit_class(command):
+    """Which rate limiter applies to a command (None: not limited)."""
+    if command is chat_with_rabbit:
+        return "chat"
+    if isinstance(command, GameCommand):
+        return "game"
+    return None
+
+def is_throttled(user_id, command):
+    if not RATE_LIMIT_ENABLED:
+        return False
+    limit = rate_limit_class(command)
+    return limit is not None and not rate_limiters[limit].allow(user_id)
+
+def command_name(command):
+    """Label used for the per-command latency histograms."""
+    return getattr(command, "name", None) or command.__name__
+
+def build_router():
+    """Register every command once; shop commands come from SHOP_ITEMS."""
+    router = CommandRouter(fallback=chat_with_rabbit)
 
     # --- 1. Daily Streak / Morning Greeting ---
-    if "おはよう" in text:
-        msg_text = game_logic.process_morning_greeting(user_id)
-        reply_content.append(TextSendMessage(text=msg_text))
+    router.add_keyword("おはよう", GameCommand("morning_greeting"))
 
     # --- 2. Shop & Item Display ---
-    elif text == "ショップ":
-        reply_content.append(line_messages.create_shop_message())
-
-    elif text == "会員証":
-        user_data, _ = game_logic.get_or_create_user(user_id)
-        reply_content.append(line_messages.create_member_card(user_data))
-
-    # --- 3. Purchase Logic ---
-    elif text == "身代わり人形を買う":
-        msg_text = game_logic.process_purchase(user_id, "substitute_doll", 5, "身代わり人形🧸")
-        reply_content.append(TextSendMessage(text=msg_text))
-
-    elif text == "サングラスを買う":
-        msg_text = game_logic.process_purchase(user_id, "sunglasses", 10, "サングラス🕶️")
-        reply_content.append(TextSendMessage(text=msg_text + "\n「サングラス装着」と送ると着替えるよ！"))
-
-    elif text == "ピンク染め粉を買う":
-        msg_text = game_logic.process_purchase(user_id, "pink_dye", 20, "魔法のピンク染め粉🎨")
-        reply_content.append(TextSendMessage(text=msg_text + "\n「ピンクに変身」と送ると着替えるよ！"))
-
-    # --- 4. Change Appearance Logic ---
-    elif text == "ピンクに変身":
-        msg_text = game_logic.process_change_look(
-            user_id,
-            "pink",
-            "pink_dye",
-            "✨キラキラ〜✨\nピンク色に変身しました！🐰🎀",
-            "まだ染め粉を持ってないよ！"
-        )
-        reply_content.append(TextSendMessage(text=msg_text))
-
-    elif text == "サングラス装着":
-        msg_text = game_logic.process_change_look(
-            user_id,
-            "sunglasses",
-            "sunglasses",
-            "シャキーン！😎\nサングラスをかけました！",
-            "まだサングラスを持ってないよ！"
-        )
-        reply_content.append(TextSendMessage(text=msg_text))
+    router.add_exact("ショップ", show_shop)
+    router.add_exact("会員証", show_member_card)
+    if LEADERBOARD_ENABLED:
+        router.add_exact("ランキング", show_leaderboard)
 
-    elif text == "元に戻す":
-        # resetting to normal doesn't require an item
-        msg_text = game_logic.process_change_look(
-            user_id, "normal", None, "ポンッ💨\n元の姿に戻りました！🐰", ""
-        )
-        reply_content.append(TextSendMessage(text=msg_text))
+    # --- 3. Purchase Logic & 4. Change Appearance Logic ---
+    for item_key, item in SHOP_ITEMS.items():
+        router.add_exact(item["buy_command"], GameCommand("purchase", suffix=item["buy_hint"], item_key=item_key))
+        look = item["look"]
+        if look:
+            router.add_exact(look["command"], GameCommand(
+                "change_look",
+                look_key=look["key"],
+                item_req=item_key,
+                message_success=look["success"],
+                message_fail=look["fail"],
+            ))
+    # resetting to normal doesn't require an item
+    router.add_exact("元に戻す", GameCommand(
+        "change_look",
+        look_key="normal",
+        item_req=None,
+        message_success="ポンッ💨\n元の姿に戻りました！🐰",
+        message_fail="",
+    ))
 
     # --- 5. Moon Phase / Good Night ---
-    elif "おやすみ" in text:
-        moon_emoji = game_logic.get_moon_info()
-        reply_content.append(
-            TextSendMessage(
-                text=f"おやすみなさいだうさ〜🐰💤\n\n今日の月は【 {moon_emoji} 】だぴょん！\nゆっくり休んでね✨"
-            )
-        )
+    router.add_keyword("おやすみ", good_night)
 
     # --- 6. Fallback: Chat with Gemini ---
-    else:
-        # If no commands matched, chat with the AI persona
-        reply_text = game_logic.get_gemini_reply(text)
-        reply_content.append(TextSendMessage(text=reply_text))
+    return router
+
+router = build_router()
+
+async def handle_message(event):
+    """Main message handler. Routes logic based on user input.
+
+    Blocking Firestore calls go to the thread pool so the event loop stays
+    free for other webhooks; Gemini and LINE use native async clients.
+    """
+    user_id = event.source.user_id
+    text = event.message.text.strip()
+
+    with stage_metrics.timer("dispatch"):
+        command = router.resolve(text)
+        if is_throttled(user_id, command):
+            command = throttled_reply
+    name = command_name(command)
+
+    with profiler.request(name), stage_metrics.timer(f"command.{name}"):
+        reply_content = await command(user_id, text)
 
-    # Send the replies
-    if reply_content:
-        line_bot_api.reply_message(event.reply_token, reply_content)
+        # Send the replies
+        if reply_content:
+            await send_reply(event, reply_content)
 
+async def send_reply(event, messages):
+    """Reply through the pooled client; retries stop when the reply token expires."""
+    with stage_metrics.timer("line.reply"):
+        await line_client.reply_message(event.reply_token, messages, received_at=event.timestamp / 1000)
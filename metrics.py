@@ -0,0 +1,217 @@
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, deque
+from contextlib import contextmanager
+
+# Bucket upper bounds in seconds: 0.1ms doubling every 4 buckets (~19% apart) up to ~2 min
+BUCKET_BOUNDS = tuple(0.0001 * 2 ** (i / 4) for i in range(82))
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram: O(log buckets) observe, constant memory.
+
+    Percentiles are reported as the upper bound of the bucket that holds
+    the requested rank (at most ~19% high), capped by the observed max.
+    """
+
+    def __init__(self, bounds=BUCKET_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect_left(self.bounds, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, pct):
+        with self._lock:
+            counts, count, largest = list(self.counts), self.count, self.max
+        if not count:
+            return 0.0
+        rank = max(1, int(round(pct / 100 * count)))
+        seen = 0
+        for index, bucket in enumerate(counts):
+            seen += bucket
+            if seen >= rank:
+                bound = self.bounds[index] if index < len(self.bounds) else largest
+                return min(bound, largest)
+        return largest
+
+    def summary(self):
+        count = self.count
+        return {
+            "count": count,
+            "avg_ms": round(self.total / count * 1000, 3) if count else 0.0,
+            "p50_ms": round(self.percentile(50) * 1000, 3),
+            "p95_ms": round(self.percentile(95) * 1000, 3),
+            "p99_ms": round(self.percentile(99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+class StageMetrics:
+    """Per-stage latency histograms plus plain event counters.
+
+    Stage names are dotted strings ("firestore.get", "command.purchase");
+    histograms are created on first use.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self._histograms = {}
+        self._counters = Counter()
+        self._lock = threading.Lock()
+
+    def histogram(self, stage):
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(stage, LatencyHistogram())
+        return histogram
+
+    def observe(self, stage, seconds):
+        if self.enabled:
+            self.histogram(stage).observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        """Time the block; failures are timed too (and counted as <stage>.error)."""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.incr(f"{stage}.error")
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self._counters = Counter()
+
+    def stats(self):
+        return {
+            "stages": {stage: h.summary() for stage, h in sorted(self._histograms.items())},
+            "counters": dict(self._counters),
+        }
+
+
+def _collapse(frame, max_depth=40):
+    """Frame -> "file:function;file:function;..." (outermost first)."""
+    names = []
+    while frame is not None and len(names) < max_depth:
+        code = frame.f_code
+        names.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SlowRequestProfiler:
+    """Opt-in sampling profiler that keeps stack profiles of slow requests.
+
+    While enabled, a daemon thread samples every thread's stack with
+    sys._current_frames() each `interval` seconds, but only while at least
+    one request is being tracked. Samples are attributed to every request
+    in flight at that moment (the process is shared, so a profile shows
+    what the worker was doing during the request). Requests that took
+    `slow_threshold` seconds or more keep their collapsed stacks; faster
+    ones are discarded.
+    """
+
+    def __init__(self, interval=0.005, slow_threshold=1.0, max_profiles=20, top_stacks=25):
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self.top_stacks = top_stacks
+        self.profiles = deque(maxlen=max_profiles)
+        self.samples = 0
+        self._active = {}  # token -> Counter of collapsed stacks
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def enabled(self):
+        return self._thread is not None
+
+    def enable(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="slow-request-profiler", daemon=True)
+        self._thread.start()
+
+    def disable(self):
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+        with self._lock:
+            self._active.clear()
+
+    @contextmanager
+    def request(self, name):
+        if self._thread is None:
+            yield
+            return
+        token = object()
+        stacks = Counter()
+        with self._lock:
+            self._active[token] = stacks
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._active.pop(token, None)
+            if elapsed >= self.slow_threshold:
+                self.profiles.append({
+                    "name": name,
+                    "duration_ms": round(elapsed * 1000, 1),
+                    "samples": sum(stacks.values()),
+                    "stacks": [f"{stack} {count}" for stack, count in stacks.most_common(self.top_stacks)],
+                })
+
+    def sample(self):
+        """Take one sample of all threads (except the profiler's own)."""
+        with self._lock:
+            if not self._active:
+                return
+            counters = list(self._active.values())
+        own = threading.get_ident()
+        stacks = [_collapse(frame) for thread_id, frame in sys._current_frames().items() if thread_id != own]
+        self.samples += 1
+        for counter in counters:
+            counter.update(stacks)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "interval_ms": self.interval * 1000,
+            "slow_threshold_ms": self.slow_threshold * 1000,
+            "samples": self.samples,
+            "profiles": list(self.profiles),
+        }
+
+
+# Process-wide registry shared by main, game_logic and line_messages
+stage_metrics = StageMetrics()
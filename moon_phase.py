@@ -0,0 +1,264 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+NEW_MOON, FIRST_QUARTER, FULL_MOON, LAST_QUARTER = range(4)
+PHASE_NAMES = ("new_moon", "first_quarter", "full_moon", "last_quarter")
+
+# Emoji shown at (around) each principal phase, and between it and the next one
+PRINCIPAL_LABELS = ("🌑 (新月)", "🌓 (上弦の月)", "🌕 (満月)", "🌗 (下弦の月)")
+BETWEEN_LABELS = ("🌒 (三日月)", "🌔 (十三夜)", "🌖 (寝待月)", "🌘 (有明月)")
+# Half-width (days) of the window in which a principal phase label is used
+PRINCIPAL_WINDOW_DAYS = (1.0, 1.5, 1.0, 1.5)
+
+DAY = 86400.0
+UNIX_EPOCH_JD = 2440587.5
+
+# --- Meeus, Astronomical Algorithms (2nd ed.), chapter 49 ---
+# Periodic terms: (coefficient, power of E, multipliers of M, M', F, Omega)
+_NEW_MOON_TERMS = (
+    (-0.40720, 0, 0, 1, 0, 0), (0.17241, 1, 1, 0, 0, 0), (0.01608, 0, 0, 2, 0, 0),
+    (0.01039, 0, 0, 0, 2, 0), (0.00739, 1, -1, 1, 0, 0), (-0.00514, 1, 1, 1, 0, 0),
+    (0.00208, 2, 2, 0, 0, 0), (-0.00111, 0, 0, 1, -2, 0), (-0.00057, 0, 0, 1, 2, 0),
+    (0.00056, 1, 1, 2, 0, 0), (-0.00042, 0, 0, 3, 0, 0), (0.00042, 1, 1, 0, 2, 0),
+    (0.00038, 1, 1, 0, -2, 0), (-0.00024, 1, -1, 2, 0, 0), (-0.00017, 0, 0, 0, 0, 1),
+    (-0.00007, 0, 2, 1, 0, 0), (0.00004, 0, 0, 2, -2, 0), (0.00004, 0, 3, 0, 0, 0),
+    (0.00003, 0, 1, 1, -2, 0), (0.00003, 0, 0, 2, 2, 0), (-0.00003, 0, 1, 1, 2, 0),
+    (0.00003, 0, -1, 1, 2, 0), (-0.00002, 0, -1, 1, -2, 0), (-0.00002, 0, 1, 3, 0, 0),
+    (0.00002, 0, 0, 4, 0, 0),
+)
+_FULL_MOON_TERMS = (
+    (-0.40614, 0, 0, 1, 0, 0), (0.17302, 1, 1, 0, 0, 0), (0.01614, 0, 0, 2, 0, 0),
+    (0.01043, 0, 0, 0, 2, 0), (0.00734, 1, -1, 1, 0, 0), (-0.00515, 1, 1, 1, 0, 0),
+    (0.00209, 2, 2, 0, 0, 0), (-0.00111, 0, 0, 1, -2, 0), (-0.00057, 0, 0, 1, 2, 0),
+    (0.00056, 1, 1, 2, 0, 0), (-0.00042, 0, 0, 3, 0, 0), (0.00042, 1, 1, 0, 2, 0),
+    (0.00038, 1, 1, 0, -2, 0), (-0.00024, 1, -1, 2, 0, 0), (-0.00017, 0, 0, 0, 0, 1),
+) + _NEW_MOON_TERMS[15:]
+_QUARTER_TERMS = (
+    (-0.62801, 0, 0, 1, 0, 0), (0.17172, 1, 1, 0, 0, 0), (-0.01183, 1, 1, 1, 0, 0),
+    (0.00862, 0, 0, 2, 0, 0), (0.00804, 0, 0, 0, 2, 0), (0.00454, 1, -1, 1, 0, 0),
+    (0.00204, 2, 2, 0, 0, 0), (-0.00180, 0, 0, 1, -2, 0), (-0.00070, 0, 0, 1, 2, 0),
+    (-0.00040, 0, 0, 3, 0, 0), (-0.00034, 1, -1, 2, 0, 0), (0.00032, 1, 1, 0, 2, 0),
+    (0.00032, 1, 1, 0, -2, 0), (-0.00028, 2, 2, 1, 0, 0), (0.00027, 1, 1, 2, 0, 0),
+    (-0.00017, 0, 0, 0, 0, 1), (-0.00005, 0, -1, 1, -2, 0), (0.00004, 0, 0, 2, 2, 0),
+    (-0.00004, 0, 1, 1, 2, 0), (0.00004, 0, -2, 1, 0, 0), (0.00003, 0, 1, 1, -2, 0),
+    (0.00003, 0, 3, 0, 0, 0), (0.00002, 0, 0, 2, -2, 0), (0.00002, 0, -1, 1, 2, 0),
+    (-0.00002, 0, 1, 3, 0, 0),
+)
+# Planetary arguments A1..A14: (constant, k coefficient, T^2 coefficient, correction amplitude)
+_PLANETARY_TERMS = (
+    (299.77, 0.107408, -0.009173, 0.000325), (251.88, 0.016321, 0, 0.000165),
+    (251.83, 26.651886, 0, 0.000164), (349.42, 36.412478, 0, 0.000126),
+    (84.66, 18.206239, 0, 0.000110), (141.74, 53.303771, 0, 0.000062),
+    (207.14, 2.453732, 0, 0.000060), (154.84, 7.306860, 0, 0.000056),
+    (34.52, 27.261239, 0, 0.000047), (207.19, 0.121824, 0, 0.000042),
+    (291.34, 1.844379, 0, 0.000040), (161.72, 24.198154, 0, 0.000037),
+    (239.56, 25.513099, 0, 0.000035), (331.55, 3.592518, 0, 0.000023),
+)
+
+
+def phase_jde(k, phase):
+    """Julian Ephemeris Day of a principal phase.
+
+    k: lunation number (0 = the new moon of 2000-01-06); phase: NEW_MOON ..
+    LAST_QUARTER. Accurate to well under a minute for 1900-2100.
+    """
+    k = k + phase / 4
+    t = k / 1236.85
+    jde = (2451550.09766 + 29.530588861 * k + 0.00015437 * t ** 2
+           - 0.000000150 * t ** 3 + 0.00000000073 * t ** 4)
+    e = 1 - 0.002516 * t - 0.0000074 * t ** 2
+    m = math.radians(2.5534 + 29.10535670 * k - 0.0000014 * t ** 2 - 0.00000011 * t ** 3)
+    mp = math.radians(201.5643 + 385.81693528 * k + 0.0107582 * t ** 2
+                      + 0.00001238 * t ** 3 - 0.000000058 * t ** 4)
+    f = math.radians(160.7108 + 390.67050284 * k - 0.0016118 * t ** 2
+                     - 0.00000227 * t ** 3 + 0.000000011 * t ** 4)
+    omega = math.radians(124.7746 - 1.56375588 * k + 0.0020672 * t ** 2 + 0.00000215 * t ** 3)
+
+    terms = (_NEW_MOON_TERMS, _QUARTER_TERMS, _FULL_MOON_TERMS, _QUARTER_TERMS)[phase]
+    for coef, e_power, cm, cmp, cf, comega in terms:
+        jde += coef * e ** e_power * math.sin(cm * m + cmp * mp + cf * f + comega * omega)
+
+    if phase in (FIRST_QUARTER, LAST_QUARTER):
+        w = (0.00306 - 0.00038 * e * math.cos(m) + 0.00026 * math.cos(mp)
+             - 0.00002 * math.cos(mp - m) + 0.00002 * math.cos(mp + m) + 0.00002 * math.cos(2 * f))
+        jde += w if phase == FIRST_QUARTER else -w
+
+    for constant, k_coef, t2_coef, coef in _PLANETARY_TERMS:
+        jde += coef * math.sin(math.radians(constant + k_coef * k + t2_coef * t ** 2))
+    return jde
+
+
+def delta_t(year):
+    """TT - UT in seconds (Espenak & Meeus polynomial fits)."""
+    if year < 2005:
+        t = year - 2000
+        return 63.86 + 0.3345 * t - 0.060374 * t ** 2 + 0.0017275 * t ** 3 + 0.000651814 * t ** 4 + 0.00002373599 * t ** 5
+    if year < 2050:
+        t = year - 2000
+        return 62.92 + 0.32217 * t + 0.005589 * t ** 2
+    u = (year - 1820) / 100
+    return -20 + 32 * u ** 2 - 0.5628 * (2150 - year)
+
+
+def jde_to_timestamp(jde):
+    """Ephemeris Julian Day -> Unix timestamp (UTC)."""
+    year = 2000 + (jde - 2451545.0) / 365.25
+    return (jde - UNIX_EPOCH_JD) * DAY - delta_t(year)
+
+
+def _timestamp(when):
+    if when is None:
+        return time.time()
+    if isinstance(when, datetime):
+        return when.timestamp()
+    return float(when)
+
+
+class MoonPhaseTable:
+    """Principal phase instants for a range of years, searched with bisect.
+
+    Entries are stored in a flat array of Unix timestamps starting at a new
+    moon, so entry i is phase i % 4 and the table costs 8 bytes per phase
+    (about 400 bytes a year). Lookups are O(log n).
+    """
+
+    def __init__(self, start_year, end_year):
+        k = math.floor((start_year - 2000) * 12.3685) - 1
+        end = datetime(end_year + 1, 1, 1, tzinfo=timezone.utc).timestamp()
+        self.times = array("d")
+        while True:
+            for phase in range(4):
+                self.times.append(jde_to_timestamp(phase_jde(k, phase)))
+            if self.times[-1] > end:
+                break
+            k += 1
+        self.start = self.times[0]
+        self.end = self.times[-1]
+
+    def _index(self, ts):
+        """Index of the last phase instant at or before ts."""
+        index = bisect_right(self.times, ts) - 1
+        if index < 0 or index >= len(self.times) - 1:
+            raise ValueError(f"{datetime.fromtimestamp(ts, timezone.utc)} is outside the moon phase table")
+        return index
+
+    def moon_age(self, when=None):
+        """Days since the previous new moon."""
+        ts = _timestamp(when)
+        index = self._index(ts)
+        return (ts - self.times[index - index % 4]) / DAY
+
+    def describe(self, when=None):
+        """Phase label ("🌕 (満月)" etc.) for the given time (default: now)."""
+        ts = _timestamp(when)
+        index = self._index(ts)
+        since = ts - self.times[index]
+        until = self.times[index + 1] - ts
+        nearest, distance = (index % 4, since) if since <= until else ((index + 1) % 4, until)
+        if distance <= PRINCIPAL_WINDOW_DAYS[nearest] * DAY:
+            return PRINCIPAL_LABELS[nearest]
+        return BETWEEN_LABELS[index % 4]
+
+    def next_phase(self, phase, when=None):
+        """Timestamp of the first `phase` instant strictly after `when`."""
+        ts = _timestamp(when)
+        index = bisect_right(self.times, ts)
+        index += (phase - index) % 4
+        if index >= len(self.times):
+            raise ValueError("Next phase is beyond the moon phase table")
+        return self.times[index]
+
+    def next_transition(self, phases=(NEW_MOON, FIRST_QUARTER, FULL_MOON, LAST_QUARTER), when=None):
+        """(timestamp, phase) of the next instant of any of `phases`."""
+        return min((self.next_phase(phase, when), phase) for phase in phases)
+
+    def next_full_moon(self, when=None):
+        return datetime.fromtimestamp(self.next_phase(FULL_MOON, when), timezone.utc)
+
+    def next_new_moon(self, when=None):
+        return datetime.fromtimestamp(self.next_phase(NEW_MOON, when), timezone.utc)
+
+
+_table = None
+_table_lock = threading.Lock()
+
+
+def get_table(years_ahead=30):
+    """Process-wide table covering last year to `years_ahead` years ahead."""
+    global _table
+    if _table is None:
+        with _table_lock:
+            if _table is None:
+                this_year = datetime.now(timezone.utc).year
+                _table = MoonPhaseTable(this_year - 1, this_year + years_ahead)
+    return _table
+
+
+class MoonPhaseScheduler:
+    """Calls `await callback(phase, when)` at each principal phase instant.
+
+    `table` may also be a zero-argument callable, so the table is only built
+    when the scheduler starts. Sleeps are capped at `max_sleep` so clock
+    adjustments (or a suspended instance) are picked up; a phase that is
+    already past when the loop wakes up is still delivered once.
+    """
+
+    def __init__(self, table, callback, phases=(NEW_MOON, FULL_MOON), clock=time.time, max_sleep=3600):
+        self.table = table
+        self.callback = callback
+        self.phases = tuple(phases)
+        self.clock = clock
+        self.max_sleep = max_sleep
+        self.fired = 0
+        self._task = None
+
+    def start(self):
+        if callable(self.table):
+            self.table = self.table()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def _next_transition(self):
+        """next_transition(), rebuilding the table (same span, from now) once it runs out."""
+        now = self.clock()
+        try:
+            return self.table.next_transition(self.phases, now)
+        except ValueError:
+            year = datetime.fromtimestamp(now, timezone.utc).year
+            years = max(1, round((self.table.end - self.table.start) / (365.25 * 86400)))
+            logger.warning("Moon phase table ends before %s; rebuilding it for %d-%d",
+                           datetime.fromtimestamp(now, timezone.utc), year - 1, year + years)
+            self.table = MoonPhaseTable(year - 1, year + years)
+            return self.table.next_transition(self.phases, now)
+
+    async def _run(self):
+        while True:
+            try:
+                ts, phase = self._next_transition()
+            except ValueError:
+                logger.exception("Moon phase scheduler stopped: no next phase")
+                return
+            while (delay := ts - self.clock()) > 0:
+                await asyncio.sleep(min(delay, self.max_sleep))
+            self.fired += 1
+            try:
+                await self.callback(phase, datetime.fromtimestamp(ts, timezone.utc))
+            except Exception:
+                logger.exception("Moon phase callback failed for %s", PHASE_NAMES[phase])
@@ -0,0 +1,71 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucketLimiter:
+    """Per-user token buckets: `rate` tokens per second, up to `burst`.
+
+    Each user is one (tokens, updated_at) tuple in an LRU. A bucket left
+    alone for burst / rate seconds is full again, so idle users are dropped
+    after that (or `idle_ttl`, if longer) without changing any decision;
+    `max_users` caps memory if a flood of distinct IDs arrives faster.
+    """
+
+    def __init__(self, rate=1.0, burst=10.0, idle_ttl=0.0, max_users=100000, clock=time.monotonic):
+        if rate <= 0:
+            # 0 would mean "never refill"; turn limiting off with RATE_LIMIT_ENABLED=false
+            raise ValueError(f"TokenBucketLimiter rate must be > 0 tokens/s, got {rate}")
+        self.rate = rate
+        self.burst = burst
+        self.idle_ttl = max(idle_ttl, burst / rate)
+        self.max_users = max_users
+        self.clock = clock
+        self.allowed = 0
+        self.throttled = 0
+        self.evicted = 0
+        self._buckets = OrderedDict()  # user_id -> (tokens, updated_at), least recently seen first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def allow(self, user_id, cost=1.0):
+        """Take `cost` tokens from the user's bucket; False if there aren't enough."""
+        now = self.clock()
+        with self._lock:
+            bucket = self._buckets.pop(user_id, None)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            ok = tokens >= cost
+            if ok:
+                tokens -= cost
+                self.allowed += 1
+            else:
+                self.throttled += 1
+            self._buckets[user_id] = (tokens, now)
+            self._evict(now)
+        return ok
+
+    def _evict(self, now):
+        buckets = self._buckets
+        while buckets:
+            user_id, (_, updated_at) = next(iter(buckets.items()))
+            if len(buckets) <= self.max_users and now - updated_at < self.idle_ttl:
+                break
+            del buckets[user_id]
+            self.evicted += 1
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def stats(self):
+        return {
+            "users": len(self._buckets),
+            "allowed": self.allowed,
+            "throttled": self.throttled,
+            "evicted": self.evicted,
+        }
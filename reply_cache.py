@@ -0,0 +1,134 @@
+import hashlib
+import random
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# Trailing punctuation / symbols that don't change the meaning of a greeting.
+# "?" (a question is not the statement) and "ー" (part of words like コーヒー) are kept.
+_TRAILING_NOISE = re.compile(r"[\s!！。、.,〜~♪☆★]+$")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    """Normalize chat input so 'おはよう！' and 'おはよう〜' share a cache key."""
+    text = unicodedata.normalize("NFKC", text).lower().strip()
+    text = _SPACES.sub(" ", text)
+    return _TRAILING_NOISE.sub("", text)
+
+
+class ReplyCacheBackend:
+    """Storage interface for cached replies.
+
+    Implementations keep up to N reply variants per key. The in-process
+    backend below is the default; a shared backend (e.g. Redis) only needs
+    these three methods.
+    """
+
+    def get_variants(self, key):
+        raise NotImplementedError
+
+    def add_variant(self, key, reply, max_variants):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class InMemoryReplyCache(ReplyCacheBackend):
+    """Thread-safe LRU of reply variants with a per-key TTL."""
+
+    def __init__(self, max_entries=1024, ttl=3600.0, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires_at, [variants])
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_variants(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return list(entry[1])
+
+    def add_variant(self, key, reply, max_variants):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self.clock():
+                entry = (self.clock() + self.ttl, [])
+                self._entries[key] = entry
+            variants = entry[1]
+            # Duplicates are kept: a deterministic model still fills the key
+            if len(variants) < max_variants:
+                variants.append(reply)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class ReplyCache:
+    """Cache in front of Gemini for short, repeated chat inputs.
+
+    A key only starts serving hits once `variants` replies have been
+    collected for it, and hits pick one at random so stock phrases don't
+    always get the exact same answer.
+    """
+
+    def __init__(self, backend, system_instruction, variants=3, max_input_chars=20):
+        self.backend = backend
+        self.variants = variants
+        self.max_input_chars = max_input_chars
+        self._instruction_hash = hashlib.sha256(system_instruction.encode("utf-8")).hexdigest()[:16]
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def make_key(self, text):
+        """Cache key for the input, or None if it is too long to be worth caching."""
+        normalized = normalize_text(text)
+        if not normalized or len(normalized) > self.max_input_chars:
+            return None
+        return f"{self._instruction_hash}:{normalized}"
+
+    def lookup(self, text):
+        key = self.make_key(text)
+        if key is None:
+            self.bypassed += 1
+            return None
+        variants = self.backend.get_variants(key)
+        if variants and len(variants) >= self.variants:
+            self.hits += 1
+            return random.choice(variants)
+        self.misses += 1
+        return None
+
+    def store(self, text, reply):
+        key = self.make_key(text)
+        if key is not None and reply:
+            self.backend.add_variant(key, reply, self.variants)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": len(self.backend) if hasattr(self.backend, "__len__") else None,
+        }
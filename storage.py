@@ -0,0 +1,498 @@
+"""Storage backends behind game_logic.
+
+Documents are dicts addressed by (collection, key); a collection may be a
+path under another document ("rabbit_gamers/U1/chat_memory"). Every
+backend gives the same guarantees:
+
+- get() / get_many() return Document(key, data, version), data None if absent
+- create() writes only if the document does not exist yet
+- transact() runs a read-modify-write of one document atomically; the
+  function may be called again if the document changed meanwhile, so it
+  must not have side effects
+- write_many() applies a list of Writes atomically; a Write with a
+  version only succeeds while the document is still at that version.
+  commit() does the same and returns the new versions (None on conflict),
+  so a caller can guard its next write without reading again
+- scan_page() pages through a collection in key order, resuming after
+  the last key of the previous page
+
+Field values may be DELETE (drop the field) or Increment(n).
+
+Backends: Firestore (production), in-memory (tests, local load tests) and
+SQLite in WAL mode (local runs that keep their data, several processes).
+"""
+import heapq
+import itertools
+import json
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import NamedTuple
+
+# Field value: remove this field from the document
+DELETE = object()
+
+
+class Increment:
+    """Field value: add `value` to the stored number (0 if unset)."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return f"Increment({self.value})"
+
+
+class Document(NamedTuple):
+    key: str
+    data: dict = None
+    version: object = None  # opaque; pass back in Write.version as a precondition
+
+    @property
+    def exists(self):
+        return self.data is not None
+
+
+class Write:
+    """One document write.
+
+    op: "set" (replace), "merge" (nested maps merged key by key), "update"
+    (top-level fields; the document must exist) or "create" (must not exist).
+    """
+
+    __slots__ = ("op", "collection", "key", "data", "version")
+
+    def __init__(self, op, collection, key, data, version=None):
+        if op not in ("set", "merge", "update", "create"):
+            raise ValueError(f"Unknown write op: {op}")
+        self.op = op
+        self.collection = collection
+        self.key = key
+        self.data = data
+        self.version = version
+
+    def __repr__(self):
+        return f"Write({self.op!r}, {self.collection!r}, {self.key!r}, {self.data!r})"
+
+
+class StorageConflict(Exception):
+    """A write precondition failed: changed, already existing or missing document."""
+
+
+def create_backend(name, firestore_client=None, sqlite_path="moon_rabbit.db"):
+    """Backend by STORAGE_BACKEND name; firestore_client is a client factory."""
+    if name == "firestore":
+        return FirestoreBackend(firestore_client)
+    if name == "memory":
+        return InMemoryBackend()
+    if name == "sqlite":
+        return SQLiteBackend(sqlite_path)
+    raise ValueError(f"Unknown storage backend: {name}")
+
+
+# --- Write semantics shared by the in-process backends ---
+
+def _value(current, value):
+    if isinstance(value, Increment):
+        return (current if isinstance(current, (int, float)) else 0) + value.value
+    if isinstance(value, dict):
+        return {name: _value(None, v) for name, v in value.items() if v is not DELETE}
+    if isinstance(value, list):
+        return [_value(None, v) for v in value]
+    return value
+
+
+def _merge(current, data):
+    merged = dict(current)
+    for name, value in data.items():
+        if value is DELETE:
+            merged.pop(name, None)
+        elif isinstance(value, dict):
+            nested = merged.get(name)
+            merged[name] = _merge(nested if isinstance(nested, dict) else {}, value)
+        else:
+            merged[name] = _value(merged.get(name), value)
+    return merged
+
+
+def apply_write(current, write):
+    """Document data after `write` (current None: absent). Raises StorageConflict."""
+    if write.op == "create":
+        if current is not None:
+            raise StorageConflict(f"Document already exists: {write.collection}/{write.key}")
+        return _value(None, write.data)
+    if write.op == "set":
+        return _value(None, write.data)
+    if write.op == "merge":
+        return _merge(current or {}, write.data)
+    if current is None:
+        raise StorageConflict(f"No document to update: {write.collection}/{write.key}")
+    data = dict(current)
+    for name, value in write.data.items():
+        if value is DELETE:
+            data.pop(name, None)
+        else:
+            data[name] = _value(data.get(name), value)
+    return data
+
+
+def _stage(writes, read):
+    """Apply writes in order on top of read((collection, key)) -> (data, version).
+
+    Version preconditions are checked against the stored version. Returns
+    {(collection, key): data}; raises StorageConflict before anything is stored.
+    """
+    staged = {}
+    for write in writes:
+        doc_key = (write.collection, write.key)
+        if doc_key not in staged:
+            staged[doc_key] = read(doc_key)
+        current, version = staged[doc_key]
+        if write.version is not None and version != write.version:
+            raise StorageConflict(f"Document changed: {write.collection}/{write.key}")
+        staged[doc_key] = (apply_write(current, write), version)
+    return {doc_key: data for doc_key, (data, _) in staged.items()}
+
+
+def _copy(value):
+    if isinstance(value, dict):
+        return {name: _copy(v) for name, v in value.items()}
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
+
+
+def _top(docs, field, limit):
+    ranked = [doc for doc in docs if isinstance(doc.data.get(field), (int, float))]
+    return heapq.nlargest(limit, ranked, key=lambda doc: doc.data[field])
+
+
+class InMemoryBackend:
+    """Dict of documents behind one lock; versions are a global counter."""
+
+    name = "memory"
+
+    def __init__(self):
+        self._docs = {}  # (collection, key) -> (data, version)
+        self._versions = itertools.count(1)
+        self._lock = threading.RLock()
+
+    def warm_up(self):
+        pass
+
+    def _read(self, doc_key):
+        return self._docs.get(doc_key, (None, None))
+
+    def get(self, collection, key):
+        with self._lock:
+            data, version = self._read((collection, key))
+        return Document(key, _copy(data), version)
+
+    def get_many(self, collection, keys):
+        return {key: self.get(collection, key) for key in keys}
+
+    def create(self, collection, key, data):
+        return self.write_many([Write("create", collection, key, data)])
+
+    def transact(self, collection, key, func, max_attempts=5):
+        # One lock serialises everything, so the first attempt always commits
+        with self._lock:
+            result, writes = func(self.get(collection, key))
+            self._commit(writes)
+        return result
+
+    def write_many(self, writes):
+        return self.commit(writes) is not None
+
+    def commit(self, writes):
+        with self._lock:
+            try:
+                return self._commit(writes)
+            except StorageConflict:
+                return None
+
+    def _commit(self, writes):
+        versions = {}
+        for doc_key, data in _stage(writes, self._read).items():
+            versions[doc_key] = next(self._versions)
+            self._docs[doc_key] = (data, versions[doc_key])
+        return versions
+
+    def top(self, collection, field, limit):
+        """Documents with the highest numeric `field`, best first (scans the collection)."""
+        return _top(self.scan(collection), field, limit)
+
+    def scan(self, collection):
+        with self._lock:
+            return [Document(key, _copy(data), version)
+                    for (name, key), (data, version) in self._docs.items() if name == collection]
+
+    def scan_page(self, collection, after=None, limit=1000):
+        """Up to `limit` documents with keys after `after`, in key order (scans the collection)."""
+        with self._lock:
+            keys = heapq.nsmallest(limit, (key for name, key in self._docs
+                                           if name == collection and (after is None or key > after)))
+            return [self.get(collection, key) for key in keys]
+
+    def clear(self):
+        with self._lock:
+            self._docs.clear()
+
+
+class SQLiteBackend:
+    """One table of JSON documents in a SQLite database in WAL mode.
+
+    Each thread (and each forked worker) gets its own connection. transact()
+    and write_many() run in BEGIN IMMEDIATE transactions, which take the
+    database write lock up front: concurrent read-modify-writes queue up
+    (busy_timeout) instead of overwriting each other, across processes too.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path="moon_rabbit.db", busy_timeout=10.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+
+    def warm_up(self):
+        self._conn()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # WAL + NORMAL: durable at checkpoints, never corrupt; the usual pairing
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                " collection TEXT NOT NULL, key TEXT NOT NULL, data TEXT NOT NULL, version INTEGER NOT NULL,"
+                " PRIMARY KEY (collection, key)) WITHOUT ROWID"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _read(self, conn, doc_key):
+        row = conn.execute(
+            "SELECT data, version FROM documents WHERE collection = ? AND key = ?", doc_key
+        ).fetchone()
+        return (_decode(row[0]), row[1]) if row else (None, None)
+
+    def get(self, collection, key):
+        data, version = self._read(self._conn(), (collection, key))
+        return Document(key, data, version)
+
+    def get_many(self, collection, keys):
+        keys = list(keys)
+        found = {}
+        conn = self._conn()
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = conn.execute(
+                f"SELECT key, data, version FROM documents WHERE collection = ? AND key IN ({','.join('?' * len(chunk))})",
+                [collection, *chunk],
+            )
+            for key, data, version in rows:
+                found[key] = Document(key, _decode(data), version)
+        return {key: found.get(key) or Document(key) for key in keys}
+
+    def create(self, collection, key, data):
+        return self.write_many([Write("create", collection, key, data)])
+
+    def transact(self, collection, key, func, max_attempts=5):
+        with self._transaction() as conn:
+            data, version = self._read(conn, (collection, key))
+            result, writes = func(Document(key, data, version))
+            self._commit(conn, writes)
+        return result
+
+    def write_many(self, writes):
+        return self.commit(writes) is not None
+
+    def commit(self, writes):
+        try:
+            with self._transaction() as conn:
+                return self._commit(conn, writes)
+        except StorageConflict:
+            return None
+
+    def _commit(self, conn, writes):
+        staged = _stage(writes, lambda doc_key: self._read(conn, doc_key))
+        versions = {}
+        for (collection, key), data in staged.items():
+            versions[(collection, key)] = conn.execute(
+                "INSERT INTO documents (collection, key, data, version) VALUES (?, ?, ?, 1)"
+                " ON CONFLICT (collection, key) DO UPDATE SET data = excluded.data, version = version + 1"
+                " RETURNING version",
+                (collection, key, _encode(data)),
+            ).fetchone()[0]
+        return versions
+
+    def top(self, collection, field, limit):
+        rows = self._conn().execute(
+            "SELECT key, data, version FROM documents WHERE collection = ?"
+            " AND json_type(data, ?) IN ('integer', 'real') ORDER BY json_extract(data, ?) DESC LIMIT ?",
+            (collection, f"$.{field}", f"$.{field}", limit),
+        )
+        return [Document(key, _decode(data), version) for key, data, version in rows]
+
+    def scan(self, collection):
+        rows = self._conn().execute("SELECT key, data, version FROM documents WHERE collection = ?", (collection,))
+        return [Document(key, _decode(data), version) for key, data, version in rows]
+
+    def scan_page(self, collection, after=None, limit=1000):
+        # the primary key makes this a range scan, however deep the cursor
+        rows = self._conn().execute(
+            "SELECT key, data, version FROM documents WHERE collection = ? AND key > ? ORDER BY key LIMIT ?",
+            (collection, after if after is not None else "", limit),
+        )
+        return [Document(key, _decode(data), version) for key, data, version in rows]
+
+
+def _encode(data):
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=_encode_value)
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    raise TypeError(f"Cannot store {type(value).__name__}")
+
+
+def _decode(text):
+    return json.loads(text, object_hook=_decode_object)
+
+
+def _decode_object(obj):
+    if len(obj) == 1 and "$datetime" in obj:
+        return datetime.fromisoformat(obj["$datetime"])
+    return obj
+
+
+class FirestoreBackend:
+    """Cloud Firestore; versions are document update times."""
+
+    name = "firestore"
+
+    def __init__(self, client_factory):
+        self.client_factory = client_factory
+
+    def warm_up(self):
+        self.client_factory()
+
+    def _ref(self, db, collection, key):
+        return db.collection(collection).document(key)
+
+    def get(self, collection, key):
+        return _document(self._ref(self.client_factory(), collection, key).get())
+
+    def get_many(self, collection, keys):
+        db = self.client_factory()
+        docs = {snapshot.id: _document(snapshot) for snapshot in db.get_all([self._ref(db, collection, key) for key in keys])}
+        return {key: docs.get(key) or Document(key) for key in keys}
+
+    def create(self, collection, key, data):
+        from google.api_core.exceptions import AlreadyExists, Conflict
+        try:
+            self._ref(self.client_factory(), collection, key).create(_to_firestore(data))
+        except (AlreadyExists, Conflict):
+            return False
+        return True
+
+    def transact(self, collection, key, func, max_attempts=5):
+        from firebase_admin import firestore
+        db = self.client_factory()
+        ref = self._ref(db, collection, key)
+
+        @firestore.transactional
+        def run(transaction):
+            result, writes = func(_document(ref.get(transaction=transaction)))
+            for write in writes:
+                self._queue(db, transaction, write)
+            return result
+        return run(db.transaction(max_attempts=max_attempts))
+
+    def write_many(self, writes):
+        return self.commit(writes) is not None
+
+    def commit(self, writes):
+        from google.api_core.exceptions import AlreadyExists, Conflict, FailedPrecondition, NotFound
+        db = self.client_factory()
+        batch = db.batch()
+        for write in writes:
+            self._queue(db, batch, write)
+        try:
+            results = batch.commit()
+        except (FailedPrecondition, AlreadyExists, Conflict, NotFound):
+            return None
+        # one WriteResult per write, in order
+        return {(write.collection, write.key): result.update_time for write, result in zip(writes, results)}
+
+    def _queue(self, db, writer, write):
+        """Add a Write to a transaction or write batch."""
+        ref = self._ref(db, write.collection, write.key)
+        data = _to_firestore(write.data)
+        if write.op == "set":
+            writer.set(ref, data)
+        elif write.op == "merge":
+            writer.set(ref, data, merge=True)
+        elif write.op == "create":
+            writer.create(ref, data)
+        elif write.version is not None:
+            writer.update(ref, data, option=db.write_option(last_update_time=write.version))
+        else:
+            writer.update(ref, data)
+
+    def top(self, collection, field, limit):
+        from google.cloud.firestore import Query
+        query = self.client_factory().collection(collection).order_by(field, direction=Query.DESCENDING).limit(limit)
+        return [_document(snapshot) for snapshot in query.stream()]
+
+    def scan(self, collection):
+        return [_document(snapshot) for snapshot in self.client_factory().collection(collection).stream()]
+
+    def scan_page(self, collection, after=None, limit=1000):
+        from google.cloud.firestore_v1.field_path import FieldPath
+        db = self.client_factory()
+        query = db.collection(collection).order_by(FieldPath.document_id()).limit(limit)
+        if after is not None:
+            query = query.start_after({FieldPath.document_id(): self._ref(db, collection, after)})
+        return [_document(snapshot) for snapshot in query.stream()]
+
+
+def _document(snapshot):
+    if not snapshot.exists:
+        return Document(snapshot.id)
+    return Document(snapshot.id, snapshot.to_dict(), snapshot.update_time)
+
+
+def _to_firestore(data):
+    from google.cloud import firestore
+    converted = {}
+    for name, value in data.items():
+        if value is DELETE:
+            value = firestore.DELETE_FIELD
+        elif isinstance(value, Increment):
+            value = firestore.Increment(value.value)
+        elif isinstance(value, dict):
+            value = _to_firestore(value)
+        converted[name] = value
+    return converted
@@ -0,0 +1,70 @@
+import pytest
+
+np = pytest.importorskip("numpy")  # requirements-analytics.txt
+from analytics_export import ColumnExporter, daily_stats, load_columns, user_hash
+from storage import InMemoryBackend, Write
+from user_state import ITEM_BITS, UserState
+
+DAY = 20000
+DOLL = ITEM_BITS["substitute_doll"]
+
+
+def make_players(backend, count=25):
+    writes = []
+    for i in range(count):
+        state = UserState(user_id=f"U{i:03d}", carrot_count=i, current_streak=i % 8,
+                          last_login_day=DAY - i % 3, item_bits=DOLL if i % 5 == 0 else 0,
+                          current_look="pink" if i % 4 == 0 else "normal")
+        writes.append(Write("set", "rabbit_gamers", state.user_id, state.to_dict()))
+    # a v1 document is migrated on the way out
+    writes.append(Write("set", "rabbit_gamers", "Uv1", {"user_id": "Uv1", "carrot_count": 3, "items": ["sunglasses"],
+                                                         "last_login": "2024-01-01", "current_streak": 2}))
+    backend.write_many(writes)
+
+
+def test_interrupted_export_resumes_from_cursor(tmp_path):
+    backend = InMemoryBackend()
+    make_players(backend)
+    out = str(tmp_path / "export")
+
+    paused = ColumnExporter(backend, out, page_size=4, chunk_rows=6, today=DAY).run(max_pages=3)
+    assert not paused["complete"]
+    assert paused["rows"] == 12 and paused["cursor"] == "U011"
+
+    manifest = ColumnExporter(backend, out, page_size=4, chunk_rows=6, today=DAY).run()
+    assert manifest["complete"] and manifest["rows"] == 26
+    assert all(chunk["rows"] <= 6 for chunk in manifest["chunks"])
+
+    cols, _ = load_columns(out, ["user_hash", "carrot_count", "item_bits"])
+    assert len(np.unique(cols["user_hash"])) == 26
+    assert cols["carrot_count"].sum() == sum(range(25)) + 3
+    assert cols["item_bits"][-1] == ITEM_BITS["sunglasses"]
+    # a finished export is left alone
+    assert ColumnExporter(backend, out, today=DAY).run()["chunks"] == manifest["chunks"]
+
+
+def test_daily_stats(tmp_path):
+    backend = InMemoryBackend()
+    make_players(backend)
+    before = str(tmp_path / "before")
+    ColumnExporter(backend, before, page_size=10, today=DAY - 1).run()
+
+    # U000 and U005 burn their dolls overnight
+    backend.write_many([Write("update", "rabbit_gamers", user_id, {"item_bits": 0}) for user_id in ("U000", "U005")])
+    after = str(tmp_path / "after")
+    ColumnExporter(backend, after, page_size=10, today=DAY).run()
+
+    stats = daily_stats(after, previous_dir=before)
+    assert stats["players"] == 26
+    assert stats["active"]["1d"] == 9  # i % 3 == 0
+    assert stats["streak"]["buckets"]["0"] == 4
+    assert stats["streak"]["buckets"]["7-13"] == 3
+    assert stats["carrots"]["total"] == sum(range(25)) + 3
+    assert stats["items"]["substitute_doll"] == 3
+    assert stats["looks"] == {"pink": 7, "normal": 19}
+    assert stats["doll_burn"] == {"holders": 5, "burned": 2, "rate": 0.4}
+
+
+def test_user_hash_is_stable():
+    assert user_hash("U123") == user_hash("U123") != user_hash("U124")
+    assert user_hash("U123") < 2 ** 64
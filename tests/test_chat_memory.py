@@ -0,0 +1,77 @@
+from benchmarks.fakes import FakeFirestore
+from chat_memory import ChatMemory, ChatSession, ChatStore, extractive_summary
+from storage import FirestoreBackend
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_history_is_compacted_into_summary():
+    memory = ChatMemory(max_exchanges=4, compact_exchanges=2, summary_max_chars=30)
+    session = memory.load("U1")
+    for i in range(20):
+        memory.record(session, f"質問{i}", f"答え{i}")
+        # prompt size stays bounded however long the conversation gets
+        assert len(session.exchanges) <= 4
+        assert len(session.summary) <= 30
+
+    assert memory.compactions > 0
+    assert [text for text, _ in session.exchanges] == ["質問16", "質問17", "質問18", "質問19"]
+    # the summary keeps the most recent of what was folded away
+    assert session.summary.endswith("質問15")
+
+    contents = session.contents("今の質問")
+    assert contents[0]["parts"][0].startswith("（これまでの会話のまとめ")
+    assert [c["role"] for c in contents[1:]] == ["user", "model"] * 4 + ["user"]
+    assert contents[-1]["parts"] == ["今の質問"]
+
+
+def test_extractive_summary_keeps_user_side():
+    summary = extractive_summary("前の話", [("にんじん好き", "そうだぴょん"), ("月に行きたい", "いいね")], 100)
+    assert summary == "前の話 / にんじん好き / 月に行きたい"
+
+
+def test_lru_and_idle_sessions_go_cold():
+    clock = FakeClock()
+    memory = ChatMemory(max_sessions=2, idle_ttl=60, clock=clock)
+    sessions = {user: memory.load(user) for user in ("A", "B")}
+    memory.record(sessions["A"], "hi", "hello")
+    memory.record(sessions["B"], "hi", "hello")
+
+    # a third user pushes out the least recently used one
+    cold = memory.record(memory.load("C"), "hi", "hello")
+    assert [s.user_id for s in cold] == ["A"]
+    assert memory.hot("A") is None
+
+    clock.now = 120
+    cold = memory.record(memory.load("D"), "hi", "hello")
+    assert sorted(s.user_id for s in cold) == ["B", "C"]
+    assert len(memory) == 1
+
+
+def test_cold_sessions_round_trip_through_firestore():
+    db = FakeFirestore()
+    backend = FirestoreBackend(lambda: db)
+    store = ChatStore(lambda: backend)
+    memory = ChatMemory(max_sessions=1, store=store)
+    first = memory.load("U1")
+    memory.record(first, "にんじん好き？", "大好きだぴょん🥕")
+    memory.persist(memory.record(memory.load("U2"), "こんにちは", "こんにちはだうさ"))
+    assert memory.saved == 1
+
+    # stored under the user's rabbit_gamers document
+    assert ("rabbit_gamers/U1/chat_memory", "session") in db._docs
+
+    reloaded = ChatMemory(store=store).load("U1")
+    assert list(reloaded.exchanges) == [("にんじん好き？", "大好きだぴょん🥕")]
+    assert not reloaded.dirty
+
+
+def test_session_from_dict_ignores_unpaired_turn():
+    session = ChatSession.from_dict("U1", {"summary": "s", "turns": ["a", "b", "c"]})
+    assert list(session.exchanges) == [("a", "b")]
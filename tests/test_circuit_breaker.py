@@ -0,0 +1,219 @@
+import asyncio
+from unittest.mock import patch
+import pytest
+import game_logic
+from benchmarks.fakes import install_fakes
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, GuardedBackend
+from storage import InMemoryBackend
+from user_state import UserState
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def boom():
+    raise ConnectionError("down")
+
+
+def test_opens_on_failure_rate_and_rejects():
+    clock = FakeClock()
+    breaker = CircuitBreaker("dep", failure_rate=0.5, min_calls=4, open_seconds=10, clock=clock)
+    for fail in (False, True, False):
+        breaker.record(fail)
+    assert breaker.state == CLOSED  # below min_calls
+    breaker.record(True)
+    assert breaker.state == OPEN
+
+    calls = []
+    with pytest.raises(CircuitOpenError):
+        breaker.call(calls.append, 1)
+    assert calls == []
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_half_open_probe_closes_or_reopens():
+    clock = FakeClock()
+    breaker = CircuitBreaker("dep", min_calls=2, open_seconds=10, clock=clock)
+    breaker.record(True)
+    breaker.record(True)
+    clock.now = 10
+    assert breaker.state == HALF_OPEN
+
+    with pytest.raises(ConnectionError):
+        breaker.call(boom)
+    assert breaker.state == OPEN
+    assert breaker.opened == 2
+
+    clock.now = 20
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.state == CLOSED
+
+
+def test_half_open_lets_only_the_probes_through():
+    clock = FakeClock()
+    breaker = CircuitBreaker("dep", min_calls=1, open_seconds=10, probes=1, clock=clock)
+    breaker.record(True)
+    clock.now = 10
+    assert breaker.allow() is True
+    assert breaker.allow() is False  # the probe is still out
+
+
+def test_slow_calls_count_as_failures():
+    clock = FakeClock()
+    breaker = CircuitBreaker("dep", min_calls=2, slow_call=1.0, clock=clock)
+
+    def slow():
+        clock.now += 2
+        return "late"
+
+    assert breaker.call(slow) == "late"
+    assert breaker.call(slow) == "late"
+    assert breaker.state == OPEN
+
+
+def test_old_failures_leave_the_window():
+    clock = FakeClock()
+    breaker = CircuitBreaker("dep", failure_rate=0.5, min_calls=3, window=30, clock=clock)
+    breaker.record(True)
+    breaker.record(True)
+    clock.now = 31
+    breaker.record(False)
+    assert breaker.state == CLOSED
+    assert breaker.stats()["window_calls"] == 1
+
+
+def test_guarded_backend_counts_errors_not_conflicts():
+    backend = InMemoryBackend()
+    breaker = CircuitBreaker("storage", failure_rate=0.3, min_calls=3)
+    guarded = GuardedBackend(backend, breaker)
+    assert guarded.create("users", "U1", {"n": 1}) is True
+    assert guarded.create("users", "U1", {"n": 2}) is False
+    assert breaker.state == CLOSED
+
+    with patch.object(backend, "get", side_effect=ConnectionError("down")):
+        with pytest.raises(ConnectionError):
+            guarded.get("users", "U1")
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        guarded.get("users", "U1")
+
+
+# --- Fault injection: game_logic against failing stand-ins ---
+
+@pytest.fixture
+def outage():
+    """install_fakes with breakers that trip after two calls and a clock the test moves."""
+    clock = FakeClock()
+    storage_breaker = CircuitBreaker("storage", min_calls=2, open_seconds=10, clock=clock)
+    gemini_breaker = CircuitBreaker("gemini", min_calls=2, open_seconds=10, clock=clock)
+    with patch("game_logic.storage"), patch("game_logic.db"), patch("game_logic.model"), \
+            patch("game_logic.CIRCUIT_BREAKER_ENABLED", True), \
+            patch("game_logic.storage_breaker", storage_breaker), \
+            patch("game_logic.gemini_breaker", gemini_breaker), \
+            patch("game_logic.deferred_writes", game_logic.deque()):
+        db, model = install_fakes()
+        yield clock, db, model
+    game_logic.profile_cache.clear()
+
+
+def trip_storage(db):
+    db.outage = ConnectionError("firestore unavailable")
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            game_logic.get_storage().get("rabbit_gamers", "anyone")
+    assert game_logic.storage_breaker.state == OPEN
+
+
+def test_greeting_is_deferred_and_replayed(outage):
+    clock, db, _ = outage
+    trip_storage(db)
+    rpcs = db.rpcs
+
+    reply = game_logic.run_game_action("U1", "morning_greeting", {})
+    assert reply == game_logic.DEGRADED_GREETING_MESSAGE
+    assert db.rpcs == rpcs  # answered without touching storage
+    assert len(game_logic.deferred_writes) == 1
+
+    # still open: nothing is replayed
+    game_logic.replay_deferred()
+    assert len(game_logic.deferred_writes) == 1
+
+    db.outage = None
+    clock.now = 10
+    game_logic.replay_deferred()
+    assert not game_logic.deferred_writes
+    stored = UserState.from_dict(game_logic.storage.get("rabbit_gamers", "U1").data, "U1")
+    assert stored.carrot_count == 1
+    assert stored.last_login_day == game_logic.today_number()
+    assert game_logic.storage_breaker.state == CLOSED
+
+
+def test_purchase_is_refused_while_storage_is_down(outage):
+    _, db, _ = outage
+    trip_storage(db)
+    reply = game_logic.run_game_action("U1", "purchase", {"item_key": "pink_dye"})
+    assert reply == game_logic.DEGRADED_SHOP_MESSAGE
+    assert not game_logic.deferred_writes
+
+
+def test_chat_gets_canned_reply_while_gemini_is_down(outage):
+    _, _, model = outage
+    model.outage = ConnectionError("gemini unavailable")
+    with patch("game_logic.CHAT_MEMORY_ENABLED", False), patch("game_logic.get_cached_reply", return_value=None):
+        for i in range(2):
+            asyncio.run(game_logic.get_gemini_reply_async(f"hello{i}"))
+        assert game_logic.gemini_breaker.state == OPEN
+        calls = model.calls
+        reply = asyncio.run(game_logic.get_gemini_reply_async("hello"))
+    assert reply in game_logic.DEGRADED_CHAT_REPLIES
+    assert model.calls == calls
+
+
+def test_sync_chat_goes_through_the_gemini_breaker(outage):
+    _, _, model = outage
+    model.outage = ConnectionError("gemini unavailable")
+    with patch("game_logic.get_cached_reply", return_value=None):
+        for i in range(2):
+            assert game_logic.get_gemini_reply(f"hello{i}") == game_logic.GEMINI_FALLBACK_MESSAGE
+        calls = model.calls
+        reply = game_logic.get_gemini_reply("hello")
+    assert reply in game_logic.DEGRADED_CHAT_REPLIES
+    assert model.calls == calls
+
+
+def test_cancelled_calls_are_not_failures():
+    breaker = CircuitBreaker("dep", min_calls=1)
+
+    async def hang():
+        await asyncio.sleep(10)
+
+    async def cancel_one():
+        task = asyncio.create_task(breaker.call_async(hang))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    async def deadline():
+        with pytest.raises(asyncio.TimeoutError):
+            await breaker.call_async(lambda: asyncio.wait_for(hang(), timeout=0.01))
+
+    asyncio.run(cancel_one())
+    assert breaker.state == CLOSED
+    asyncio.run(deadline())
+    assert breaker.state == OPEN
+
+
+def test_chat_memory_skips_storage_quietly_while_open(outage, caplog):
+    _, db, _ = outage
+    trip_storage(db)
+    with patch("game_logic.CHAT_MEMORY_ENABLED", True), patch("game_logic.get_cached_reply", return_value=None):
+        reply = asyncio.run(game_logic.get_gemini_reply_async("hello", user_id="U_chat_outage"))
+    assert reply
+    assert "storage circuit is open" in caplog.text
+    assert not [r for r in caplog.records if r.exc_info]
@@ -0,0 +1,38 @@
+from commands import CommandRouter, KeywordMatcher
+
+
+def test_keyword_matcher_priority_and_overlap():
+    matcher = KeywordMatcher(["おはよう", "おやすみ", "はよ"])
+    assert matcher.best("みんなおはよう！") == 0
+    # highest priority wins regardless of position in the text
+    assert matcher.best("おやすみ、そしておはよう") == 0
+    assert matcher.best("もうおやすみ") == 1
+    # overlapping / nested keywords are still found
+    assert matcher.best("はよう") == 2
+    assert matcher.best("こんにちは") is None
+
+
+def test_router_exact_keyword_and_fallback():
+    router = CommandRouter(fallback="chat")
+    router.add_keyword("おはよう", "greeting")
+    router.add_exact("ショップ", "shop")
+    router.add_keyword("おやすみ", "night")
+
+    assert router.resolve("ショップ") == "shop"
+    assert router.resolve("ショップ見たい") == "chat"
+    assert router.resolve("おはようございます") == "greeting"
+    assert router.resolve("おやすみなさい") == "night"
+    assert router.resolve("おやすみ…おはよう") == "greeting"
+    assert router.resolve("元気？") == "chat"
+
+
+def test_main_router_covers_shop_items():
+    import main
+    from config import SHOP_ITEMS
+
+    for item_key, item in SHOP_ITEMS.items():
+        command = main.router.resolve(item["buy_command"])
+        assert isinstance(command, main.GameCommand)
+        assert command.kwargs == {"item_key": item_key}
+    assert main.router.resolve("今日もおはよう").action == "morning_greeting"
+    assert main.router.resolve("何してるの？") is main.chat_with_rabbit
@@ -0,0 +1,66 @@
+from benchmarks.fakes import FakeFirestore
+from event_dedup import EventDeduplicator, SharedEventStore
+from storage import FirestoreBackend
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_duplicates_within_ttl_are_dropped():
+    clock = FakeClock()
+    dedup = EventDeduplicator(ttl=60, clock=clock)
+    assert dedup.is_duplicate("E1") is False
+    assert dedup.is_duplicate("E1", redelivery=True) is True
+    clock.now = 61
+    assert dedup.is_duplicate("E1", redelivery=True) is False
+    stats = dedup.stats()
+    assert stats["duplicates_dropped"] == 1
+    assert stats["redeliveries"] == 2
+
+
+def test_seen_set_is_bounded_and_expires():
+    clock = FakeClock()
+    dedup = EventDeduplicator(max_entries=3, ttl=10, clock=clock)
+    for i in range(5):
+        dedup.is_duplicate(f"E{i}")
+    assert dedup.stats()["entries"] == 3
+    clock.now = 11
+    dedup.is_duplicate("E9")
+    assert dedup.stats()["entries"] == 1
+
+
+def test_events_without_id_are_never_duplicates():
+    dedup = EventDeduplicator()
+    assert dedup.is_duplicate(None) is False
+    assert dedup.is_duplicate(None) is False
+
+
+def test_forgotten_event_can_be_accepted_again():
+    dedup = EventDeduplicator()
+    dedup.is_duplicate("E1")
+    dedup.forget("E1")
+    assert dedup.is_duplicate("E1") is False
+
+
+def test_shared_store_claims_each_event_once():
+    db = FakeFirestore()
+    backend = FirestoreBackend(lambda: db)
+    instance_a = EventDeduplicator(store=SharedEventStore(lambda: backend))
+    instance_b = EventDeduplicator(store=SharedEventStore(lambda: backend))
+    assert instance_a.claim_shared("E1") is True
+    assert instance_b.claim_shared("E1") is False
+    assert instance_b.stats()["shared_duplicates"] == 1
+    assert EventDeduplicator().claim_shared("E1") is True
+
+
+def test_shared_store_outage_fails_open():
+    db = FakeFirestore()
+    db.outage = ConnectionError("firestore unavailable")
+    dedup = EventDeduplicator(store=SharedEventStore(lambda: FirestoreBackend(lambda: db)))
+    assert dedup.claim_shared("E1") is True
+    assert dedup.stats()["shared_errors"] == 1
@@ -0,0 +1,97 @@
+import asyncio
+import time
+import pytest
+from event_queue import EventProcessor, QueueFullError
+
+
+def test_events_run_concurrently():
+    """Blocking handlers should overlap across the worker pool."""
+    done = []
+
+    def slow_handler(event):
+        time.sleep(0.1)
+        done.append(event)
+
+    async def scenario():
+        processor = EventProcessor(slow_handler, maxsize=10, workers=5)
+        await processor.start()
+        started = time.monotonic()
+        processor.submit_many(list(range(5)))
+        await processor.stop()
+        return processor, time.monotonic() - started
+
+    processor, elapsed = asyncio.run(scenario())
+    assert sorted(done) == [0, 1, 2, 3, 4]
+    assert elapsed < 0.4
+    assert processor.stats()["processed"] == 5
+
+
+def test_backpressure_rejects_whole_payload():
+    """A payload that doesn't fit is rejected entirely, nothing half-queued."""
+    async def handler(event):
+        await asyncio.sleep(10)
+
+    async def scenario():
+        processor = EventProcessor(handler, maxsize=2, workers=1, drain_timeout=0.01)
+        await processor.start()
+        processor.submit_many(["a", "b"])
+        with pytest.raises(QueueFullError):
+            processor.submit_many(["c", "d", "e"])
+        stats = processor.stats()
+        await processor.stop()
+        return stats
+
+    stats = asyncio.run(scenario())
+    assert stats["enqueued"] == 2
+    assert stats["rejected"] == 3
+
+
+def test_stop_drains_queue_and_counts_failures():
+    """Shutdown waits for queued events; handler errors are counted, not raised."""
+    seen = []
+
+    async def handler(event):
+        await asyncio.sleep(0.01)
+        if event == "bad":
+            raise RuntimeError("boom")
+        seen.append(event)
+
+    async def scenario():
+        processor = EventProcessor(handler, maxsize=10, workers=1)
+        await processor.start()
+        processor.submit_many(["a", "bad", "b"])
+        await processor.stop()
+        return processor.stats()
+
+    stats = asyncio.run(scenario())
+    assert seen == ["a", "b"]
+    assert stats["processed"] == 2
+    assert stats["failed"] == 1
+    assert stats["queue_size"] == 0
+
+
+def test_fair_queue_interleaves_users():
+    """A user with a backlog doesn't hold up others queued after it."""
+    order = []
+
+    async def handler(event):
+        order.append(event)
+
+    async def scenario():
+        processor = EventProcessor(handler, maxsize=20, workers=1,
+                                   flow=lambda event: event[0],
+                                   cost=lambda event: 3.0 if event[1] == "chat" else 1.0)
+        await processor.start()
+        processor.submit_many([("heavy", i) for i in range(10)])
+        processor.submit_many([("light", 0), ("light", 1)])
+        processor.submit_many([("chatty", "chat"), ("chatty", "chat")])
+        await processor.stop()
+
+    asyncio.run(scenario())
+    positions = {event: i for i, event in enumerate(order)}
+    assert positions[("light", 1)] < 4
+    # per-user order is kept
+    assert [e for e in order if e[0] == "heavy"] == [("heavy", i) for i in range(10)]
+    # costlier events use up their user's share faster
+    chatty = [i for i, e in enumerate(order) if e[0] == "chatty"]
+    assert chatty[1] > positions[("heavy", 4)]
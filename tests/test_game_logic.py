@@ -1,18 +1,32 @@
+import asyncio
+import os
+import time
 import pytest
 from datetime import datetime, date, timedelta
 from unittest.mock import MagicMock, patch
+from google.api_core.exceptions import ResourceExhausted
 import game_logic
+from storage import InMemoryBackend, Write
+from user_state import UserState, day_number
 
 @pytest.fixture
-def mock_firestore():
-    """Mock the Firestore client and document reference."""
-    with patch("game_logic.init_db") as mock_init:
-        mock_db = MagicMock()
-        mock_init.return_value = mock_db
+def storage():
+    """In-memory storage backend with a spy on every commit and read."""
+    backend = InMemoryBackend()
+    backend._commit = MagicMock(wraps=backend._commit)
+    backend.get = MagicMock(wraps=backend.get)
+    game_logic.profile_cache.clear()
+    with patch("game_logic.storage", backend):
+        yield backend
+    game_logic.profile_cache.clear()
 
-        mock_doc_ref = MagicMock()
-        mock_db.collection.return_value.document.return_value = mock_doc_ref
-        yield mock_db, mock_doc_ref
+def committed(backend):
+    """Writes of the last commit."""
+    return backend._commit.call_args.args[0]
+
+def put_user(backend, data):
+    backend.write_many([Write("set", "rabbit_gamers", data["user_id"], data)])
+    backend._commit.reset_mock()
 
 def test_moon_info():
     """Test that moon info returns a string containing an emoji."""
@@ -22,61 +36,338 @@ def test_moon_info():
     emojis = ["🌑", "🌒", "🌓", "🌔", "🌕", "🌖", "🌗", "🌘"]
     assert any(e in moon_info for e in emojis)
 
-def test_get_or_create_user_new(mock_firestore):
+def test_get_or_create_user_new(storage):
     """Test creating a new user."""
-    _, mock_doc_ref = mock_firestore
-
-    # Simulate non-existent document
-    mock_doc = MagicMock()
-    mock_doc.exists = False
-    mock_doc_ref.get.return_value = mock_doc
-
-    user_data, _ = game_logic.get_or_create_user("test_user_123")
+    user_data = game_logic.get_or_create_user("test_user_123")
 
     # should return default data
-    assert user_data["user_id"] == "test_user_123"
-    assert user_data["carrot_count"] == 0
-    # should call set()
-    mock_doc_ref.set.assert_called_once()
+    assert user_data.user_id == "test_user_123"
+    assert user_data.carrot_count == 0
+    # should create the document
+    [write] = committed(storage)
+    assert (write.op, write.key) == ("create", "test_user_123")
+    assert storage.get("rabbit_gamers", "test_user_123").exists
 
-def test_morning_greeting_streak(mock_firestore):
+def test_morning_greeting_streak(storage):
     """Test that streak increases by 1 if logged in yesterday."""
-    _, mock_doc_ref = mock_firestore
-
-    today = datetime.now().date()
-    yesterday = today.replace(day=today.day - 1) # simple logic, might fail on 1st of month but okay for mock
-    # Use patch for datetime to be safe if rigorous, but for simple logic check:
-    # Let's mock the user data returned
-
-    mock_doc = MagicMock()
-    mock_doc.exists = True
-    # Fake user data: logged in yesterday
-    yesterday_str = "2023-01-01" # dummy
-    # Actually, the logic calculates delta. We need to control 'today'.
-
-    # To test logic involving "today", we usually mock datetime.now()
-    # But here we can simply trust the logic if we manipulate the input 'last_login' relative to real today
-    # OR we use freezegun (not installed).
-    # Let's try a logic test without mocking datetime by setting last_login to yesterday's real date.
-
-    real_yesterday_str = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
-
-    mock_doc.to_dict.return_value = {
+    # Logged in yesterday (the login calendar is JST), stored in the v1 schema
+    today = game_logic.get_now_jst().date()
+    real_yesterday_str = (today - timedelta(days=1)).strftime("%Y-%m-%d")
+    put_user(storage, {
         "user_id": "test",
         "carrot_count": 10,
         "current_streak": 5,
         "last_login": real_yesterday_str,
         "items": []
-    }
-    mock_doc_ref.get.return_value = mock_doc
+    })
 
     # Run logic
     msg = game_logic.process_morning_greeting("test")
 
     assert "6日連続" in msg
-    mock_doc_ref.update.assert_called_with({
-        "carrot_count": 11,
-        "last_login": datetime.now().strftime("%Y-%m-%d"),
-        "current_streak": 6,
-        "items": []
-    })
+    stored = storage.get("rabbit_gamers", "test").data
+    assert stored["carrot_count"] == 11
+    assert stored["current_streak"] == 6
+    assert stored["last_login_day"] == day_number(today)
+    assert stored["schema_version"] == 2
+    # the v1 fields are dropped while the document is rewritten anyway
+    assert "items" not in stored and "last_login" not in stored
+
+def test_morning_greeting_writes_only_changed_fields(storage):
+    today = day_number(game_logic.get_now_jst().date())
+    put_user(storage, UserState(user_id="test", carrot_count=3, current_streak=2, last_login_day=today - 1).to_dict())
+
+    with patch("game_logic.LEADERBOARD_ENABLED", False):
+        game_logic.process_morning_greeting("test")
+
+    [write] = committed(storage)
+    assert write.op == "update"
+    assert write.data == {"carrot_count": 4, "current_streak": 3, "last_login_day": today}
+
+class FakeSlowModel:
+    """Stand-in for the Gemini model with a fixed async latency."""
+
+    def __init__(self, latency, failures=None, chunks=None):
+        self.latency = latency
+        self.failures = list(failures or [])
+        self.chunks = chunks  # streamed text pieces (default: one chunk echoing the prompt)
+        self.calls = 0
+        self.chunks_sent = 0
+
+    async def generate_content_async(self, text, stream=False, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if self.failures:
+            raise self.failures.pop(0)
+        if not stream:
+            return MagicMock(text=f"{text}だぴょん")
+        return self._stream(self.chunks or [f"{text}だぴょん"])
+
+    async def _stream(self, chunks):
+        for piece in chunks:
+            self.chunks_sent += 1
+            yield MagicMock(text=piece, usage_metadata=MagicMock(prompt_token_count=5, candidates_token_count=self.chunks_sent))
+
+def test_gemini_async_concurrent_chats():
+    """Many concurrent chats should finish in roughly one model latency."""
+    fake_model = FakeSlowModel(latency=0.2)
+
+    async def chat_burst():
+        started = time.monotonic()
+        replies = await asyncio.gather(
+            *(game_logic.get_gemini_reply_async(f"hello{i}") for i in range(20))
+        )
+        return replies, time.monotonic() - started
+
+    with patch("game_logic.get_model", return_value=fake_model), \
+            patch("game_logic.GEMINI_MAX_CONCURRENCY", 20):
+        replies, elapsed = asyncio.run(chat_burst())
+
+    assert replies[3] == "hello3だぴょん"
+    assert fake_model.calls == 20
+    assert elapsed < 0.2 * 2
+
+def test_gemini_async_timeout_falls_back():
+    fake_model = FakeSlowModel(latency=1.0)
+    with patch("game_logic.get_model", return_value=fake_model), \
+            patch("game_logic.GEMINI_TIMEOUT", 0.05):
+        reply = asyncio.run(game_logic.get_gemini_reply_async("hello"))
+    assert reply == game_logic.GEMINI_FALLBACK_MESSAGE
+
+def test_gemini_async_retries_rate_limit():
+    fake_model = FakeSlowModel(latency=0, failures=[ResourceExhausted("quota")])
+    with patch("game_logic.get_model", return_value=fake_model), \
+            patch("game_logic.GEMINI_RETRY_BASE_DELAY", 0.01):
+        reply = asyncio.run(game_logic.get_gemini_reply_async("hello"))
+    assert reply == "helloだぴょん"
+    assert fake_model.calls == 2
+
+def test_trim_reply_budgets():
+    assert game_logic.trim_reply("こんにちは！元気だぴょん🐰", max_sentences=5) == ("こんにちは！元気だぴょん🐰", False)
+    # sentence budget: trailing emoji stay with their sentence
+    text = "一つ目だぴょん！🐰二つ目だうさ。三つ目！"
+    assert game_logic.trim_reply(text, max_sentences=2) == ("一つ目だぴょん！🐰二つ目だうさ。", True)
+    # char budget: cut at the last sentence end that fits
+    assert game_logic.trim_reply("あいうえお。かきくけこさしすせそ", max_chars=10) == ("あいうえお。", True)
+    # no sentence end to cut at: hard cut with an ellipsis
+    assert game_logic.trim_reply("あ" * 20, max_chars=10) == ("あ" * 9 + "…", True)
+    # a partial stream does not count a sentence until something follows it
+    assert game_logic.trim_reply("一つ目！", final=False, max_sentences=1) == ("一つ目！", False)
+
+def test_streamed_reply_stops_at_budget():
+    chunks = ["おはようだぴょん！", "🐰今日もいい天気", "だうさ。", "月からの", "お知らせ", "だぴょん。"] + ["続き。"] * 50
+    fake_model = FakeSlowModel(latency=0, chunks=chunks)
+    game_logic.reply_cache.backend.clear()
+    before = dict(game_logic.gemini_stats)
+    with patch("game_logic.get_model", return_value=fake_model), \
+            patch("game_logic.GEMINI_REPLY_MAX_SENTENCES", 2):
+        reply = asyncio.run(game_logic.get_gemini_reply_async("長いお話をして"))
+
+    assert reply == "おはようだぴょん！🐰今日もいい天気だうさ。"
+    # the stream is abandoned right after the budget is reached
+    assert fake_model.chunks_sent == 4
+    assert game_logic.gemini_stats["cut_off"] == before["cut_off"] + 1
+    assert game_logic.gemini_stats["output_tokens"] == before["output_tokens"] + 4
+
+def test_gemini_reply_served_from_cache():
+    """Once enough variants are cached, stock phrases skip the model call."""
+    game_logic.reply_cache.backend.clear()
+    mock_model = MagicMock()
+    mock_model.generate_content.return_value = MagicMock(text="こんばんはだぴょん🌙")
+
+    with patch("game_logic.get_model", return_value=mock_model):
+        for _ in range(game_logic.REPLY_CACHE_VARIANTS + 3):
+            assert game_logic.get_gemini_reply("こんばんは！") == "こんばんはだぴょん🌙"
+
+    assert mock_model.generate_content.call_count == game_logic.REPLY_CACHE_VARIANTS
+
+def test_chat_memory_sends_history_and_bypasses_cache():
+    game_logic.reply_cache.backend.clear()
+    game_logic.chat_memory.clear()
+    fake_model = FakeSlowModel(latency=0)
+    seen = []
+    original = fake_model.generate_content_async
+
+    async def record_contents(contents, **kwargs):
+        seen.append(contents)
+        return await original(contents if isinstance(contents, str) else contents[-1]["parts"][0], **kwargs)
+
+    fake_model.generate_content_async = record_contents
+
+    async def conversation():
+        first = await game_logic.get_gemini_reply_async("こんにちは", user_id="U_chat")
+        second = await game_logic.get_gemini_reply_async("こんにちは", user_id="U_chat")
+        return first, second
+
+    with patch("game_logic.get_model", return_value=fake_model), \
+            patch("game_logic.CHAT_MEMORY_ENABLED", True), \
+            patch.object(game_logic.chat_memory, "store", None):
+        first, second = asyncio.run(conversation())
+
+    assert first == second == "こんにちはだぴょん"
+    # the first message is stateless; the second carries the exchange before it
+    assert seen[0] == "こんにちは"
+    assert [c["parts"][0] for c in seen[1]] == ["こんにちは", "こんにちはだぴょん", "こんにちは"]
+    assert len(game_logic.chat_memory.hot("U_chat").exchanges) == 2
+    game_logic.chat_memory.clear()
+
+def test_purchase_reads_profile_once(storage):
+    """process_purchase no longer does a separate existence check before the transaction."""
+    put_user(storage, {"user_id": "buyer", "carrot_count": 12, "items": []})
+
+    with game_logic.read_counter.track_request() as reads:
+        msg = game_logic.process_purchase("buyer", "sunglasses")
+
+    assert "残り人参: 2本" in msg
+    assert reads[0] == 1
+    # the committed result is written through to the profile cache
+    assert game_logic.profile_cache.get("buyer").items == ["sunglasses"]
+
+def test_change_look_uses_cached_profile(storage):
+    put_user(storage, {"user_id": "looker", "items": ["pink_dye"], "current_look": "normal"})
+    game_logic.profile_cache.put("looker", UserState.from_dict({"user_id": "looker", "items": ["pink_dye"], "current_look": "normal"}))
+
+    msg = game_logic.process_change_look("looker", "pink", "pink_dye", "ok", "fail")
+
+    assert msg == "ok"
+    storage.get.assert_not_called()
+    [write] = committed(storage)
+    assert (write.op, write.data) == ("update", {"current_look": "pink"})
+    assert game_logic.profile_cache.get("looker").current_look == "pink"
+
+def test_change_look_rechecks_stale_cache(storage):
+    """A cached profile without the item is re-read before refusing."""
+    put_user(storage, {"user_id": "looker", "items": ["sunglasses"], "current_look": "normal"})
+    game_logic.profile_cache.put("looker", UserState.from_dict({"user_id": "looker", "items": [], "current_look": "normal"}))
+
+    msg = game_logic.process_change_look("looker", "sunglasses", "sunglasses", "ok", "fail")
+
+    assert msg == "ok"
+    storage.get.assert_called_once()
+
+def test_process_batch_groups_reads_and_writes(storage):
+    """One get_many and one atomic commit for a payload with several users."""
+    put_user(storage, {"user_id": "alice", "carrot_count": 30, "items": [], "last_login": None})
+    storage.transact = MagicMock(wraps=storage.transact)
+    actions = [
+        ("alice", "purchase", {"item_key": "pink_dye"}),
+        ("bob", "morning_greeting", {}),
+        ("alice", "change_look", {"look_key": "pink", "item_req": "pink_dye",
+                                  "message_success": "ok", "message_fail": "fail"}),
+    ]
+
+    with patch("game_logic.LEADERBOARD_ENABLED", False):
+        messages = game_logic.process_batch(actions)
+
+    assert "残り人参: 10本" in messages[0]
+    assert "最初のご褒美" in messages[1]
+    # alice's purchase is visible to her look change within the same payload
+    assert messages[2] == "ok"
+    storage._commit.assert_called_once()
+    alice, bob = committed(storage)
+    assert alice.op == "update" and alice.version is not None
+    assert alice.data["carrot_count"] == 10
+    assert alice.data["current_look"] == "pink"
+    assert (bob.op, bob.key) == ("create", "bob")
+    storage.transact.assert_not_called()
+
+def test_process_batch_falls_back_on_conflict(storage):
+    """If a profile changed after the batched read, actions rerun as transactions."""
+    put_user(storage, {"user_id": "alice", "carrot_count": 30, "items": []})
+    storage.commit = MagicMock(return_value=None)
+
+    with patch("game_logic.run_action", return_value="from transaction") as mock_run:
+        messages = game_logic.process_batch([
+            ("alice", "purchase", {"item_key": "sunglasses"}),
+        ])
+
+    assert messages == ["from transaction"]
+    mock_run.assert_called_once()
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires fork()")
+def test_clients_are_rebuilt_after_fork():
+    """A forked worker must not reuse the parent's gRPC-backed clients."""
+    parent_model = object()
+    with patch("game_logic.model", parent_model):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if game_logic.model is None and game_logic.db is None else 1)
+        _, status = os.waitpid(pid, 0)
+        assert os.WEXITSTATUS(status) == 0
+        assert game_logic.model is parent_model
+
+def test_cached_profile_commits_without_reading(storage):
+    with patch("game_logic.today_number", return_value=20000):
+        game_logic.process_morning_greeting("early")
+    storage.get.reset_mock()
+
+    with patch("game_logic.today_number", return_value=20001):
+        msg = game_logic.process_morning_greeting("early")
+
+    assert "2日連続" in msg
+    storage.get.assert_not_called()
+    write = committed(storage)[0]
+    assert (write.op, write.key) == ("update", "early") and write.version is not None
+    # the cached profile now carries the version of that write
+    assert game_logic.profile_cache.get("early").version == storage.get("rabbit_gamers", "early").version
+
+def test_conditional_write_rereads_on_conflict(storage):
+    put_user(storage, {"user_id": "buyer", "carrot_count": 12, "items": []})
+    game_logic.get_or_create_user("buyer")
+    # another instance spends carrots behind this instance's cache
+    storage.write_many([Write("update", "rabbit_gamers", "buyer", {"carrot_count": 11})])
+    conflicts = game_logic.write_stats["conflicts"]
+
+    msg = game_logic.process_purchase("buyer", "sunglasses")
+
+    assert "残り人参: 1本" in msg
+    assert game_logic.write_stats["conflicts"] == conflicts + 1
+    assert storage.get("rabbit_gamers", "buyer").data["carrot_count"] == 1
+
+def test_refusal_from_cache_is_confirmed(storage):
+    put_user(storage, {"user_id": "buyer", "carrot_count": 0, "items": []})
+    game_logic.get_or_create_user("buyer")
+    storage.write_many([Write("update", "rabbit_gamers", "buyer", {"carrot_count": 30})])
+
+    msg = game_logic.process_purchase("buyer", "pink_dye")
+
+    assert "残り人参: 10本" in msg
+
+def test_change_look_without_item_skips_read(storage):
+    put_user(storage, {"user_id": "looker", "items": [], "current_look": "pink"})
+
+    assert game_logic.process_change_look("newcomer", "normal", None, "ok", "fail") == "ok"
+    assert game_logic.process_change_look("looker", "normal", None, "ok", "fail") == "ok"
+
+    assert storage.get("rabbit_gamers", "looker").data["current_look"] == "normal"
+    assert storage.get("rabbit_gamers", "newcomer").data["current_look"] == "normal"
+
+@pytest.mark.parametrize("conditional", [True, False])
+def test_concurrent_messages_from_one_user(conditional):
+    """Simultaneous purchases keep the invariants on either write path."""
+    from concurrent.futures import ThreadPoolExecutor
+    from benchmarks.fakes import FakeFirestore
+    from storage import FirestoreBackend
+
+    db = FakeFirestore(latency=0.001)
+    backend = FirestoreBackend(lambda: db)
+    backend.write_many([Write("set", "rabbit_gamers", "busy", {"user_id": "busy", "carrot_count": 100, "items": []})])
+    game_logic.profile_cache.clear()
+    stats = dict(game_logic.write_stats)
+    items = ["substitute_doll", "sunglasses", "pink_dye"] * 6
+
+    with patch("game_logic.storage", backend), patch("game_logic.CONDITIONAL_WRITES_ENABLED", conditional):
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            messages = list(pool.map(lambda item: game_logic.process_purchase("busy", item), items))
+    game_logic.profile_cache.clear()
+
+    # each item is sold exactly once (single-item policy) and paid for exactly once
+    assert sum(m.startswith("まいどあり") for m in messages) == 3
+    stored = backend.get("rabbit_gamers", "busy").data
+    assert stored["carrot_count"] == 100 - 5 - 10 - 20
+    assert stored["item_bits"] == 0b111
+    if conditional:
+        # every write was a single guarded commit, or a transaction after repeated conflicts
+        assert db.transactions_committed == game_logic.write_stats["transaction_fallbacks"] - stats["transaction_fallbacks"]
+    else:
+        assert game_logic.write_stats["transactions"] - stats["transactions"] == len(items)
@@ -0,0 +1,95 @@
+import random
+import pytest
+from unittest.mock import patch
+import game_logic
+from benchmarks.fakes import install_fakes
+from leaderboard import FenwickTree, LeaderboardStore, RankingIndex
+
+
+@pytest.fixture
+def fake_db():
+    saved = game_logic.db, game_logic.storage, game_logic.model
+    db, _ = install_fakes()
+    game_logic.leaderboard._indexes = None
+    game_logic.leaderboard._top.clear()
+    yield db
+    game_logic.db, game_logic.storage, game_logic.model = saved
+    game_logic.profile_cache.clear()
+    game_logic.leaderboard._indexes = None
+    game_logic.leaderboard._top.clear()
+
+
+def greet_on(day, users):
+    with patch("game_logic.today_number", return_value=20000 + day):
+        for user_id in users:
+            game_logic.process_morning_greeting(user_id)
+
+
+def test_fenwick_prefix_sums():
+    counts = [random.Random(i).randint(0, 9) for i in range(50)]
+    tree = FenwickTree.from_counts(counts)
+    assert [tree.prefix_sum(i) for i in range(50)] == [sum(counts[:i + 1]) for i in range(50)]
+    tree.add(10, 5)
+    assert tree.prefix_sum(49) == sum(counts) + 5
+
+
+def test_ranking_index_matches_brute_force():
+    rng = random.Random(1)
+    scores = [rng.randint(0, 120) for _ in range(500)]
+    index = RankingIndex(max_score=100, counts={})
+    for score in scores:
+        index.move(0, score)
+    for _ in range(200):
+        i = rng.randrange(len(scores))
+        new = rng.randint(0, 120)
+        index.move(scores[i], new)
+        scores[i] = new
+
+    capped = [min(s, 100) for s in scores]
+    assert index.total == sum(1 for s in capped if s > 0)
+    for score in (0, 1, 37, 100, 150):
+        assert index.rank(score) == 1 + sum(1 for s in capped if s > min(score, 100))
+
+
+def test_scoring_transactions_maintain_histogram(fake_db):
+    greet_on(0, ["U1", "U2"])
+    greet_on(1, ["U1", "U2"])
+    greet_on(2, ["U1", "U3"])
+
+    top, rank, total, score = game_logic.get_leaderboard("U2")["streak"]
+    assert top == [("U1", 3), ("U2", 2), ("U3", 1)]
+    assert (rank, total, score) == (2, 3, 2)
+
+    # the shards alone give the same ranking (no profile reads)
+    reads = fake_db.rpcs
+    indexes = LeaderboardStore(game_logic.get_storage).indexes()
+    assert fake_db.rpcs == reads + 1
+    assert indexes["streak"].rank(2) == 2
+    assert indexes["carrots"].total == 3
+
+
+def test_purchase_updates_carrot_rank(fake_db):
+    greet_on(0, ["U1", "U2"])
+    for day in range(1, 5):
+        greet_on(day, ["U1"])
+    assert game_logic.get_leaderboard("U1")["carrots"][1:] == (1, 2, 5)
+
+    game_logic.process_purchase("U1", "substitute_doll")
+    # this instance sees its own write right away; a fresh instance reads the shards
+    assert game_logic.get_leaderboard("U1")["carrots"][1] == 2
+    fresh = LeaderboardStore(game_logic.get_storage)
+    assert fresh.rank("carrots", 0) == (2, 1)
+
+
+def test_batch_path_updates_histogram(fake_db):
+    game_logic.process_batch([("U1", "morning_greeting", {}), ("U2", "morning_greeting", {})])
+    assert LeaderboardStore(game_logic.get_storage).rank("streak", 1) == (1, 2)
+
+
+def test_rebuild_counts_existing_profiles(fake_db):
+    for i in range(5):
+        fake_db.collection("rabbit_gamers").document(f"U{i}").set({"current_streak": i, "carrot_count": 2 * i})
+    store = LeaderboardStore(game_logic.get_storage, shards=4)
+    assert store.rebuild() == {"streak": 4, "carrots": 4}
+    assert store.rank("streak", 2) == (3, 4)
+    assert store.top("carrots")[0] == ("U4", 8)
@@ -0,0 +1,132 @@
+import asyncio
+import time
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from linebot.models import TextSendMessage
+from line_client import AsyncLineClient, LineApiError
+
+
+class LineStubServer:
+    """Local stand-in for the Messaging API with scripted failures."""
+
+    def __init__(self, failures=None):
+        self.failures = list(failures or [])  # (status, headers) returned before succeeding
+        self.requests = []
+        self.peers = set()
+        app = web.Application()
+        app.router.add_post("/v2/bot/message/{kind}", self.handle)
+        self.server = TestServer(app)
+
+    async def handle(self, request):
+        self.peers.add(request.transport.get_extra_info("peername"))
+        self.requests.append((request.match_info["kind"], dict(request.headers), await request.json()))
+        if self.failures:
+            status, headers = self.failures.pop(0)
+            return web.json_response({"message": "error"}, status=status, headers=headers)
+        return web.json_response({})
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.server.close()
+
+    @property
+    def endpoint(self):
+        return str(self.server.make_url(""))
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_connections_are_reused():
+    async def scenario():
+        async with LineStubServer() as stub:
+            client = AsyncLineClient("token", endpoint=stub.endpoint)
+            for i in range(5):
+                await client.reply_message(f"token-{i}", [TextSendMessage(text="hi")])
+            await client.close()
+            return stub, client
+
+    stub, client = run(scenario())
+    assert len(stub.requests) == 5
+    assert len(stub.peers) == 1
+    assert client.stats()["connections_created"] == 1
+    assert stub.requests[0][1]["Authorization"] == "Bearer token"
+    assert stub.requests[0][2]["messages"] == [{"type": "text", "text": "hi"}]
+
+
+def test_retries_on_5xx_and_429():
+    async def scenario():
+        async with LineStubServer(failures=[(500, {}), (429, {"Retry-After": "0"})]) as stub:
+            client = AsyncLineClient("token", endpoint=stub.endpoint, retry_base_delay=0.01)
+            await client.push_message("U1", [TextSendMessage(text="hi")])
+            await client.close()
+            return stub, client
+
+    stub, client = run(scenario())
+    assert len(stub.requests) == 3
+    assert client.stats()["retries"] == 2
+    # every attempt carries the same retry key so LINE can deduplicate
+    assert len({headers["X-Line-Retry-Key"] for _, headers, _ in stub.requests}) == 1
+
+
+def test_client_errors_are_not_retried():
+    async def scenario():
+        async with LineStubServer(failures=[(400, {})]) as stub:
+            client = AsyncLineClient("token", endpoint=stub.endpoint)
+            with pytest.raises(LineApiError) as exc:
+                await client.reply_message("expired", [TextSendMessage(text="hi")])
+            await client.close()
+            return stub, exc.value
+
+    stub, error = run(scenario())
+    assert error.status == 400
+    assert len(stub.requests) == 1
+
+
+def test_reply_retry_respects_token_expiry():
+    async def scenario():
+        async with LineStubServer(failures=[(503, {"Retry-After": "5"})]) as stub:
+            client = AsyncLineClient("token", endpoint=stub.endpoint, reply_token_ttl=50)
+            # the event arrived 48s ago: waiting 5s more would outlive the token
+            with pytest.raises(LineApiError):
+                await client.reply_message("token", [TextSendMessage(text="hi")], received_at=time.time() - 48)
+            await client.close()
+            return stub, client
+
+    stub, client = run(scenario())
+    assert len(stub.requests) == 1
+    assert client.stats()["expired_replies"] == 1
+
+
+def test_multicast_is_chunked():
+    async def scenario():
+        async with LineStubServer() as stub:
+            client = AsyncLineClient("token", endpoint=stub.endpoint)
+            sent = await client.multicast([f"U{i}" for i in range(1200)], [TextSendMessage(text="🌕")])
+            await client.close()
+            return stub, sent
+
+    stub, sent = run(scenario())
+    assert sent == 3
+    assert sorted(len(body["to"]) for kind, _, body in stub.requests) == [200, 500, 500]
+    assert all(kind == "multicast" for kind, _, _ in stub.requests)
+
+
+def test_broadcast_with_shared_retry_key_is_idempotent():
+    async def scenario():
+        # the second worker's broadcast is answered 409: already accepted
+        async with LineStubServer(failures=[(200, {}), (409, {})]) as stub:
+            client = AsyncLineClient("token", endpoint=stub.endpoint)
+            key = "123e4567-e89b-12d3-a456-426614174000"
+            await client.broadcast([TextSendMessage(text="満月")], retry_key=key)
+            await client.broadcast([TextSendMessage(text="満月")], retry_key=key)
+            await client.close()
+            return stub
+
+    stub = run(scenario())
+    assert [kind for kind, _, _ in stub.requests] == ["broadcast", "broadcast"]
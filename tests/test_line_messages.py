@@ -0,0 +1,88 @@
+import json
+import os
+import pytest
+from linebot.models import FlexSendMessage
+from config import IMAGE_URLS, SHOP_ITEMS
+import line_messages
+from line_messages import FlexTemplate
+from user_state import UserState
+
+
+def test_template_renders_only_dynamic_paths():
+    template = FlexTemplate({
+        "type": "bubble",
+        "header": {"type": "box", "contents": [{"type": "text", "text": "static"}]},
+        "body": {"type": "box", "contents": [{"type": "text", "text": "人参: {count} 本"}]},
+    })
+    first = template.render(count=1)
+    second = template.render(count=2)
+
+    assert template.fields == {"count"}
+    assert first["body"]["contents"][0]["text"] == "人参: 1 本"
+    assert second["body"]["contents"][0]["text"] == "人参: 2 本"
+    # static subtrees are shared, not copied
+    assert first["header"] is second["header"]
+    with pytest.raises(KeyError):
+        template.render()
+
+
+def test_shop_message_is_prebuilt():
+    message = line_messages.create_shop_message()
+    assert message is line_messages.create_shop_message()
+    assert isinstance(message, FlexSendMessage)
+    payload = message.as_json_dict()
+    assert payload["altText"] == "月面コンビニ"
+    assert payload["contents"]["type"] == "carousel"
+    buttons = [b["footer"]["contents"][0]["action"] for b in payload["contents"]["contents"]]
+    assert [b["text"] for b in buttons] == [item["buy_command"] for item in SHOP_ITEMS.values()]
+    assert buttons[1]["label"] == "10人参で買う"
+
+
+def test_shop_carousel_matches_hand_written_json():
+    """The templated carousel is the same JSON as the hand-written one it replaced."""
+    path = os.path.join(os.path.dirname(__file__), "data", "shop_carousel.json")
+    with open(path, encoding="utf-8") as f:
+        expected = json.load(f)
+    rendered = line_messages.create_shop_message().as_json_dict()["contents"]
+    assert json.dumps(rendered, ensure_ascii=False) == json.dumps(expected, ensure_ascii=False)
+
+
+def test_member_card_fields():
+    card = line_messages.create_member_card(UserState.from_dict({
+        "carrot_count": 12,
+        "current_streak": 3,
+        "items": ["substitute_doll"],
+        "current_look": "pink",
+    }, "U1")).as_json_dict()
+
+    contents = card["contents"]
+    texts = [c["text"] for c in contents["body"]["contents"][2]["contents"]]
+    assert contents["hero"]["url"] == IMAGE_URLS["pink"]
+    assert texts == [
+        "🥕 所持人参: 12 本",
+        "🔥 連続記録: 3 日",
+        "🧸 身代わり人形: あり 🧸",
+        "状態: ピンクに変身中 🎀",
+    ]
+    # the rendered JSON is still valid for the SDK
+    FlexSendMessage(alt_text="会員証", contents=contents)
+
+
+def test_leaderboard_message_renders():
+    boards = {
+        "streak": ([("Uaaaa1111", 9), ("Ubbbb2222", 9), ("Ume", 4)], 3, 120, 4),
+        "carrots": ([], 121, 120, 0),
+    }
+    message = line_messages.create_leaderboard_message("Ume", boards)
+    # valid Flex for the SDK
+    FlexSendMessage(alt_text=message.alt_text, contents=message.as_json_dict()["contents"])
+
+    streak, carrots = message.contents["contents"]
+    rows = streak["body"]["contents"][line_messages.LEADERBOARD_ROWS_AT]["contents"]
+    assert [row["contents"][0]["text"] for row in rows] == ["🥇", "🥇", "🥉"]
+    assert rows[2]["contents"][1]["text"] == "あなた"
+    assert "3位 / 120匹中" in streak["body"]["contents"][-2]["text"]
+    assert "-位" in carrots["body"]["contents"][-2]["text"]
+    # the shared template stays untouched
+    assert line_messages.LEADERBOARD_TEMPLATE.render(title="", my_rank="", total="", my_score="")[
+        "body"]["contents"][line_messages.LEADERBOARD_ROWS_AT]["contents"] == []
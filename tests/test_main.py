@@ -0,0 +1,116 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import uuid
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+from config import CHANNEL_SECRET
+import main
+from rate_limit import TokenBucketLimiter
+
+
+def make_payload(text, user_id="U_test", event_id=None, redelivery=False):
+    return json.dumps({
+        "destination": "dest",
+        "events": [{
+            "type": "message",
+            "mode": "active",
+            "timestamp": 1700000000000,
+            "source": {"type": "user", "userId": user_id},
+            "replyToken": "reply-token",
+            "webhookEventId": event_id or uuid.uuid4().hex.upper(),
+            "deliveryContext": {"isRedelivery": redelivery},
+            "message": {"type": "text", "id": "1", "text": text},
+        }],
+    })
+
+
+def sign(body):
+    digest = hmac.new(CHANNEL_SECRET.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+def test_callback_acks_before_processing():
+    """/callback returns 200 while the handler is still blocked."""
+    release = threading.Event()
+    handled = []
+
+    async def slow_handler(event):
+        await asyncio.to_thread(release.wait, 5)
+        handled.append(event.message.text)
+
+    body = make_payload("ショップ")
+    with patch("main.handle_message", side_effect=slow_handler):
+        with TestClient(main.app) as client:
+            res = client.post("/callback", content=body, headers={"X-Line-Signature": sign(body)})
+            assert res.status_code == 200
+            assert handled == []
+            release.set()
+        # leaving the client runs the lifespan shutdown, which drains the queue
+    assert handled == ["ショップ"]
+
+
+def test_callback_rejects_bad_signature():
+    body = make_payload("ショップ")
+    with patch("main.handle_message") as mock_handle:
+        with TestClient(main.app) as client:
+            res = client.post("/callback", content=body, headers={"X-Line-Signature": "invalid"})
+    assert res.json() == "Invalid signature"
+    mock_handle.assert_not_called()
+
+
+def test_metrics_report_stage_latency():
+    async def handler(event):
+        pass
+
+    body = make_payload("ショップ")
+    with patch("main.handle_message", side_effect=handler):
+        with TestClient(main.app) as client:
+            client.post("/callback", content=body, headers={"X-Line-Signature": sign(body)})
+            stages = client.get("/metrics").json()["latency"]["stages"]
+    assert stages["webhook.signature"]["count"] >= 1
+    assert set(stages["webhook.signature"]) >= {"p50_ms", "p95_ms", "p99_ms", "max_ms"}
+
+
+def test_redelivered_event_is_handled_once():
+    handled = []
+
+    async def handler(event):
+        handled.append(event.webhook_event_id)
+
+    first = make_payload("おはよう", event_id="01DUPLICATE")
+    again = make_payload("おはよう", event_id="01DUPLICATE", redelivery=True)
+    with patch("main.handle_message", side_effect=handler):
+        with TestClient(main.app) as client:
+            for body in (first, again):
+                res = client.post("/callback", content=body, headers={"X-Line-Signature": sign(body)})
+                assert res.status_code == 200
+            dedup = client.get("/metrics").json()["dedup"]
+    assert handled == ["01DUPLICATE"]
+    assert dedup["duplicates_dropped"] >= 1
+    assert dedup["redeliveries"] >= 1
+
+
+def test_throttled_chat_gets_canned_reply():
+    sent = []
+
+    async def capture_reply(event, messages):
+        sent.append(messages[0].text)
+
+    async def gemini(text, user_id=None):
+        return "こんにちはだぴょん"
+
+    limiter = TokenBucketLimiter(rate=0.001, burst=2)
+    with patch.dict(main.rate_limiters, {"chat": limiter}), \
+            patch("main.send_reply", side_effect=capture_reply), \
+            patch("game_logic.get_gemini_reply_async", side_effect=gemini) as mock_gemini:
+        with TestClient(main.app) as client:
+            for _ in range(3):
+                body = make_payload("こんにちは", user_id="U_flood")
+                client.post("/callback", content=body, headers={"X-Line-Signature": sign(body)})
+    assert sorted(sent) == sorted(["こんにちはだぴょん"] * 2 + [main.THROTTLED_MESSAGE])
+    assert mock_gemini.call_count == 2
+    assert limiter.stats()["throttled"] == 1
@@ -0,0 +1,61 @@
+import threading
+import time
+import pytest
+from metrics import LatencyHistogram, StageMetrics, SlowRequestProfiler
+
+
+def test_histogram_percentiles_within_bucket_error():
+    histogram = LatencyHistogram()
+    for ms in range(1, 101):
+        histogram.observe(ms / 1000)
+    assert histogram.count == 100
+    assert 0.050 <= histogram.percentile(50) <= 0.050 * 1.2
+    assert 0.099 <= histogram.percentile(99) <= 0.100
+    assert histogram.percentile(100) == pytest.approx(0.100)
+    assert LatencyHistogram().percentile(95) == 0.0
+
+
+def test_timer_records_failures():
+    metrics = StageMetrics()
+    with pytest.raises(RuntimeError):
+        with metrics.timer("firestore.get"):
+            raise RuntimeError("boom")
+    with metrics.timer("firestore.get"):
+        pass
+    stats = metrics.stats()
+    assert stats["stages"]["firestore.get"]["count"] == 2
+    assert stats["counters"] == {"firestore.get.error": 1}
+
+
+def busy_firestore_call(release):
+    release.wait(5)
+
+
+def test_profiler_keeps_only_slow_requests():
+    profiler = SlowRequestProfiler(slow_threshold=0.05)
+    profiler._thread = threading.current_thread()  # enabled, sampled by hand below
+    release = threading.Event()
+    worker = threading.Thread(target=busy_firestore_call, args=(release,))
+    worker.start()
+    try:
+        with profiler.request("fast"):
+            profiler.sample()
+        with profiler.request("slow"):
+            profiler.sample()
+            time.sleep(0.06)
+    finally:
+        release.set()
+        worker.join()
+
+    assert [p["name"] for p in profiler.profiles] == ["slow"]
+    stacks = profiler.profiles[0]["stacks"]
+    assert any("test_metrics.py:busy_firestore_call" in stack for stack in stacks)
+    # the sampling thread itself is left out
+    assert not any("test_profiler_keeps_only_slow_requests" in stack for stack in stacks)
+
+
+def test_profiler_disabled_is_a_no_op():
+    profiler = SlowRequestProfiler(slow_threshold=0)
+    with profiler.request("chat"):
+        pass
+    assert list(profiler.profiles) == []
@@ -0,0 +1,98 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+import pytest
+import moon_phase
+from moon_phase import MoonPhaseTable, MoonPhaseScheduler, NEW_MOON, FIRST_QUARTER, FULL_MOON, LAST_QUARTER
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+@pytest.fixture(scope="module")
+def table():
+    return MoonPhaseTable(2022, 2026)
+
+
+# Published phase instants (UTC, to the minute)
+KNOWN_PHASES = [
+    (NEW_MOON, utc(2023, 1, 21, 20, 53)),
+    (NEW_MOON, utc(2024, 1, 11, 11, 57)),
+    (FIRST_QUARTER, utc(2024, 1, 18, 3, 53)),
+    (FULL_MOON, utc(2024, 1, 25, 17, 54)),
+    (LAST_QUARTER, utc(2024, 2, 2, 23, 18)),
+    (FULL_MOON, utc(2025, 9, 7, 18, 9)),
+]
+
+
+@pytest.mark.parametrize("phase, expected", KNOWN_PHASES)
+def test_phase_instants_match_published_dates(table, phase, expected):
+    found = table.next_phase(phase, expected.timestamp() - 5 * 86400)
+    assert abs(found - expected.timestamp()) < 120
+
+
+def test_next_full_and_new_moon(table):
+    assert table.next_full_moon(utc(2024, 1, 12)).date() == utc(2024, 1, 25).date()
+    assert table.next_new_moon(utc(2024, 1, 12)).date() == utc(2024, 2, 9).date()
+    # strictly after: asking at the instant itself gives the following one
+    full = table.next_phase(FULL_MOON, utc(2024, 1, 20))
+    assert table.next_phase(FULL_MOON, full) > full + 29 * 86400
+
+
+def test_describe_and_moon_age(table):
+    assert table.describe(utc(2024, 1, 25, 18)) == "🌕 (満月)"
+    assert table.describe(utc(2024, 1, 11, 12)) == "🌑 (新月)"
+    assert table.describe(utc(2024, 1, 14)) == "🌒 (三日月)"
+    assert table.describe(utc(2024, 1, 22)) == "🌔 (十三夜)"
+    assert table.describe(utc(2024, 2, 6)) == "🌘 (有明月)"
+    assert table.moon_age(utc(2024, 1, 12, 11, 57)) == pytest.approx(1.0, abs=0.01)
+
+
+def test_lookup_outside_table_raises(table):
+    with pytest.raises(ValueError):
+        table.describe(utc(2030, 6, 1))
+
+
+def test_scheduler_fires_at_phase_change(table):
+    full = table.next_phase(FULL_MOON, utc(2024, 1, 20))
+    offset = full - time.time() - 0.05  # the full moon is 50ms away on this clock
+    fired = []
+
+    async def on_phase(phase, when):
+        fired.append((phase, when))
+
+    async def scenario():
+        scheduler = MoonPhaseScheduler(table, on_phase, phases=(NEW_MOON, FULL_MOON),
+                                       clock=lambda: time.time() + offset)
+        scheduler.start()
+        await asyncio.sleep(0.3)
+        await scheduler.stop()
+
+    asyncio.run(scenario())
+    assert fired == [(FULL_MOON, datetime.fromtimestamp(full, timezone.utc))]
+
+
+def test_default_table_covers_now():
+    assert moon_phase.get_table().describe() in moon_phase.PRINCIPAL_LABELS + moon_phase.BETWEEN_LABELS
+
+
+def test_scheduler_rebuilds_table_past_its_end(table):
+    later = MoonPhaseTable(2027, 2028)
+    full = later.next_phase(FULL_MOON, utc(2027, 3, 1))
+    offset = full - time.time() - 0.05  # past the end of `table`
+    fired = []
+
+    async def on_phase(phase, when):
+        fired.append(phase)
+
+    async def scenario():
+        scheduler = MoonPhaseScheduler(table, on_phase, phases=(FULL_MOON,), clock=lambda: time.time() + offset)
+        scheduler.start()
+        await asyncio.sleep(0.3)
+        await scheduler.stop()
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert fired == [FULL_MOON]
+    assert scheduler.table is not table and scheduler.table.end > full
@@ -0,0 +1,49 @@
+import pytest
+from rate_limit import TokenBucketLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_allows_burst_then_refills():
+    clock = FakeClock()
+    limiter = TokenBucketLimiter(rate=0.5, burst=3, clock=clock)
+    assert [limiter.allow("U1") for _ in range(4)] == [True, True, True, False]
+    # other users have their own bucket
+    assert limiter.allow("U2")
+
+    clock.now = 2.0  # one token back
+    assert limiter.allow("U1")
+    assert not limiter.allow("U1")
+    assert limiter.stats()["throttled"] == 2
+
+
+def test_idle_users_are_evicted():
+    clock = FakeClock()
+    limiter = TokenBucketLimiter(rate=1, burst=5, clock=clock)
+    for i in range(100):
+        limiter.allow(f"U{i}")
+    assert len(limiter) == 100
+
+    # after burst / rate seconds every bucket is full again, so it can be forgotten
+    clock.now = 5.0
+    limiter.allow("U_new")
+    assert len(limiter) == 1
+    assert limiter.stats()["evicted"] == 100
+
+
+def test_max_users_bounds_memory():
+    limiter = TokenBucketLimiter(rate=1, burst=5, max_users=10, clock=lambda: 0.0)
+    for i in range(50):
+        limiter.allow(f"U{i}")
+    assert len(limiter) == 10
+
+
+def test_zero_rate_is_rejected():
+    with pytest.raises(ValueError, match="rate must be > 0"):
+        TokenBucketLimiter(rate=0, burst=5)
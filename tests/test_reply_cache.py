@@ -0,0 +1,69 @@
+from reply_cache import ReplyCache, InMemoryReplyCache, normalize_text
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_cache(variants=2, clock=None, max_entries=10):
+    backend = InMemoryReplyCache(max_entries=max_entries, ttl=60, clock=clock or FakeClock())
+    return ReplyCache(backend, "persona", variants=variants, max_input_chars=10)
+
+
+def test_normalize_text():
+    assert normalize_text("おはよう！！") == normalize_text("おはよう〜") == "おはよう"
+    assert normalize_text("ＨＥＬＬＯ  World!") == "hello world"
+    assert normalize_text("コーヒー") == "コーヒー"
+
+
+def test_question_and_statement_have_different_keys():
+    cache = make_cache()
+    assert cache.make_key("元気？") != cache.make_key("元気")
+    assert cache.make_key("元気？") == cache.make_key("元気?")
+
+
+def test_hit_after_variants_collected():
+    cache = make_cache(variants=2)
+    assert cache.lookup("こんにちは") is None
+    cache.store("こんにちは", "A")
+    assert cache.lookup("こんにちは！") is None
+    cache.store("こんにちは", "B")
+    assert cache.lookup("こんにちは") in ("A", "B")
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+def test_long_input_bypasses_cache():
+    cache = make_cache()
+    cache.store("今日あったことを詳しく聞いてほしい", "reply")
+    assert cache.lookup("今日あったことを詳しく聞いてほしい") is None
+    assert cache.stats()["bypassed"] == 1
+    assert len(cache.backend) == 0
+
+
+def test_ttl_and_lru_eviction():
+    clock = FakeClock()
+    cache = make_cache(variants=1, clock=clock, max_entries=2)
+    cache.store("a", "1")
+    cache.store("b", "2")
+    assert cache.lookup("a") == "1"  # refresh "a" so "b" is least recently used
+    cache.store("c", "3")
+    assert cache.lookup("b") is None
+    assert cache.lookup("a") == "1"
+
+    clock.now = 61
+    assert cache.lookup("a") is None
+    assert len(cache.backend) == 1
+
+
+def test_key_depends_on_system_instruction():
+    backend = InMemoryReplyCache()
+    old = ReplyCache(backend, "old persona", variants=1)
+    new = ReplyCache(backend, "new persona", variants=1)
+    old.store("やあ", "old reply")
+    assert old.lookup("やあ") == "old reply"
+    assert new.lookup("やあ") is None
@@ -0,0 +1,47 @@
+"""Cold-start budget: importing main must stay cheap and SDK-free."""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Cumulative import time of `main`, in ms (override for slow CI machines)
+IMPORT_BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS", "1000"))
+LAZY_MODULES = ("firebase_admin", "google.cloud.firestore", "google.generativeai", "aiohttp")
+
+
+def run_python(code, *flags):
+    env = dict(os.environ, CHANNEL_ACCESS_TOKEN="x", CHANNEL_SECRET="y", GEMINI_API_KEY="z", STARTUP_WARMUP="false")
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+
+
+def import_report(stderr):
+    """Parse -X importtime output into {module: cumulative microseconds}."""
+    report = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        report[name.strip()] = int(cumulative)
+    return report
+
+
+def test_import_main_within_budget():
+    report = import_report(run_python("import main", "-X", "importtime").stderr)
+    slowest = sorted(report.items(), key=lambda item: -item[1])[:10]
+    assert report["main"] / 1000 < IMPORT_BUDGET_MS, f"import main: {report['main'] / 1000:.0f} ms; slowest: {slowest}"
+    for module in LAZY_MODULES:
+        assert module not in report, f"{module} is imported at startup"
+
+
+def test_health_check_answers_before_sdks_load():
+    code = (
+        "import sys\n"
+        "from fastapi.testclient import TestClient\n"
+        "import main\n"
+        "with TestClient(main.app) as client:\n"
+        "    assert client.get('/').status_code == 200\n"
+        f"print([m for m in {LAZY_MODULES!r} if m in sys.modules])\n"
+    )
+    assert run_python(code).stdout.strip() == "[]"
@@ -0,0 +1,109 @@
+import threading
+from datetime import datetime, timezone
+import pytest
+from benchmarks.fakes import FakeFirestore
+from storage import DELETE, FirestoreBackend, Increment, InMemoryBackend, SQLiteBackend, Write
+
+
+@pytest.fixture(params=["memory", "sqlite", "firestore"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return InMemoryBackend()
+    if request.param == "sqlite":
+        return SQLiteBackend(str(tmp_path / "rabbit.db"))
+    db = FakeFirestore()
+    return FirestoreBackend(lambda: db)
+
+
+def test_create_only_once(backend):
+    assert backend.create("users", "U1", {"carrot_count": 1}) is True
+    assert backend.create("users", "U1", {"carrot_count": 2}) is False
+    doc = backend.get("users", "U1")
+    assert doc.exists and doc.data == {"carrot_count": 1}
+    assert not backend.get("users", "U2").exists
+
+
+def test_write_ops_and_field_values(backend):
+    when = datetime(2026, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+    assert backend.write_many([
+        Write("set", "users", "U1", {"carrot_count": 5, "items": ["pink_dye"], "created_at": when}),
+        Write("merge", "leaderboard", "shard0", {"streak": {"3": Increment(1)}}),
+    ])
+    assert backend.write_many([
+        Write("update", "users", "U1", {"carrot_count": Increment(-2), "items": DELETE}),
+        Write("merge", "leaderboard", "shard0", {"streak": {"3": Increment(1), "4": Increment(1)}}),
+    ])
+    assert backend.get("users", "U1").data == {"carrot_count": 3, "created_at": when}
+    assert backend.get("leaderboard", "shard0").data == {"streak": {"3": 2, "4": 1}}
+    # update needs an existing document
+    assert backend.write_many([Write("update", "users", "U9", {"carrot_count": 1})]) is False
+
+
+def test_write_many_is_atomic_under_version_preconditions(backend):
+    backend.create("users", "U1", {"carrot_count": 1})
+    stale = backend.get("users", "U1").version
+    backend.write_many([Write("update", "users", "U1", {"carrot_count": 2})])
+
+    assert backend.write_many([
+        Write("create", "users", "U2", {"carrot_count": 1}),
+        Write("update", "users", "U1", {"carrot_count": 9}, version=stale),
+    ]) is False
+    assert backend.get("users", "U1").data == {"carrot_count": 2}
+    assert not backend.get("users", "U2").exists
+
+    fresh = backend.get("users", "U1").version
+    assert backend.write_many([Write("update", "users", "U1", {"carrot_count": 3}, version=fresh)])
+
+
+def test_transact_reads_and_writes_one_document(backend):
+    def add_carrot(doc):
+        count = (doc.data or {}).get("carrot_count", 0) + 1
+        return count, [Write("set", "users", doc.key, {"carrot_count": count})]
+
+    assert backend.transact("users", "U1", add_carrot) == 1
+    assert backend.transact("users", "U1", add_carrot) == 2
+    assert backend.get("users", "U1").data == {"carrot_count": 2}
+
+
+def test_get_many_top_and_scan(backend):
+    for i in range(5):
+        backend.create("users", f"U{i}", {"current_streak": i})
+    backend.create("chat/U1/memory", "session", {"summary": "s"})
+
+    docs = backend.get_many("users", ["U3", "U1", "U7"])
+    assert [doc.data for doc in docs.values()] == [{"current_streak": 3}, {"current_streak": 1}, None]
+    assert [doc.key for doc in backend.top("users", "current_streak", 2)] == ["U4", "U3"]
+    assert sorted(doc.key for doc in backend.scan("users")) == [f"U{i}" for i in range(5)]
+    assert backend.get("chat/U1/memory", "session").data == {"summary": "s"}
+
+
+def test_sqlite_transactions_serialise_across_connections(tmp_path):
+    path = str(tmp_path / "rabbit.db")
+    backends = [SQLiteBackend(path) for _ in range(4)]
+
+    def add_carrot(doc):
+        count = (doc.data or {}).get("carrot_count", 0) + 1
+        return count, [Write("set", "users", "U1", {"carrot_count": count})]
+
+    def worker(backend):
+        for _ in range(25):
+            backend.transact("users", "U1", add_carrot)
+
+    threads = [threading.Thread(target=worker, args=(backend,)) for backend in backends]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert SQLiteBackend(path).get("users", "U1").data == {"carrot_count": 100}
+
+
+def test_scan_page_resumes_after_cursor(backend):
+    for i in (3, 0, 4, 1, 2):
+        backend.create("users", f"U{i}", {"n": i})
+    backend.create("other", "U9", {"n": 9})
+
+    first = backend.scan_page("users", limit=2)
+    rest = backend.scan_page("users", after=first[-1].key, limit=10)
+    assert [doc.key for doc in first + rest] == [f"U{i}" for i in range(5)]
+    assert rest[0].data == {"n": 2}
+    assert backend.scan_page("users", after="U4") == []
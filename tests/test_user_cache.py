@@ -0,0 +1,48 @@
+from user_cache import UserProfileCache, FirestoreReadCounter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_returns_copies():
+    cache = UserProfileCache()
+    cache.put("u1", {"items": ["pink_dye"], "carrot_count": 3})
+    data = cache.get("u1")
+    data["items"].append("sunglasses")
+    assert cache.get("u1")["items"] == ["pink_dye"]
+
+
+def test_cache_lru_and_ttl():
+    clock = FakeClock()
+    cache = UserProfileCache(max_entries=2, ttl=10, clock=clock)
+    cache.put("u1", {"carrot_count": 1})
+    cache.put("u2", {"carrot_count": 2})
+    cache.get("u1")
+    cache.put("u3", {"carrot_count": 3})
+    assert cache.get("u2") is None
+    assert cache.get("u1")["carrot_count"] == 1
+
+    clock.now = 11
+    assert cache.get("u1") is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_read_counter_per_request():
+    counter = FirestoreReadCounter()
+    with counter.track_request():
+        counter.record_read()
+        counter.record_read()
+    with counter.track_request():
+        counter.record_read()
+    counter.record_read()  # outside any request
+
+    stats = counter.stats()
+    assert stats["total_reads"] == 4
+    assert stats["requests"] == 2
+    assert stats["reads_per_request"] == 1.5
+    assert stats["max_reads_per_request"] == 2
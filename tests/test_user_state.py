@@ -0,0 +1,62 @@
+from datetime import date, datetime
+import pytest
+from user_state import UserState, DELETE, SCHEMA_VERSION, day_number, day_to_date
+
+
+def test_day_numbers_round_trip():
+    assert day_number(date(1970, 1, 2)) == 1
+    assert day_to_date(day_number(date(2024, 2, 29))) == date(2024, 2, 29)
+
+
+def test_v1_document_is_migrated_on_read():
+    created = datetime(2024, 1, 1, 7, 0)
+    state = UserState.from_dict({
+        "user_id": "u1",
+        "carrot_count": 7,
+        "current_streak": 2,
+        "last_login": "2024-03-01",
+        "items": ["sunglasses", "substitute_doll", "retired_item"],
+        "current_look": "sunglasses",
+        "current_at": created,
+    })
+
+    assert state.items == ["substitute_doll", "sunglasses"]
+    assert state.has_item("sunglasses") and not state.has_item("pink_dye")
+    assert day_to_date(state.last_login_day) == date(2024, 3, 1)
+    assert state.created_at == created
+    assert not state.is_new
+
+    updates = state.changes()
+    assert updates["schema_version"] == SCHEMA_VERSION
+    assert updates["item_bits"] == state.item_bits
+    assert updates["created_at"] == created
+    assert {name for name, value in updates.items() if value is DELETE} == {"items", "last_login", "current_at"}
+    # unchanged fields the v1 document already holds are not rewritten
+    assert "carrot_count" not in updates and "current_look" not in updates
+
+
+def test_v2_document_writes_only_changed_fields():
+    stored = UserState(user_id="u1", carrot_count=20, last_login_day=19800).to_dict()
+    state = UserState.from_dict(stored)
+    assert state.changes() == {}
+
+    state.carrot_count -= 10
+    state.add_item("pink_dye")
+    assert state.changes() == {"carrot_count": 10, "item_bits": 4}
+
+    state.mark_saved()
+    assert state.changes() == {}
+
+
+def test_copy_is_independent():
+    state = UserState.from_dict(UserState(user_id="u1").to_dict())
+    clone = state.copy()
+    clone.mark_written({"current_look": "pink"})
+    clone.add_item("sunglasses")
+    assert state.current_look == "normal" and state.item_bits == 0
+    assert clone.changes() == {"item_bits": 2}
+
+
+def test_unknown_item_is_rejected():
+    with pytest.raises(KeyError):
+        UserState(user_id="u1").add_item("moon_rock")
@@ -0,0 +1,37 @@
+import asyncio
+import pytest
+import game_logic
+from benchmarks.webhook_bench import percentile, regressions, run_benchmark
+
+
+@pytest.fixture
+def bench_fakes():
+    """run_benchmark installs its own fakes into game_logic; put the originals back."""
+    saved = game_logic.db, game_logic.storage, game_logic.model
+    yield
+    game_logic.db, game_logic.storage, game_logic.model = saved
+    game_logic.profile_cache.clear()
+
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([], 95) == 0.0
+
+
+def test_regressions_flag_slower_p95_and_lower_throughput():
+    baseline = {"ショップ": {"count": 10, "p95_ms": 10.0, "rps": 100.0}}
+    ok = {"ショップ": {"count": 10, "p95_ms": 11.0, "rps": 95.0}}
+    bad = {"ショップ": {"count": 10, "p95_ms": 20.0, "rps": 50.0}}
+    assert regressions(ok, baseline, 0.2) == []
+    assert len(regressions(bad, baseline, 0.2)) == 2
+
+
+def test_small_run_replies_to_every_request(bench_fakes):
+    report, _ = asyncio.run(run_benchmark(
+        requests=40, concurrency=4, users=5,
+        firestore_latency=0, gemini_latency=0, line_latency=0,
+    ))
+    assert report["ALL"]["count"] == 40
+    assert report["ALL"]["rps"] > 0
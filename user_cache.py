@@ -0,0 +1,130 @@
+import contextvars
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def _copy_profile(data):
+    # Copy so callers can't mutate the cached entry (UserState, or a plain
+    # dict whose only nested values are lists)
+    if not isinstance(data, dict):
+        return data.copy()
+    return {k: list(v) if isinstance(v, list) else v for k, v in data.items()}
+
+
+class UserProfileCache:
+    """Bounded, thread-safe LRU of rabbit_gamers profiles keyed by user_id.
+
+    Entries are written through after successful transactions and expire
+    after `ttl` seconds, so profiles changed by another instance are picked
+    up again eventually. Only use cached data where a slightly stale view
+    is harmless (display, item checks that are re-verified on failure).
+    """
+
+    def __init__(self, max_entries=10000, ttl=300.0, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # user_id -> (expires_at, data)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return _copy_profile(entry[1])
+
+    def put(self, user_id, data):
+        with self._lock:
+            self._entries[user_id] = (self.clock() + self.ttl, _copy_profile(data))
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def update(self, user_id, fields):
+        """Apply a partial write to a cached profile (no-op if not cached)."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            if isinstance(entry[1], dict):
+                entry[1].update(_copy_profile(fields))
+            else:
+                entry[1].mark_written(fields)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# Per-request read tally; a mutable holder so increments made in
+# thread-pool workers (which run on a copy of the context) are still seen.
+_request_reads = contextvars.ContextVar("firestore_request_reads", default=None)
+
+
+class FirestoreReadCounter:
+    """Counts Firestore document reads, in total and per handled request."""
+
+    def __init__(self):
+        self.total_reads = 0
+        self.requests = 0
+        self.request_reads = 0
+        self.max_request_reads = 0
+        self._lock = threading.Lock()
+
+    def record_read(self, count=1):
+        with self._lock:
+            self.total_reads += count
+        holder = _request_reads.get()
+        if holder is not None:
+            holder[0] += count
+
+    @contextmanager
+    def track_request(self):
+        """Attribute reads made inside the block to one request."""
+        holder = [0]
+        token = _request_reads.set(holder)
+        try:
+            yield holder
+        finally:
+            _request_reads.reset(token)
+            with self._lock:
+                self.requests += 1
+                self.request_reads += holder[0]
+                self.max_request_reads = max(self.max_request_reads, holder[0])
+
+    def stats(self):
+        return {
+            "total_reads": self.total_reads,
+            "requests": self.requests,
+            "reads_per_request": round(self.request_reads / self.requests, 3) if self.requests else 0.0,
+            "max_reads_per_request": self.max_request_reads,
+        }
@@ -0,0 +1,162 @@
+from dataclasses import dataclass, field, replace
+from datetime import date, datetime
+from storage import DELETE
+
+# v1: items as a list of keys, last_login as "YYYY-MM-DD", created_at / current_at
+# v2: items as a bitmask, last_login_day as a day number, always created_at
+SCHEMA_VERSION = 2
+
+# One bit per shop item. Stored in Firestore: never renumber, only add new bits.
+ITEM_BITS = {
+    "substitute_doll": 1 << 0,
+    "sunglasses": 1 << 1,
+    "pink_dye": 1 << 2,
+}
+
+# v1 fields that are removed from the document on its next write
+LEGACY_FIELDS = ("items", "last_login", "current_at")
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def day_number(day):
+    """date -> days since 1970-01-01 (the login calendar is JST dates)."""
+    return day.toordinal() - _EPOCH_ORDINAL
+
+
+def day_to_date(number):
+    return date.fromordinal(number + _EPOCH_ORDINAL)
+
+
+def item_bit(item_key):
+    try:
+        return ITEM_BITS[item_key]
+    except KeyError:
+        raise KeyError(f"Item has no bit in user_state.ITEM_BITS: {item_key}") from None
+
+
+@dataclass(slots=True)
+class UserState:
+    """One rabbit_gamers profile.
+
+    Remembers the values last read from / written to Firestore, so
+    changes() returns only the fields that need writing.
+    """
+
+    user_id: str
+    carrot_count: int = 0
+    moon_level: int = 1
+    current_streak: int = 0
+    last_login_day: int = None
+    item_bits: int = 0
+    current_look: str = "normal"
+    created_at: datetime = None
+    schema_version: int = SCHEMA_VERSION
+    # storage version of the document _saved describes (None: unknown)
+    version: object = field(default=None, repr=False, compare=False)
+    _saved: dict = field(default=None, repr=False, compare=False)  # None: not in Firestore yet
+    _legacy: tuple = field(default=(), repr=False, compare=False)
+
+    @classmethod
+    def new(cls, user_id, now=None):
+        return cls(user_id=user_id, created_at=now)
+
+    @classmethod
+    def from_dict(cls, data, user_id=None):
+        """Build from a stored document, migrating older schemas in memory."""
+        if data.get("schema_version", 1) >= SCHEMA_VERSION:
+            state = cls(**{name: data[name] for name in PERSISTED_FIELDS if name in data})
+            if state.user_id is None:
+                state.user_id = user_id
+            state._saved = {name: data.get(name) for name in PERSISTED_FIELDS}
+            return state
+        return cls._from_v1(data, user_id)
+
+    @classmethod
+    def _from_v1(cls, data, user_id):
+        item_bits = 0
+        for item_key in data.get("items") or ():
+            item_bits |= ITEM_BITS.get(item_key, 0)
+        last_login = data.get("last_login")
+        state = cls(
+            user_id=data.get("user_id") or user_id,
+            carrot_count=data.get("carrot_count", 0),
+            moon_level=data.get("moon_level", 1),
+            current_streak=data.get("current_streak", 0),
+            last_login_day=day_number(datetime.strptime(last_login, "%Y-%m-%d").date()) if last_login else None,
+            item_bits=item_bits,
+            current_look=data.get("current_look", "normal"),
+            # the morning-greeting create path used to write current_at
+            created_at=data.get("created_at", data.get("current_at")),
+        )
+        # Fields the v1 document already holds in the same form; the rest are
+        # written (and the legacy fields dropped) with the next update
+        state._saved = {name: data[name] for name in ("user_id", "carrot_count", "moon_level",
+                                                      "current_streak", "current_look", "created_at") if name in data}
+        state._legacy = tuple(name for name in LEGACY_FIELDS if name in data)
+        return state
+
+    @property
+    def is_new(self):
+        return self._saved is None
+
+    @property
+    def items(self):
+        """Owned item keys in ITEM_BITS order."""
+        return [key for key, bit in ITEM_BITS.items() if self.item_bits & bit]
+
+    def has_item(self, item_key):
+        return bool(self.item_bits & item_bit(item_key))
+
+    def add_item(self, item_key):
+        self.item_bits |= item_bit(item_key)
+
+    def remove_item(self, item_key):
+        self.item_bits &= ~item_bit(item_key)
+
+    def saved_value(self, name, default=None):
+        """Value of `name` in the stored document (default if not stored)."""
+        return (self._saved or {}).get(name, default)
+
+    def to_dict(self):
+        """Full v2 document."""
+        return {name: getattr(self, name) for name in PERSISTED_FIELDS}
+
+    def changes(self):
+        """Fields that differ from the stored document (DELETE for legacy fields)."""
+        saved = self._saved or {}
+        updates = {}
+        for name in PERSISTED_FIELDS:
+            value = getattr(self, name)
+            if name not in saved or saved[name] != value:
+                updates[name] = value
+        for name in self._legacy:
+            updates[name] = DELETE
+        return updates
+
+    def mark_saved(self, version=None):
+        """Record the current values as what storage holds (at `version`, if known)."""
+        self._saved = self.to_dict()
+        self._legacy = ()
+        self.version = version
+
+    def mark_written(self, fields):
+        """Apply a partial write that has already been committed.
+
+        The document's new version isn't known, so version is cleared.
+        """
+        for name, value in fields.items():
+            setattr(self, name, value)
+            if self._saved is not None:
+                self._saved[name] = value
+        self.version = None
+
+    def copy(self):
+        state = replace(self)
+        if self._saved is not None:
+            state._saved = dict(self._saved)
+        return state
+
+
+PERSISTED_FIELDS = ("schema_version", "user_id", "carrot_count", "moon_level", "current_streak",
+                    "last_login_day", "item_bits", "current_look", "created_at")